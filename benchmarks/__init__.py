@@ -0,0 +1,4 @@
+"""
+    Benchmarks for the fitting application, run with airspeed velocity (asv).
+    See asv.conf.json at the top of the repository.
+"""
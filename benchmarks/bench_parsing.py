@@ -0,0 +1,56 @@
+#pylint: disable=invalid-name, attribute-defined-outside-init
+"""
+    Benchmarks for reading data sets and fit results
+"""
+from __future__ import absolute_import, division, print_function
+
+# Sets up Django, so it comes first
+from . import common
+from . import synthetic
+from fitting import view_util
+from fitting.parsing import refl1d, refl1d_simultaneous
+
+class ExtractAscii(object):
+    """ Extract the data points from a stored plot """
+    params = [1000, 10000, 100000]
+    param_names = ['n_points']
+
+    def setup(self, n_points):
+        """ Create a stored plot """
+        self.html_data = synthetic.plot_div(*synthetic.reflectivity_data(n_points))
+
+    def time_extract_ascii_from_div(self, n_points):
+        """ Extract the points of a plot """
+        view_util.extract_ascii_from_div(self.html_data)
+
+class SimultaneousLog(object):
+    """ Parse the log of a co-refinement """
+    params = [[1, 4], [1000, 50000]]
+    param_names = ['n_models', 'n_points']
+
+    def setup(self, n_models, n_points):
+        """ Create a DREAM log """
+        self.log = common.dream_log(n_models, 10, n_points)
+
+    def time_parse_models_from_log(self, n_models, n_points):
+        """ Read the fit results of each model """
+        refl1d_simultaneous.parse_models_from_log(self.log)
+
+    def track_log_size(self, n_models, n_points):
+        """ Size of the log, in MB """
+        return len(common.dream_log(n_models, 10, n_points)) / 1e6
+    track_log_size.unit = 'MB'
+
+class UpdateModel(object):
+    """ Update a stored model from the log of its fit """
+    params = [[5, 50], [1000, 50000]]
+    param_names = ['n_layers', 'n_points']
+
+    def setup(self, n_layers, n_points):
+        """ Create a model and the log of its fit """
+        self.fixture = common.fit_fixture(n_layers, 1000)
+        self.log = common.dream_log(1, n_layers, n_points)
+
+    def time_update_model(self, n_layers, n_points):
+        """ Read the fit results and save them """
+        refl1d.update_model(self.log, self.fixture.fit_problem)
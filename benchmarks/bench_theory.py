@@ -0,0 +1,58 @@
+#pylint: disable=invalid-name, attribute-defined-outside-init
+"""
+    Benchmarks for theory curves, asymmetries and plots
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+# Sets up Django, so it comes first
+from . import common
+from . import synthetic
+from fitting import job_handling, view_util
+from fitting.parsing import refl1d_simultaneous
+from fitting.simultaneous import model_handling
+
+class ComputeReflectivity(object):
+    """ Compute the theory curve of a model """
+    params = [1, 5, 20, 50]
+    param_names = ['n_layers']
+
+    def setup(self, n_layers):
+        """ Create a data set and a model """
+        self.data = synthetic.reflectivity_data(500)
+        self.model = refl1d_simultaneous.json_to_fit_problem(common.model_json(n_layers), 'bench/1', [])
+
+    def time_compute_reflectivity(self, n_layers):
+        """ Compute the reflectivity and SLD profile """
+        q, r, dr, dq = self.data
+        job_handling.compute_reflectivity(q, r, dr, dq, self.model)
+
+class Asymmetry(object):
+    """ Compute the asymmetry between two data sets """
+    params = [1000, 100000]
+    param_names = ['n_points']
+
+    def setup(self, n_points):
+        """ Create two data sets with slightly different Q values """
+        q, r, dr, _ = synthetic.reflectivity_data(n_points)
+        q_2, r_2, dr_2, _ = synthetic.reflectivity_data(n_points, seed=1)
+        self.data_1 = [q, r, dr]
+        self.data_2 = [q_2 * (1.0 + 1e-4 * np.cos(q_2)), r_2, dr_2]
+
+    def time_compute_asymmetry(self, n_points):
+        """ Match the Q values and compute the asymmetry """
+        model_handling.compute_asymmetry(self.data_1, self.data_2)
+
+class Plot1d(object):
+    """ Produce a plot <div> """
+    params = [[1000, 100000], [None, 0]]
+    param_names = ['n_points', 'max_points']
+
+    def setup(self, n_points, max_points):
+        """ Create a data set """
+        self.data = [list(synthetic.reflectivity_data(n_points))]
+
+    def time_plot1d(self, n_points, max_points):
+        """ Plot a data set, downsampled by default """
+        view_util.plot1d(self.data, data_names='data', x_title=u"Q (1/A)", y_title="Reflectivity",
+                         max_points=max_points)
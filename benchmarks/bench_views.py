@@ -0,0 +1,49 @@
+#pylint: disable=invalid-name, attribute-defined-outside-init
+"""
+    Benchmarks for the fit pages and the co-refinement scripts, with the data
+    served by the datahandler application
+"""
+from __future__ import absolute_import, division, print_function
+
+# Sets up Django, so it comes first
+from . import common
+from django.core.cache import cache
+
+from fitting import view_util
+
+class FitView(object):
+    """ Requests for the fit page of a data set with a model """
+    params = [5, 50]
+    param_names = ['n_layers']
+
+    def setup(self, n_layers):
+        """ Create the data set and its model, and fill the plot cache """
+        self.fixture = common.fit_fixture(n_layers, 2000)
+        self.fixture.client.get(self.fixture.url() + 'plots/')
+
+    def time_fit_page(self, n_layers):
+        """ Fit page, whose plots are loaded separately """
+        self.fixture.client.get(self.fixture.url())
+
+    def time_plots(self, n_layers):
+        """ Plots of the data and theory, computed from scratch """
+        cache.clear()
+        self.fixture.client.get(self.fixture.url() + 'plots/')
+
+    def time_plots_cached(self, n_layers):
+        """ Plots of the data and theory, from the plot cache """
+        self.fixture.client.get(self.fixture.url() + 'plots/')
+
+class CoRefinementScript(object):
+    """ Write the job script of a co-refinement """
+    params = [2, 8]
+    param_names = ['n_models']
+
+    def setup(self, n_models):
+        """ Create the data sets and their models """
+        self.fixture = common.fit_fixture(10, 2000, n_models)
+
+    def time_assemble_simultaneous_job(self, n_models):
+        """ Write the job script """
+        view_util.assemble_simultaneous_job(self.fixture.request(), self.fixture.username,
+                                            self.fixture.data_ids[0], None)
@@ -0,0 +1,172 @@
+#pylint: disable=invalid-name, wrong-import-position
+"""
+    Django setup and fixtures shared by the benchmarks. The synthetic data sets
+    come from benchmarks.synthetic, which the load tests use too.
+
+    The benchmarks run the application found in web_reflectivity/ with its own settings,
+    against a test database created for the benchmark process. The datahandler application
+    stands in for the live data server: uploaded data sets are stored in that database.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import json
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'web_reflectivity')
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web_reflectivity.settings')
+
+import django
+django.setup()
+
+from django.apps import apps
+from django.db import connection
+from django.test import Client, RequestFactory, override_settings
+from django.test.utils import setup_test_environment
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from fitting.models import UserData, FitProblem, SimultaneousModel
+from fitting.data_server import data_handler
+from .synthetic import reflectivity_data, data_file_content, fit_form_data
+
+## Fixtures already created in this process
+_fixtures = {}
+
+def setup_database():
+    """
+        Create the test database for this process, once.
+        Tables are created straight from the models, so that the benchmarks
+        don't depend on the migrations having been generated.
+    """
+    if 'database' in _fixtures:
+        return
+    if not data_handler.is_local():
+        raise NotImplementedError("The benchmarks need the datahandler application to store data locally")
+    override_settings(MIGRATION_MODULES=dict((app.label, None) for app in apps.get_app_configs()),
+                      REQUEST_TIMING_SAMPLE_RATE=0, JOB_HANDLING_HOST='localhost').enable()
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    _fixtures['database'] = True
+
+def _parameter(name, value, fixed=True):
+    """ Return the JSON representation of a refl1d parameter """
+    return dict(name=name, value=value, fixed=fixed, type='Parameter',
+                bounds=dict(type='Unbounded', limits=[0, 1000]))
+
+def model_json(n_layers, n_points=0):
+    """
+        Return a synthetic refl1d experiment, as written in the JSON output of a fit.
+        The thickness, SLD and roughness of each layer are fitted.
+
+        :param int n_layers: number of layers between the front and back media
+        :param int n_points: number of data points held by the probe
+    """
+    def _layer(name, thickness, rho, interface, fixed):
+        """ Return the JSON representation of a slab """
+        return dict(name=name, type='Slab',
+                    thickness=_parameter('%s thickness' % name, thickness, fixed),
+                    interface=_parameter('%s interface' % name, interface, fixed),
+                    material=dict(name=name, type='SLD',
+                                  rho=_parameter('%s rho' % name, rho, fixed),
+                                  irho=_parameter('%s irho' % name, 0.0)))
+    layers = [_layer('Si', 0, 2.07, 5.0, True)]
+    layers.extend([_layer('layer%d' % (i + 1), 50.0, 2.0 + 0.01 * i, 3.0, False) for i in range(n_layers)])
+    layers.append(_layer('air', 0, 0.0, 0.0, True))
+
+    probe = dict(type='QProbe',
+                 intensity=_parameter('intensity', 1.0),
+                 background=_parameter('background', 0.0),
+                 back_absorption=_parameter('back_absorption', 1.0),
+                 theta_offset=_parameter('theta_offset', 0.0))
+    if n_points > 0:
+        q, r, dr, dq = reflectivity_data(n_points)
+        probe.update(dict(Q=q.tolist(), dQ=dq.tolist(), R=r.tolist(), dR=dr.tolist()))
+    return dict(type='Experiment', refl1d='0.8.8', probe=probe,
+                sample=dict(type='Stack', layers=layers))
+
+def dream_log(n_models, n_layers, n_points):
+    """
+        Return a synthetic log of a DREAM fit, as written by the simultaneous job script.
+        Most of its size comes from the data arrays of the JSON models.
+
+        :param int n_models: number of data sets fitted together
+        :param int n_layers: number of layers in each model
+        :param int n_points: number of data points in each data set
+    """
+    names = ['bench/%d' % (i + 1) for i in range(n_models)]
+    lines = ['REFL1D_VERSION 0.8.8', 'SIMULTANEOUS %s' % json.dumps(names), 'MODEL_PARAMS_START']
+    for i in range(n_models):
+        lines.extend(['-- Model %d None' % i, '[chisq=1.%04d(30), nllf=%d.5]' % (i, 100 + i)])
+    lines.append('[overall chisq=1.2345(30), nllf=1234.5]')
+    lines.append('              Parameter       mean  median    best [   68% interval] [   95% interval]')
+    index = 0
+    for i in range(n_layers):
+        for par_name, value in [('thickness', 50.0), ('rho', 2.0 + 0.01 * i), ('interface', 3.0)]:
+            index += 1
+            lines.append('%2d %20s %.4f(35) %.4f %.4f [%.4f %.4f] [%.4f %.4f]'
+                         % (index, 'layer%d %s' % (i + 1, par_name), value, value, value,
+                            value - 0.1, value + 0.1, value - 0.2, value + 0.2))
+    lines.append('MODEL_PARAMS_END')
+    model = json.dumps(model_json(n_layers, n_points))
+    for i in range(n_models):
+        lines.extend(['EXPT_START %d' % i, 'MODEL_JSON_START', model, 'MODEL_JSON_END', 'EXPT_END %d' % i])
+    lines.append('Done: 123.4 sec')
+    return '\n'.join(lines) + '\n'
+
+class FitFixture(object):
+    """
+        A user with uploaded data sets and a model for each of them.
+        The first data set is the parent of a co-refinement with the others.
+    """
+    def __init__(self, n_layers, n_points, n_models=1):
+        """
+            :param int n_layers: number of layers in each model
+            :param int n_points: number of points in each data set
+            :param int n_models: number of data sets
+        """
+        self.username = 'bench_%s_%s_%s' % (n_layers, n_points, n_models)
+        self.user = User.objects.create_user(self.username, '%s@test.com' % self.username, 'benchpassword')
+        self.client = Client()
+        self.client.force_login(self.user)
+
+        files = [SimpleUploadedFile('data_%d.txt' % i, data_file_content(n_points, seed=i)) for i in range(n_models)]
+        self.client.post('/fit/files/', {'name': 'data', 'file': files})
+        self.data_ids = [UserData.objects.get(user=self.user, file_name='data_%d.txt' % i).file_id
+                         for i in range(n_models)]
+        for data_id in self.data_ids:
+            self.client.post(self.url(data_id), fit_form_data('%s/%s' % (self.username, data_id), n_layers))
+        self.fit_problem = FitProblem.objects.get(user=self.user, data_path=self.data_path())
+        for data_id in self.data_ids[1:]:
+            SimultaneousModel.objects.create(fit_problem=self.fit_problem, active=True,
+                                             dependent_data='%s/%s' % (self.username, data_id))
+
+    def data_path(self, data_id=None):
+        """ Return the data path of a data set, the parent data set by default """
+        return '%s/%s' % (self.username, data_id or self.data_ids[0])
+
+    def url(self, data_id=None):
+        """ Return the URL of the fit page of a data set, the parent data set by default """
+        return '/fit/%s/' % self.data_path(data_id)
+
+    def request(self):
+        """ Return a GET request sent by the user of this fixture """
+        request = RequestFactory().get(self.url())
+        request.user = self.user
+        return request
+
+def fit_fixture(n_layers, n_points, n_models=1):
+    """
+        Return the FitFixture with the given sizes, creating it and the
+        test database the first time it is needed in this process.
+
+        :param int n_layers: number of layers in each model
+        :param int n_points: number of points in each data set
+        :param int n_models: number of data sets
+    """
+    setup_database()
+    key = (n_layers, n_points, n_models)
+    if key not in _fixtures:
+        _fixtures[key] = FitFixture(n_layers, n_points, n_models)
+    return _fixtures[key]
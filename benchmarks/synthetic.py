@@ -0,0 +1,79 @@
+#pylint: disable=invalid-name
+"""
+    Synthetic data sets and form data, shared by the benchmarks and the load tests.
+    Only numpy and plotly are needed, so that the stand-in services can use them
+    without setting up Django.
+"""
+from __future__ import absolute_import, division, print_function
+import numpy as np
+
+def reflectivity_data(n_points, q_min=0.008, q_max=0.2, seed=0, thickness=250.0):
+    """
+        Return synthetic Q, R, dR and dQ arrays: a reflectivity curve
+        with fringes, 5% errors and a 2.8% Q resolution.
+
+        :param int n_points: number of points
+        :param float q_min: minimum Q
+        :param float q_max: maximum Q
+        :param int seed: seed of the noise
+        :param float thickness: thickness of the film giving the fringes, in Angstrom
+    """
+    random_state = np.random.RandomState(seed)
+    q = np.logspace(np.log10(q_min), np.log10(q_max), n_points)
+    r = np.minimum(1.0, (0.01 / q)**4) * (1.0 + 0.5 * np.cos(2.0 * thickness * q)) + 1e-7
+    dr = 0.05 * r
+    r = np.fabs(r + dr * random_state.standard_normal(n_points))
+    return q, r, dr, 0.028 * q
+
+def data_file_content(n_points, seed=0):
+    """
+        Return the content of a four-column data file
+        :param int n_points: number of points
+        :param int seed: seed of the noise
+    """
+    return ''.join(["%g %g %g %g\n" % point for point in zip(*reflectivity_data(n_points, seed=seed))])
+
+def plot_div(q, r, dr, dq, title=''):
+    """
+        Return a data set as a plotly <div> holding every point, which is how the data server stores it
+        :param q: Q values
+        :param r: reflectivity values
+        :param dr: reflectivity errors
+        :param dq: Q resolution
+        :param str title: name of the trace
+    """
+    import plotly.offline as py
+    trace = dict(type='scatter', mode='markers', name=title, x=q, y=r,
+                 error_x=dict(type='data', array=dq, visible=True),
+                 error_y=dict(type='data', array=dr, visible=True))
+    layout = dict(xaxis=dict(title=u"Q (1/A)", type='log'), yaxis=dict(title="Reflectivity", type='log'))
+    return py.plot(dict(data=[trace], layout=layout), output_type='div', include_plotlyjs=False, show_link=False)
+
+def fit_form_data(data_path, n_layers, button_choice='skip'):
+    """
+        Return the POST data of the fit page for a model with n_layers layers,
+        with the thickness, SLD and roughness of the layers as free parameters.
+
+        :param str data_path: data path, as instrument/data_id
+        :param int n_layers: number of layers
+        :param str button_choice: action, either 'fit', 'evaluate' or 'skip' to save the model without evaluating it
+    """
+    form_data = {'data_path': data_path, 'button_choice': button_choice, 'q_min': 0, 'q_max': 1,
+                 'scale': 1, 'scale_min': 0.9, 'scale_max': 1.1, 'scale_is_fixed': 'on',
+                 'background': 0, 'background_min': 0, 'background_max': 1e-6, 'background_is_fixed': 'on',
+                 'front_name': 'air', 'front_sld': 0, 'front_sld_min': 0, 'front_sld_max': 1,
+                 'front_sld_is_fixed': 'on',
+                 'back_name': 'Si', 'back_sld': 2.07, 'back_sld_min': 2.0, 'back_sld_max': 2.1,
+                 'back_sld_is_fixed': 'on',
+                 'back_roughness': 5.0, 'back_roughness_min': 1, 'back_roughness_max': 5,
+                 'back_roughness_is_fixed': 'on',
+                 'form-TOTAL_FORMS': n_layers, 'form-INITIAL_FORMS': 0,
+                 'form-MIN_NUM_FORMS': 0, 'form-MAX_NUM_FORMS': 1000}
+    for i in range(n_layers):
+        layer = {'id': '', 'layer_number': i + 1, 'name': 'layer%d' % (i + 1),
+                 'thickness': 50.0, 'thickness_min': 10.0, 'thickness_max': 100.0,
+                 'sld': 2.0 + 0.01 * i, 'sld_min': 1.0, 'sld_max': 4.0,
+                 'i_sld': 0.0, 'i_sld_min': 0.0, 'i_sld_max': 1.0, 'i_sld_is_fixed': 'on',
+                 'roughness': 3.0, 'roughness_min': 1.0, 'roughness_max': 10.0}
+        form_data.update(dict(('form-%d-%s' % (i, key), value) for key, value in layer.items()))
+    return form_data
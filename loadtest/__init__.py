@@ -0,0 +1,4 @@
+"""
+    Load testing harness: local stand-ins for the services the application
+    depends on, and a load generator driving user sessions.
+"""
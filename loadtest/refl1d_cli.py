@@ -0,0 +1,69 @@
+#pylint: disable=bare-except, invalid-name
+"""
+    Stand-in for refl1d_cli.py, used by the stand-in compute host.
+    It takes the time of a fit, then stores the model as it was given,
+    with the same output files as refl1d.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import time
+import argparse
+import StringIO
+
+def write_results(model_path, store, engine):
+    """
+        Load a model and write the files refl1d stores at the end of a fit
+        :param str model_path: path of the model script
+        :param str store: output directory
+        :param str engine: fitting engine
+    """
+    from bumps.fitproblem import load_problem
+    problem = load_problem(model_path)
+    basename = os.path.join(store, '__model')
+    problem.save(basename)
+
+    labels = problem.labels()
+    values = problem.getp()
+    with open(basename + '.par', 'w') as par_file:
+        for label, value in zip(labels, values):
+            par_file.write("%s %.15g\n" % (label, value))
+
+    summary = StringIO.StringIO()
+    stdout, sys.stdout = sys.stdout, summary
+    try:
+        problem.show()
+    finally:
+        sys.stdout = stdout
+    with open(basename + '.err', 'w') as err_file:
+        err_file.write(summary.getvalue())
+        if engine == 'dream':
+            err_file.write("              Parameter       mean  median    best [   68% interval] [   95% interval]\n")
+            for i, (label, value) in enumerate(zip(labels, values)):
+                error = 0.01 * abs(value) + 1e-6
+                err_file.write("%2d %20s %.4f(35) %.4f %.4f [%.4f %.4f] [%.4f %.4f]\n"
+                               % (i + 1, label, value, value, value, value - error, value + error,
+                                  value - 2 * error, value + 2 * error))
+
+def main():
+    """ Process the refl1d command line """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model')
+    parser.add_argument('--fit', default='lm')
+    parser.add_argument('--store', required=True)
+    options, _ = parser.parse_known_args()
+
+    time.sleep(float(os.environ.get('LOADTEST_FIT_TIME', '0')))
+    if not os.path.isdir(options.store):
+        os.makedirs(options.store)
+    try:
+        write_results(options.model, options.store, options.fit)
+    except:
+        print("Could not process %s: %s" % (options.model, sys.exc_value), file=sys.stderr)
+        with open(os.path.join(options.store, '__model.err'), 'w') as err_file:
+            err_file.write("[chisq=1.000(10), nllf=100]\n")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,308 @@
+#pylint: disable=bare-except, invalid-name, too-many-arguments, too-many-instance-attributes
+"""
+    Load generator driving user sessions against the application.
+    Each virtual user logs in, uploads two data sets, and then repeatedly
+    browses its files, opens and evaluates a fit, submits a fit, submits
+    a co-refinement of its two data sets, and looks at an instrument run.
+    The throughput and latency of each step are reported at the end.
+
+    The application and its celery worker should run with loadtest.settings,
+    and the stand-ins of loadtest.stand_ins should be started first:
+
+        python -m loadtest.sessions --create-users --users 10 --duration 300
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import re
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+import collections
+
+import numpy as np
+import requests
+
+from benchmarks.synthetic import data_file_content, fit_form_data
+
+## Steps of a session, in the order they are reported
+STEPS = ['login', 'upload', 'browse files', 'open fit', 'plots', 'evaluate',
+         'submit fit', 'fit job', 'co-refine', 'co-refinement job', 'run page']
+## Steps timing a job from its submission to its completion
+JOB_STEPS = ['fit job', 'co-refinement job']
+
+class Stats(object):
+    """
+        Durations and errors of the steps of all sessions
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = collections.defaultdict(list)
+        self.errors = collections.defaultdict(int)
+
+    def record(self, step, duration, success=True):
+        """
+            Record a step
+            :param str step: name of the step
+            :param float duration: duration of the step, in seconds
+            :param bool success: whether the step succeeded
+        """
+        with self._lock:
+            self.durations[step].append(duration)
+            if not success:
+                self.errors[step] += 1
+
+    def summary(self, elapsed):
+        """
+            Return the count, errors, throughput and latency percentiles of each step
+            :param float elapsed: duration of the test, in seconds
+        """
+        summary = collections.OrderedDict()
+        with self._lock:
+            for step in STEPS:
+                durations = self.durations.get(step, [])
+                if not durations:
+                    continue
+                p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+                summary[step] = dict(count=len(durations), errors=self.errors.get(step, 0),
+                                     throughput=len(durations) / elapsed,
+                                     p50=p50, p90=p90, p99=p99, max=max(durations))
+        return summary
+
+def print_summary(summary, elapsed, n_users):
+    """ Print the summary of a test as a table """
+    print("\n%d users for %.0f s\n" % (n_users, elapsed))
+    print("%-18s %7s %7s %8s %8s %8s %8s %8s" % ('step', 'count', 'errors', 'per sec',
+                                                 'p50 (s)', 'p90 (s)', 'p99 (s)', 'max (s)'))
+    for step, item in summary.items():
+        print("%-18s %7d %7d %8.2f %8.3f %8.3f %8.3f %8.3f" % (step, item['count'], item['errors'], item['throughput'],
+                                                               item['p50'], item['p90'], item['p99'], item['max']))
+    requests_done = sum([item['count'] for step, item in summary.items() if step not in JOB_STEPS])
+    errors = sum([item['errors'] for step, item in summary.items() if step not in JOB_STEPS])
+    print("\n%d requests, %.2f per sec, %d errors" % (requests_done, requests_done / elapsed, errors))
+
+class Session(object):
+    """
+        Session of a virtual user
+    """
+    def __init__(self, options, username, stats, stop_time):
+        """
+            :param Namespace options: command line options
+            :param str username: user name
+            :param Stats stats: statistics to record the steps into
+            :param float stop_time: time at which the session stops
+        """
+        self.options = options
+        self.url = options.url.rstrip('/')
+        self.username = username
+        self.stats = stats
+        self.stop_time = stop_time
+        self.http = requests.Session()
+        self.data_ids = []
+        self.random = random.Random(username)
+
+    def _request(self, step, method, path, check=None, **kwargs):
+        """
+            Send a request and record its duration.
+            Return the response, or None if the request failed.
+
+            :param str step: name of the step
+            :param str method: HTTP method
+            :param str path: path of the URL
+            :param callable check: function returning True if the response is valid
+        """
+        if method == 'POST':
+            kwargs.setdefault('data', {})['csrfmiddlewaretoken'] = self.http.cookies.get('csrftoken', '')
+            kwargs.setdefault('headers', {})['Referer'] = self.url + path
+        t_0 = time.time()
+        try:
+            response = self.http.request(method, self.url + path, timeout=self.options.timeout, **kwargs)
+            success = response.status_code < 400 and (check is None or check(response))
+        except requests.RequestException:
+            logging.debug("%s %s failed: %s", method, path, sys.exc_value)
+            response, success = None, False
+        self.stats.record(step, time.time() - t_0, success)
+        return response if success else None
+
+    def _think(self):
+        """ Wait between steps, like a user reading the page """
+        time.sleep(self.random.uniform(0.5, 1.5) * self.options.think_time)
+
+    def _fit_url(self, data_id, action=''):
+        """ Return the URL of the fit page of a data set """
+        return '/fit/%s/%s/%s' % (self.username, data_id, action)
+
+    def _wait_for_job(self, step, page, t_submit):
+        """
+            Poll the status of the job submitted from a page until it completes,
+            and record the time from its submission to its completion.
+            A successful submission redirects to a page polling the job status,
+            which isn't there if the job completed before the page was shown.
+
+            :param str step: name of the step
+            :param Response page: page returned after submitting the job
+            :param float t_submit: time at which the job was submitted
+        """
+        if page is None:
+            self.stats.record(step, 0, False)
+            return
+        result = re.search(r'url: "/fit/(\d+)/"', page.text)
+        if result is None:
+            self.stats.record(step, time.time() - t_submit, len(page.history) > 0)
+            return
+        status = None
+        while time.time() - t_submit < self.options.job_timeout:
+            time.sleep(self.options.poll_interval)
+            try:
+                response = self.http.get('%s/fit/%s/' % (self.url, result.group(1)), timeout=self.options.timeout)
+                job = response.json()
+                status = job['status']
+                if job['completed']:
+                    break
+            except:
+                logging.debug("Could not poll job %s: %s", result.group(1), sys.exc_value)
+        self.stats.record(step, time.time() - t_submit, status == 'success')
+
+    def login(self):
+        """ Log in and return True if successful """
+        self._request('login', 'GET', '/users/login')
+        response = self._request('login', 'POST', '/users/login',
+                                 data=dict(username=self.username, password=self.options.password),
+                                 check=lambda response: '/users/login' not in response.url)
+        return response is not None
+
+    def prepare(self):
+        """
+            Upload two data sets, save a model for each of them, and make
+            the second data set part of the co-refinement of the first one.
+            Return True if the session has data to work with.
+        """
+        files = [('file', ('loadtest_%d.txt' % i, data_file_content(self.options.points, seed=i)))
+                 for i in range(2)]
+        self._request('upload', 'POST', '/fit/files/', files=files)
+        response = self._request('browse files', 'GET', '/fit/files/')
+        if response is None:
+            return False
+        for data_id in re.findall(r'/fit/%s/(\d+)/' % re.escape(self.username), response.text):
+            if data_id not in self.data_ids:
+                self.data_ids.append(data_id)
+        if len(self.data_ids) < 2:
+            logging.error("%s could not upload data", self.username)
+            return False
+        self.data_ids = self.data_ids[:2]
+        for data_id in self.data_ids:
+            self._request('evaluate', 'POST', self._fit_url(data_id),
+                          data=fit_form_data('%s/%s' % (self.username, data_id), self.options.layers))
+        dependent_data = '%s/%s' % (self.username, self.data_ids[1])
+        response = self._request('open fit', 'GET', self._fit_url(self.data_ids[0]))
+        if response is not None and '/fit/%s' % dependent_data not in response.text:
+            self._request('co-refine', 'POST', self._fit_url(self.data_ids[0], 'append/'),
+                          data=dict(dependent_data=dependent_data))
+        return True
+
+    def run_once(self):
+        """ Go through the steps of a session once """
+        data_id = self.data_ids[0]
+        data_path = '%s/%s' % (self.username, data_id)
+        self._request('browse files', 'GET', '/fit/files/')
+        self._think()
+        self._request('open fit', 'GET', self._fit_url(data_id))
+        self._request('plots', 'GET', self._fit_url(data_id, 'plots/'))
+        self._think()
+        self._request('evaluate', 'POST', self._fit_url(data_id),
+                      data=fit_form_data(data_path, self.options.layers, 'evaluate'))
+        self._request('plots', 'GET', self._fit_url(data_id, 'plots/'))
+        self._think()
+        t_submit = time.time()
+        page = self._request('submit fit', 'POST', self._fit_url(data_id),
+                             data=fit_form_data(data_path, self.options.layers, 'fit'))
+        self._wait_for_job('fit job', page, t_submit)
+        self._request('open fit', 'GET', self._fit_url(data_id))
+        self._request('plots', 'GET', self._fit_url(data_id, 'plots/'))
+        self._think()
+        t_submit = time.time()
+        page = self._request('co-refine', 'POST', self._fit_url(data_id, 'simultaneous/'))
+        self._wait_for_job('co-refinement job', page, t_submit)
+        self._request('co-refine', 'GET', self._fit_url(data_id, 'simultaneous/'))
+        self._think()
+        run_number = self.random.randint(1, self.options.runs)
+        self._request('run page', 'GET', '/fit/%s/%s/' % (self.options.instrument, run_number))
+        self._think()
+
+    def run(self):
+        """ Run the session until its stop time """
+        try:
+            if not self.login() or not self.prepare():
+                return
+            while time.time() < self.stop_time:
+                self.run_once()
+        except:
+            logging.error("Session of %s stopped: %s", self.username, sys.exc_value)
+
+def create_users(usernames, password):
+    """
+        Create the users of the test in the database of the application
+        :param list usernames: list of user names
+        :param str password: password of the users
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'loadtest.settings')
+    import django
+    django.setup()
+    from django.contrib.auth.models import User
+    for username in usernames:
+        user, _ = User.objects.get_or_create(username=username)
+        user.set_password(password)
+        user.save()
+
+def main():
+    """ Run the sessions and report the results """
+    parser = argparse.ArgumentParser(description="Drive user sessions against the application")
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help="URL of the application")
+    parser.add_argument('--users', type=int, default=5, help="number of concurrent users")
+    parser.add_argument('--duration', type=float, default=300, help="duration of the test, in seconds")
+    parser.add_argument('--ramp-up', type=float, default=10, help="time over which the users start, in seconds")
+    parser.add_argument('--think-time', type=float, default=1.0, help="average time between steps, in seconds")
+    parser.add_argument('--poll-interval', type=float, default=2.0, help="time between job status requests, in seconds")
+    parser.add_argument('--job-timeout', type=float, default=600, help="time after which a job is counted as failed")
+    parser.add_argument('--timeout', type=float, default=60, help="request timeout, in seconds")
+    parser.add_argument('--user-prefix', default='loadtest', help="prefix of the user names")
+    parser.add_argument('--password', default='loadtest-password', help="password of the users")
+    parser.add_argument('--create-users', action='store_true', help="create the users in the database first")
+    parser.add_argument('--layers', type=int, default=2, help="number of layers of the models")
+    parser.add_argument('--points', type=int, default=200, help="number of points of the uploaded data sets")
+    parser.add_argument('--instrument', default='REF_L', help="instrument of the runs to look at")
+    parser.add_argument('--runs', type=int, default=100, help="number of distinct runs to look at")
+    parser.add_argument('--json', default=None, help="file to write the results to, as JSON")
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    usernames = ['%s%d' % (options.user_prefix, i + 1) for i in range(options.users)]
+    if options.create_users:
+        create_users(usernames, options.password)
+
+    stats = Stats()
+    t_0 = time.time()
+    stop_time = t_0 + options.duration
+    threads = []
+    for i, username in enumerate(usernames):
+        session = Session(options, username, stats, stop_time)
+        thread = threading.Timer(options.ramp_up * i / max(1, options.users), session.run)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # Sessions finish their current pass once the stop time is reached
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - t_0
+
+    summary = stats.summary(elapsed)
+    print_summary(summary, elapsed, options.users)
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(dict(users=options.users, duration=elapsed, steps=summary), json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#pylint: disable=wildcard-import, unused-wildcard-import, invalid-name
+"""
+    Django settings pointing the application to the local stand-ins of
+    loadtest.stand_ins. Run the web server and the celery worker with:
+
+        DJANGO_SETTINGS_MODULE=loadtest.settings
+
+    The LOADTEST_* environment variables override the defaults below.
+"""
+from __future__ import absolute_import
+import os
+import sys
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(_REPO_DIR, 'web_reflectivity'))
+
+from web_reflectivity.settings import *
+from loadtest import stand_ins
+
+_STAND_IN_HOST = os.environ.get('LOADTEST_HOST', '127.0.0.1')
+
+# Data is kept on the stand-in data server
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app != 'datahandler']
+LIVE_DATA_SERVER_DOMAIN = _STAND_IN_HOST
+LIVE_DATA_SERVER_PORT = int(os.environ.get('LOADTEST_DATA_PORT', stand_ins.DATA_PORT))
+LIVE_DATA_SERVER_HTTPS = False
+LIVE_DATA_SERVER = '/plots/$instrument/$run_number/update'
+LIVE_DATA_USER_UPLOAD_URL = 'http://$domain:$port/plots/$user/upload_user_data/'
+LIVE_DATA_USER_FILES_URL = 'http://$domain:$port/plots/$user/json/'
+LIVE_DATA_API_USER = 'loadtest'
+LIVE_DATA_API_PWD = 'loadtest'
+
+# Run information comes from the stand-in ICAT catalog
+ICAT_DOMAIN = _STAND_IN_HOST
+ICAT_PORT = int(os.environ.get('LOADTEST_CATALOG_PORT', stand_ins.CATALOG_PORT))
+HIDE_RUN_DETAILS = False
+
+# Jobs run on the stand-in compute host, with the refl1d stand-in
+JOB_HANDLING_HOST = _STAND_IN_HOST
+JOB_HANDLING_PORT = int(os.environ.get('LOADTEST_SSH_PORT', stand_ins.SSH_PORT))
+JOB_HANDLING_INTERPRETER = sys.executable
+REFL1D_JOB_DIR = os.environ.get('LOADTEST_JOB_DIR', stand_ins.JOB_DIR)
+REFL1D_PATH = os.path.join(REFL1D_JOB_DIR, 'bin')
+
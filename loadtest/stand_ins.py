@@ -0,0 +1,630 @@
+#pylint: disable=bare-except, invalid-name, too-many-arguments, too-many-instance-attributes, no-self-use, unused-argument
+"""
+    Local stand-ins for the services the application uses in production:
+    the live data server, the ICAT catalog and the SSH compute host.
+    Each one can add latency to its responses and fail a fraction of its requests.
+
+    Start them from the top of the repository with:
+
+        python -m loadtest.stand_ins --latency 0.05 --error-rate 0.01
+
+    then run the application with the loadtest.settings settings module.
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import re
+import cgi
+import json
+import hmac
+import time
+import errno
+import shlex
+import random
+import socket
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+
+import paramiko
+
+from benchmarks.synthetic import reflectivity_data, plot_div
+
+DATA_PORT = 8001
+CATALOG_PORT = 8002
+SSH_PORT = 2222
+## Directory where the compute host runs jobs
+JOB_DIR = os.path.join(tempfile.gettempdir(), 'web_reflectivity_loadtest')
+## Script taking the place of refl1d_cli.py on the compute host
+REFL1D_CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'refl1d_cli.py')
+## Time given to the SSH transport to acknowledge an exec request before we reply to it
+EXEC_START_DELAY = 0.05
+
+def is_loopback(host):
+    """
+        Return True if an address can only be reached from this machine
+        :param str host: host name or address
+    """
+    try:
+        return socket.gethostbyname(host).startswith('127.')
+    except socket.error:
+        return False
+
+class Faults(object):
+    """
+        Latency and errors injected by a stand-in service
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        """
+            :param float latency: time added to each response, in seconds
+            :param float jitter: maximum random time added to the latency, in seconds
+            :param float error_rate: fraction of the requests that fail
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def delay(self):
+        """ Wait for the latency of the service """
+        duration = self.latency + random.uniform(0, self.jitter)
+        if duration > 0:
+            time.sleep(duration)
+
+    def fail(self):
+        """ Return True if the current request should fail """
+        return random.random() < self.error_rate
+
+    def __str__(self):
+        return "latency %gs + %gs jitter, %g%% errors" % (self.latency, self.jitter, 100.0 * self.error_rate)
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server handling each request in its own thread """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Request handler passing requests to the get() and post() methods of
+        a stand-in service, after the latency and errors of the service
+    """
+    def _respond(self, method):
+        """ Process a request with the given method of the service """
+        service = self.server.service
+        service.faults.delay()
+        if service.faults.fail():
+            status, body, content_type = 503, "Failure injected by the stand-in\n", 'text/plain'
+        else:
+            try:
+                status, body, content_type = getattr(service, method)(self)
+            except:
+                logging.error("Stand-in could not process %s: %s", self.path, sys.exc_value)
+                status, body, content_type = 500, "Stand-in error\n", 'text/plain'
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """ Process a GET request """
+        self._respond('get')
+
+    def do_POST(self):
+        """ Process a POST request """
+        self._respond('post')
+
+    def read_form(self):
+        """ Return the form posted with the request """
+        return cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST',
+                                         'CONTENT_TYPE': self.headers.get('Content-Type', ''),
+                                         'CONTENT_LENGTH': self.headers.get('Content-Length', '0')})
+
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        """ Log requests at the debug level """
+        logging.debug("%s %s", self.address_string(), format % args)
+
+class HTTPStandIn(object):
+    """
+        Base class for the stand-ins of HTTP services
+    """
+    name = 'HTTP service'
+
+    def __init__(self, port, faults=None, host='127.0.0.1'):
+        """
+            :param int port: port to listen to
+            :param Faults faults: latency and errors to inject
+            :param str host: address to listen to
+        """
+        self.faults = faults or Faults()
+        self.server = _ThreadedHTTPServer((host, port), _StandInHandler)
+        self.server.service = self
+
+    @property
+    def port(self):
+        """ Port the service listens to """
+        return self.server.server_address[1]
+
+    def start(self):
+        """ Serve requests in a background thread """
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """ Stop serving requests """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, request):
+        """
+            Process a GET request and return the status, body and content type of the response
+            :param BaseHTTPRequestHandler request: request handler
+        """
+        return 404, "Not found\n", 'text/plain'
+
+    def post(self, request):
+        """
+            Process a POST request and return the status, body and content type of the response
+            :param BaseHTTPRequestHandler request: request handler
+        """
+        return 404, "Not found\n", 'text/plain'
+
+class DataServer(HTTPStandIn):
+    """
+        Stand-in for the live data server. It keeps the data uploaded by users
+        in memory, and serves synthetic data for instrument runs.
+    """
+    name = 'Data server'
+
+    def __init__(self, port=DATA_PORT, faults=None, host='127.0.0.1', n_points=500):
+        """
+            :param int n_points: number of points of the instrument runs
+        """
+        super(DataServer, self).__init__(port, faults, host)
+        self.n_points = n_points
+        self._lock = threading.Lock()
+        self._user_data = {}
+        self._runs = {}
+        self._next_id = 1
+
+    def get(self, request):
+        """ Return the plot of an instrument run, or of a data set uploaded by a user """
+        result = re.match(r'^/plots/([^/]+)/(\d+)/update/html/', request.path)
+        if result is None:
+            return super(DataServer, self).get(request)
+        instrument, run_number = result.group(1), int(result.group(2))
+        with self._lock:
+            for entry in self._user_data.get(instrument, []):
+                if entry['run_number'] == run_number:
+                    return 200, entry['plot'], 'text/html'
+            plot = self._runs.get((instrument, run_number))
+        if plot is None:
+            # Each run has its own fringes
+            data = reflectivity_data(self.n_points, seed=run_number,
+                                     thickness=50.0 + 100.0 * random.Random(run_number).random())
+            plot = plot_div(*data, title="%s_%s" % (instrument, run_number))
+            with self._lock:
+                self._runs[(instrument, run_number)] = plot
+        return 200, plot, 'text/html'
+
+    def post(self, request):
+        """ Store a user's data set, or list the data sets of a user """
+        result = re.match(r'^/plots/([^/]+)/(upload_user_data|json)/$', request.path)
+        if result is None:
+            return super(DataServer, self).post(request)
+        user, action = result.groups()
+        form = request.read_form()
+        if action == 'json':
+            with self._lock:
+                entries = [dict(run_number=entry['run_number'], run_id=entry['run_id'], timestamp=entry['timestamp'])
+                           for entry in self._user_data.get(user, [])]
+            return 200, json.dumps(entries), 'application/json'
+
+        data_id = form.getfirst('data_id')
+        plot = form.getfirst('file')
+        if not data_id or not plot:
+            return 400, "Missing data\n", 'text/plain'
+        timestamp = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        with self._lock:
+            entries = self._user_data.setdefault(user, [])
+            for entry in entries:
+                if entry['run_id'] == data_id:
+                    entry.update(dict(plot=plot, timestamp=timestamp))
+                    break
+            else:
+                entries.append(dict(run_number=self._next_id, run_id=data_id, timestamp=timestamp, plot=plot))
+                self._next_id += 1
+        return 200, "OK\n", 'text/plain'
+
+class CatalogServer(HTTPStandIn):
+    """
+        Stand-in for the ICAT catalog, which returns a title and a proposal for each run
+    """
+    name = 'ICAT catalog'
+
+    def __init__(self, port=CATALOG_PORT, faults=None, host='127.0.0.1'):
+        super(CatalogServer, self).__init__(port, faults, host)
+
+    def get(self, request):
+        """ Return the metadata of a run """
+        result = re.match(r'^/icat-rest-ws/dataset/(\w+)/(\w+)/(\d+)/lite', request.path)
+        if result is None:
+            return super(CatalogServer, self).get(request)
+        _, instrument, run_number = result.groups()
+        metadata = ('<?xml version="1.0" encoding="UTF-8"?><dataset><metadata>'
+                    '<title>%s run %s</title><proposal>IPTS-%d</proposal>'
+                    '</metadata></dataset>') % (instrument, run_number, 1000 + int(run_number) // 100)
+        return 200, metadata, 'application/xml'
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    """
+        SFTP access to the job directory of the stand-in compute host
+    """
+    def __init__(self, server, *args, **kwargs):
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.host = server.host
+
+    def _path(self, path, write=False):
+        """
+            Return the local path of a file, which has to be in the job directory.
+            The refl1d stand-in can't be changed.
+        """
+        path = os.path.realpath(path)
+        if not self.host.in_job_dir(path) or (write and self.host.in_bin_dir(path)):
+            raise OSError(errno.EACCES, "Outside of the job directory")
+        return path
+
+    def list_folder(self, path):
+        """ List a directory """
+        try:
+            path = self._path(path)
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+                    for name in os.listdir(path)]
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def stat(self, path):
+        """ Return the attributes of a file """
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        """ Open a file """
+        try:
+            path = self._path(path, write=flags & (os.O_WRONLY | os.O_RDWR) != 0)
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+            if flags & os.O_WRONLY:
+                mode = 'ab' if flags & os.O_APPEND else 'wb'
+            elif flags & os.O_RDWR:
+                mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+            else:
+                mode = 'rb'
+            local_file = os.fdopen(fd, mode)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        handle = paramiko.SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = local_file
+        handle.writefile = local_file
+        return handle
+
+    def mkdir(self, path, attr):
+        """ Create a directory """
+        try:
+            os.mkdir(self._path(path, write=True))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        """ Remove a file """
+        try:
+            os.remove(self._path(path, write=True))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+class _SSHServer(paramiko.ServerInterface):
+    """
+        SSH server checking the shared password of the compute host, if it has one,
+        and the keys deployed by its users. It passes commands to the compute host.
+    """
+    def __init__(self, host):
+        self.host = host
+        ## User who logged in with the password, and may deploy a key
+        self.password_user = None
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        if self.host.password is not None and not hmac.compare_digest(password, self.host.password):
+            return paramiko.AUTH_FAILED
+        self.password_user = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        if self.host.is_authorized(username, key.get_base64()):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.host.execute, args=(channel, command, self.password_user))
+        thread.daemon = True
+        thread.start()
+        return True
+
+class ComputeHost(object):
+    """
+        Stand-in for the SSH compute host. Files are transferred with SFTP
+        to and from its job directory, and the job scripts are run there,
+        with the refl1d stand-in. Latency is added when connecting, and
+        the given fraction of the jobs fail.
+
+        Users log in with the shared password, which any password matches if none is
+        given, then with the key they deploy. A password is required to listen to an
+        address other than the loopback. Only python scripts of the job directory are run.
+    """
+    name = 'Compute host'
+
+    def __init__(self, port=SSH_PORT, faults=None, host='127.0.0.1', job_dir=JOB_DIR, fit_time=10.0,
+                 password=None):
+        """
+            :param int port: port to listen to
+            :param Faults faults: latency and errors to inject
+            :param str host: address to listen to
+            :param str job_dir: directory where jobs are run
+            :param float fit_time: time taken by the refl1d stand-in, in seconds
+            :param str password: password shared by the users
+        """
+        if password is None and not is_loopback(host):
+            raise ValueError("The compute host needs a password to listen to %s" % host)
+        self.password = password
+        self._keys = set()
+        self._keys_lock = threading.Lock()
+        self.faults = faults or Faults()
+        if not os.path.isdir(job_dir):
+            os.makedirs(job_dir)
+        self.job_dir = os.path.realpath(job_dir)
+        self.install_refl1d()
+        self.fit_time = fit_time
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(128)
+        self._running = False
+
+    @property
+    def port(self):
+        """ Port the service listens to """
+        return self.socket.getsockname()[1]
+
+    def in_job_dir(self, path):
+        """ Return True if a real path is in the job directory """
+        return path == self.job_dir or path.startswith(self.job_dir + os.sep)
+
+    def in_bin_dir(self, path):
+        """ Return True if a real path is in the directory of the refl1d stand-in """
+        bin_dir = os.path.join(self.job_dir, 'bin')
+        return path == bin_dir or path.startswith(bin_dir + os.sep)
+
+    def is_authorized(self, username, key):
+        """
+            Return True if a user deployed a public key
+            :param str username: user name
+            :param str key: public key, base64-encoded
+        """
+        with self._keys_lock:
+            return (username, key) in self._keys
+
+    def deploy_key(self, username, command):
+        """
+            Authorize the public key added to authorized_keys by a command,
+            as sent by django_remote_submission when users log in
+            :param str username: user who logged in with the password
+            :param str command: shell command
+        """
+        result = re.search(r'^KEY=(.+)$', command, re.MULTILINE)
+        if result is None:
+            return
+        fields = shlex.split(result.group(1))[0].split()
+        if len(fields) >= 2:
+            with self._keys_lock:
+                self._keys.add((username, fields[1]))
+
+    def install_refl1d(self):
+        """
+            Install the refl1d stand-in in the bin directory of the job directory,
+            which is the REFL1D_PATH of the application. Job scripts replace the
+            PATH with REFL1D_PATH, so it runs with the same python as this host.
+        """
+        bin_dir = os.path.join(self.job_dir, 'bin')
+        if not os.path.isdir(bin_dir):
+            os.makedirs(bin_dir)
+        script = os.path.join(bin_dir, 'refl1d_cli.py')
+        with open(script, 'w') as script_file:
+            script_file.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, REFL1D_CLI))
+        os.chmod(script, 0o755)
+
+    def start(self):
+        """ Accept connections in a background thread """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """ Stop accepting connections """
+        self._running = False
+        self.socket.close()
+
+    def serve_forever(self):
+        """ Accept connections until the host is stopped """
+        self._running = True
+        while self._running:
+            try:
+                client, _ = self.socket.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self._connect, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _connect(self, client):
+        """ Start an SSH session on a new connection """
+        self.faults.delay()
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _SFTPServer)
+        try:
+            transport.start_server(server=_SSHServer(self))
+        except:
+            logging.error("Could not start an SSH session: %s", sys.exc_value)
+            transport.close()
+
+    def _parse(self, command):
+        """
+            Return the working directory and the arguments of a job command,
+            of the form "cd [directory] && [interpreter] [script]",
+            or None if the command isn't a job in the job directory.
+            The interpreter has to be the python running this host, and the script
+            a python file of the job directory.
+        """
+        if ' && ' not in command:
+            return None
+        chdir, run = command.split(' && ', 1)
+        chdir = shlex.split(chdir)
+        if len(chdir) != 2 or chdir[0] != 'cd':
+            return None
+        workdir = os.path.realpath(chdir[1])
+        if not self.in_job_dir(workdir):
+            return None
+        args = shlex.split(run)
+        # Jobs submitted with a time limit
+        if len(args) == 4 and args[0] == 'timeout':
+            args = args[2:]
+        if len(args) != 2 or os.path.realpath(args[0]) != os.path.realpath(sys.executable):
+            return None
+        script = os.path.realpath(os.path.join(workdir, args[1]))
+        if not script.endswith('.py') or not os.path.isfile(script) \
+            or not self.in_job_dir(script) or self.in_bin_dir(script):
+            return None
+        return workdir, [sys.executable, script]
+
+    def execute(self, channel, command, password_user=None):
+        """
+            Run a job and send its output over the SSH channel.
+            Other commands, like the SSH key management done when users log in,
+            are acknowledged without being run.
+            :param Channel channel: SSH channel
+            :param str command: shell command
+            :param str password_user: user who logged in with the password, if any
+        """
+        time.sleep(EXEC_START_DELAY)
+        status = 0
+        try:
+            if password_user is not None:
+                self.deploy_key(password_user, command)
+            job = self._parse(command)
+            if job is not None:
+                if self.faults.fail():
+                    channel.sendall_stderr("Failure injected by the stand-in compute host\n")
+                    status = 1
+                else:
+                    status = self._run(channel, *job)
+        except:
+            logging.error("Could not run %s: %s", command, sys.exc_value)
+            status = 1
+        channel.send_exit_status(status)
+        channel.close()
+
+    def _run(self, channel, workdir, args):
+        """ Run a job script, with the refl1d stand-in, and return its exit status """
+        env = dict(os.environ, LOADTEST_FIT_TIME=str(self.fit_time))
+        process = subprocess.Popen(args, cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def _forward(pipe, send):
+            """ Send the output of the job as it comes """
+            while True:
+                data = os.read(pipe.fileno(), 4096)
+                if not data:
+                    break
+                send(data)
+        threads = [threading.Thread(target=_forward, args=(process.stdout, channel.sendall)),
+                   threading.Thread(target=_forward, args=(process.stderr, channel.sendall_stderr))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return process.wait()
+
+def main():
+    """ Start the stand-ins and wait until interrupted """
+    parser = argparse.ArgumentParser(description="Local stand-ins for the data server, the catalog and the compute host")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen to")
+    parser.add_argument('--data-port', type=int, default=DATA_PORT)
+    parser.add_argument('--catalog-port', type=int, default=CATALOG_PORT)
+    parser.add_argument('--ssh-port', type=int, default=SSH_PORT)
+    parser.add_argument('--latency', type=float, default=0.0, help="time added to each response, in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="maximum random time added to the latency, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of the requests that fail")
+    for service in ['data', 'catalog', 'ssh']:
+        parser.add_argument('--%s-latency' % service, type=float, default=None, help="overrides --latency")
+        parser.add_argument('--%s-jitter' % service, type=float, default=None, help="overrides --jitter")
+        parser.add_argument('--%s-error-rate' % service, type=float, default=None, help="overrides --error-rate")
+    parser.add_argument('--points', type=int, default=500, help="number of points of the instrument runs")
+    parser.add_argument('--fit-time', type=float, default=10.0, help="time taken by each fit, in seconds")
+    parser.add_argument('--job-dir', default=JOB_DIR, help="directory where jobs are run")
+    parser.add_argument('--ssh-password', default=None,
+                        help="password of the compute host users, required unless --host is a loopback address")
+    parser.add_argument('--verbose', action='store_true', help="log every request")
+    options = parser.parse_args()
+    if options.ssh_password is None and not is_loopback(options.host):
+        parser.error("--ssh-password is required to listen to %s" % options.host)
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    def _faults(service):
+        """ Return the faults of a service """
+        values = [getattr(options, '%s_%s' % (service, name)) for name in ['latency', 'jitter', 'error_rate']]
+        defaults = [options.latency, options.jitter, options.error_rate]
+        return Faults(*[default if value is None else value for value, default in zip(values, defaults)])
+
+    services = [DataServer(options.data_port, _faults('data'), options.host, n_points=options.points),
+                CatalogServer(options.catalog_port, _faults('catalog'), options.host),
+                ComputeHost(options.ssh_port, _faults('ssh'), options.host, job_dir=options.job_dir,
+                            fit_time=options.fit_time, password=options.ssh_password)]
+    for service in services:
+        service.start()
+        logging.info("%s on %s:%s (%s)", service.name, options.host, service.port, service.faults)
+    logging.info("Jobs run in %s", os.path.realpath(options.job_dir))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for service in services:
+        service.stop()
+
+if __name__ == '__main__':
+    main()
@@ -5,4 +5,6 @@ from __future__ import absolute_import, unicode_literals
 from .celery import app as celery_app
 
 
-__all__ = ['celery_app']
\ No newline at end of file
+__all__ = ['celery_app']
+
+default_app_config = 'fitting.apps.FittingConfig'
\ No newline at end of file
@@ -2,13 +2,20 @@
 """
     Admin views for models
 """
+from django.conf.urls import url
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.html import format_html, format_html_join
 from fitting.models import ReflectivityModel, FitProblem, ReflectivityLayer, FitterOptions, Constraint, CatalogCache
-from fitting.models import SavedModelInfo, UserData, SimultaneousModel, SimultaneousConstraint, SimultaneousFit
+from fitting.models import SavedModelInfo, UserData, SimultaneousModel, SimultaneousConstraint, SimultaneousFit, JobTelemetry
+from fitting.models import RequestProfile
 
 class FitProblemAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'reflectivity_model', 'show_layers', 'remote_job', 'timestamp')
-    list_filter = ('user', 'reflectivity_model__data_path')
+    list_filter = ('user', 'data_path')
 
 class ReflectivityModelAdmin(admin.ModelAdmin):
     list_display = ('id', 'data_path', 'scale', 'front_name', 'back_name')
@@ -47,6 +54,65 @@ class SimultaneousFitAdmin(admin.ModelAdmin):
 class CatalogCacheAdmin(admin.ModelAdmin):
     list_display = ('id', 'data_path', 'title', 'proposal', 'timestamp')
 
+class JobTelemetryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'job', 'engine', 'steps', 'burn', 'n_parameters', 'n_points', 'n_models',
+                    'wall_time', 'fit_time', 'steps_per_second', 'host', 'timestamp')
+    list_filter = ('engine', 'host', 'n_models')
+    # The run-time distributions are shown above the list
+    change_list_template = 'admin/fitting/jobtelemetry/change_list.html'
+
+    def changelist_view(self, request, extra_context=None):
+        response = super(JobTelemetryAdmin, self).changelist_view(request, extra_context=extra_context)
+        try:
+            queryset = response.context_data['cl'].queryset
+            response.context_data['runtime_summary'] = JobTelemetry.runtime_summary(queryset)
+        except (AttributeError, KeyError):
+            # Redirects and error pages have no change list
+            pass
+        return response
+
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'method', 'path', 'status', 'total_time', 'python_time',
+                    'n_queries', 'sql_time', 'timestamp', 'download')
+    list_filter = ('user',)
+    fields = ('user', 'method', 'path', 'status', 'total_time', 'python_time', 'n_queries', 'sql_time',
+              'timestamp', 'download', 'sql_statements', 'function_summary')
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        # Profiles are taken by adding ?profile to a URL
+        return False
+
+    def get_urls(self):
+        urls = [url(r'^(?P<pk>\d+)/download/$', self.admin_site.admin_view(self.download_view),
+                    name='fitting_requestprofile_download')]
+        return urls + super(RequestProfileAdmin, self).get_urls()
+
+    def download_view(self, request, pk):
+        """ Return the profile statistics, which can be loaded with pstats """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        response = HttpResponse(bytes(profile.stats), content_type='application/octet-stream')
+        response['Content-Disposition'] = 'attachment; filename=profile_%s.prof' % profile.id
+        return response
+
+    def download(self, obj):
+        return format_html('<a href="{}">profile_{}.prof</a>',
+                           reverse('admin:fitting_requestprofile_download', args=(obj.id,)), obj.id)
+    download.short_description = 'Statistics'
+
+    def sql_statements(self, obj):
+        rows = format_html_join('\n', '<tr><td>{}</td><td>{}</td><td>{}</td></tr>',
+                                ((item['count'], '%.1f' % (1000.0 * item['time']), item['sql'])
+                                 for item in obj.sql_summary()))
+        return format_html('<table><tr><th>Count</th><th>Time (ms)</th><th>Statement</th></tr>{}</table>', rows)
+    sql_statements.short_description = 'SQL statements'
+
+    def function_summary(self, obj):
+        return format_html('<pre>{}</pre>', obj.functions)
+    function_summary.short_description = 'Functions'
+
 admin.site.register(ReflectivityModel, ReflectivityModelAdmin)
 admin.site.register(FitProblem, FitProblemAdmin)
 admin.site.register(ReflectivityLayer, ReflectivityLayerAdmin)
@@ -58,3 +124,5 @@ admin.site.register(SimultaneousModel, SimultaneousModelAdmin)
 admin.site.register(SimultaneousConstraint, SimultaneousConstraintAdmin)
 admin.site.register(SimultaneousFit, SimultaneousFitAdmin)
 admin.site.register(CatalogCache, CatalogCacheAdmin)
+admin.site.register(JobTelemetry, JobTelemetryAdmin)
+admin.site.register(RequestProfile, RequestProfileAdmin)
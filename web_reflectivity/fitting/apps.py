@@ -5,3 +5,7 @@ from django.apps import AppConfig
 
 class FittingConfig(AppConfig):
     name = 'fitting'
+
+    def ready(self):
+        # Connect the receivers that collect the application metrics
+        from . import metrics #pylint: disable=unused-variable
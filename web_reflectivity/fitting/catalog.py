@@ -17,6 +17,7 @@ except:
     HAVE_ONCAT = False
 
 from fitting.models import CatalogCache
+from fitting import timing
 
 def decode_time(timestamp):
     """
@@ -54,6 +55,7 @@ def get_run_info(instrument, run_number):
         facility = settings.FACILITY_INFO.get(instrument, 'SNS')
     return _get_run_info(instrument, run_number, facility)
 
+@timing.timed('catalog')
 def _get_run_info(instrument, run_number, facility='SNS'):
     """
         Get ONCat info for the specified run
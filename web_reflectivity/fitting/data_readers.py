@@ -0,0 +1,224 @@
+#pylint: disable=bare-except, invalid-name, too-many-locals, too-many-branches
+"""
+    Readers for reduced reflectivity data in the ORSO text format and in HDF5 files,
+    such as ORSO binary or Mantid NeXus files.
+    Each reader returns a list of data sets, as (name, q, r, dr, dq) tuples, with Q in 1/A
+    and the Q resolution as a FWHM, as in the data files of the instruments.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import re
+import numpy as np
+
+ORSO_EXTENSIONS = ('.ort',)
+HDF5_EXTENSIONS = ('.orb', '.h5', '.hdf5', '.hdf', '.nxs')
+
+## Factors to convert Q to 1/A. Mantid workspaces give the unit of their axis.
+Q_UNITS = {'1/angstrom': 1.0, '1/a': 1.0, '1/nm': 0.1, 'momentumtransfer': 1.0}
+## Conversion from a standard deviation to a FWHM
+SIGMA_TO_FWHM = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+def _q_unit_factor(unit):
+    """
+        Return the factor to convert Q values in a given unit to 1/A
+        :param str unit: unit of Q, as written in the file
+    """
+    if isinstance(unit, bytes):
+        unit = unit.decode('utf-8')
+    unit = unit.strip().lower().replace(' ', '')
+    unit = re.sub(r"^(angstrom|a|nm)\^-1$", r"1/\1", unit)
+    if unit not in Q_UNITS:
+        raise ValueError("Unknown Q unit: %s" % unit)
+    return Q_UNITS[unit]
+
+
+def _fill_resolution(q, dq):
+    """
+        Use a 3% Q resolution where it is missing
+        :param array q: Q values
+        :param array dq: Q resolution, which may contain NaN
+    """
+    missing = np.isnan(dq)
+    dq[missing] = q[missing] * 0.03
+    return dq
+
+def _parse_lines(lines):
+    """
+        Parse a list of data lines into a 2D array
+        :param list lines: list of whitespace-separated lines
+    """
+    values = np.array(' '.join(lines).split(), dtype=np.float64)
+    return values.reshape(len(lines), -1)
+
+class _OrsoDataSet(object):
+    """
+        Data set being read from an ORSO file.
+        The header options are inherited from the previous data set.
+    """
+    def __init__(self, previous=None):
+        self.name = None
+        self.q_factor = previous.q_factor if previous is not None else 1.0
+        self.dq_factor = previous.dq_factor if previous is not None else SIGMA_TO_FWHM
+        self.chunks = []
+        self.lines = []
+
+    def read_header(self, line):
+        """
+            Look for the options we need in a header line
+            :param str line: header line
+        """
+        data_set = re.match(r"#\s*data_set\s*:\s*(.*)", line)
+        if data_set:
+            self.name = data_set.group(1).strip().strip('"\'')
+        q_column = re.search(r"name\s*:\s*Qz\b.*unit\s*:\s*([^,}\s]+)", line)
+        if q_column:
+            self.q_factor = _q_unit_factor(q_column.group(1))
+        # ORSO resolutions are standard deviations, unless they are declared as FWHM
+        if re.search(r"name\s*:\s*sQz\b", line):
+            self.dq_factor = 1.0 if 'fwhm' in line.lower() else SIGMA_TO_FWHM
+
+    def add_line(self, line, chunk_size):
+        """
+            Add a data line, and parse the pending lines once we have a full chunk
+            :param str line: data line
+            :param int chunk_size: number of lines to parse at once
+        """
+        self.lines.append(line)
+        if len(self.lines) >= chunk_size:
+            self.chunks.append(_parse_lines(self.lines))
+            self.lines = []
+
+    def has_data(self):
+        """ Return True if data lines were read """
+        return len(self.chunks) > 0 or len(self.lines) > 0
+
+    def get_data(self):
+        """ Return the (name, q, r, dr, dq) tuple for this data set """
+        if len(self.lines) > 0:
+            self.chunks.append(_parse_lines(self.lines))
+            self.lines = []
+        data = np.concatenate(self.chunks)
+        q = data[:, 0] * self.q_factor
+        dr = data[:, 2] if data.shape[1] > 2 else np.zeros(len(q))
+        dq = data[:, 3] * self.q_factor * self.dq_factor if data.shape[1] > 3 else np.nan * q
+        return self.name, q, data[:, 1], dr, _fill_resolution(q, dq)
+
+def read_orso_text(data_file, chunk_size=100000):
+    """
+        Read the data sets of an ORSO text file (.ort). A file may hold several
+        data sets, for example for several polarization states, each starting
+        with a new header holding a 'data_set' entry.
+        The data lines are parsed in chunks, so that we don't keep a copy of the whole text.
+
+        :param file data_file: file object to read from
+        :param int chunk_size: number of lines to parse at once
+    """
+    data_sets = []
+    current = _OrsoDataSet()
+    for line in data_file:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        if line.startswith('#'):
+            # A header line after the data starts a new data set
+            if current.has_data():
+                data_sets.append(current.get_data())
+                current = _OrsoDataSet(current)
+            current.read_header(line)
+        else:
+            current.add_line(line, chunk_size)
+    if current.has_data():
+        data_sets.append(current.get_data())
+    if len(data_sets) == 0:
+        raise ValueError("No data found")
+    return data_sets
+
+def _q_factor(dataset):
+    """
+        Return the factor to convert the Q values of a data set to 1/A
+        :param Dataset dataset: h5py data set
+    """
+    for attr in ['units', 'unit']:
+        if attr in dataset.attrs:
+            return _q_unit_factor(dataset.attrs[attr])
+    return 1.0
+
+def _sigma_factor(dataset):
+    """
+        Return the factor to convert the ORSO resolution of a data set to a FWHM.
+        ORSO resolutions are standard deviations, unless their attributes declare a FWHM.
+        :param Dataset dataset: h5py data set
+    """
+    for value in dataset.attrs.values():
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        if 'fwhm' in unicode(value).lower():
+            return 1.0
+    return SIGMA_TO_FWHM
+
+def read_hdf5(file_path, max_size=None):
+    """
+        Read the reflectivity data sets of an HDF5 file.
+        Two layouts are recognized:
+
+          - groups holding Qz, R, sR and sQz arrays, as in ORSO binary files (.orb)
+          - Mantid workspaces, holding values, errors, axis1 and xerrors arrays,
+            where each spectrum is a data set. Their Q resolution is a FWHM.
+
+        :param str file_path: path of the HDF5 file
+        :param int max_size: maximum size of the arrays read, in bytes, since compressed
+                             data sets can be much larger than the file
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise RuntimeError("Reading HDF5 files requires h5py")
+
+    total_size = [0]
+    def _read_array(dataset):
+        """ Read a data set as an array of floats, within the size limit """
+        total_size[0] += dataset.size * 8
+        if max_size is not None and total_size[0] > max_size:
+            raise ValueError("The HDF5 data is too big")
+        return np.asarray(dataset[()], dtype=np.float64)
+
+    data_sets = []
+    with h5py.File(file_path, 'r') as h5_file:
+        groups = [('', h5_file)]
+        def _add_group(name, item):
+            """ Collect the groups of the file """
+            if isinstance(item, h5py.Group):
+                groups.append((name, item))
+        h5_file.visititems(_add_group)
+
+        for name, group in groups:
+            keys = dict((key.lower(), key) for key in group.keys() if isinstance(group[key], h5py.Dataset))
+            if 'qz' in keys and 'r' in keys:
+                q_data = group[keys['qz']]
+                q = _read_array(q_data) * _q_factor(q_data)
+                r = _read_array(group[keys['r']])
+                dr = _read_array(group[keys['sr']]) if 'sr' in keys else np.zeros(len(q))
+                if 'sqz' in keys:
+                    dq = _read_array(group[keys['sqz']]) * _q_factor(q_data) * _sigma_factor(group[keys['sqz']])
+                else:
+                    dq = np.nan * q
+                data_sets.append((name, q, r, dr, _fill_resolution(q, dq)))
+            elif 'values' in keys and 'errors' in keys and 'axis1' in keys:
+                x_data = group[keys['axis1']]
+                x = _read_array(x_data) * _q_factor(x_data)
+                values = np.atleast_2d(_read_array(group[keys['values']]))
+                errors = np.atleast_2d(_read_array(group[keys['errors']]))
+                if 'xerrors' in keys:
+                    x_errors = np.atleast_2d(_read_array(group[keys['xerrors']])) * _q_factor(x_data)
+                else:
+                    x_errors = np.nan * values
+                # Histograms are stored with bin boundaries
+                if len(x) == values.shape[1] + 1:
+                    x = (x[1:] + x[:-1]) / 2.0
+                for i in range(values.shape[0]):
+                    spectrum_name = name if values.shape[0] == 1 else "%s/%s" % (name, i)
+                    data_sets.append((spectrum_name, x, values[i], errors[i], _fill_resolution(x, x_errors[i].copy())))
+    if len(data_sets) == 0:
+        raise ValueError("No reflectivity data found")
+    return data_sets
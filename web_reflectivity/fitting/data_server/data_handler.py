@@ -15,6 +15,7 @@ from django.conf import settings
 from django.utils import dateparse, timezone
 
 from ..models import UserData
+from .. import timing
 
 def generate_key(instrument, run_id):
     """
@@ -47,6 +48,12 @@ def append_key(input_url, instrument, run_id):
     delimiter = '&' if '/?' in input_url else '?'
     return "%s%skey=%s" % (input_url, delimiter, client_key)
 
+def is_local():
+    """
+        Return True if the data is stored locally rather than on a remote data server
+    """
+    return 'datahandler' in settings.INSTALLED_APPS
+
 def store_user_data(request, file_name, plot):
     """
         Store user data
@@ -55,11 +62,59 @@ def store_user_data(request, file_name, plot):
         :param str file_name: name of the uploaded file
         :param str plot: user data, as a plotly json object
     """
-    if 'datahandler' in settings.INSTALLED_APPS:
+    success, error, entry = push_user_data(request, file_name, plot)
+    if success:
+        register_user_data(request, [entry])
+    return success, error
+
+def push_user_data(request, file_name, plot):
+    """
+        Send user data to the data store, without creating its UserData entry.
+        Returns a success flag, an error message, and the file entry to pass to
+        register_user_data().
+
+        :param Request request: Django request object
+        :param str file_name: name of the uploaded file
+        :param str plot: user data, as a plotly json object
+    """
+    if is_local():
         return _local_store(request, file_name, plot)
     else:
         return _remote_store(request, file_name, plot)
 
+def register_user_data(request, entries):
+    """
+        Create the UserData entries for files sent to the data store,
+        with a single bulk insert. Files sent again get the timestamp of their
+        new data, which identifies the version of the data in the plot cache.
+
+        :param Request request: Django request object
+        :param list entries: file entries returned by push_user_data()
+    """
+    if not is_local():
+        # The remote server assigns the file IDs, so we need to ask for them
+        file_names = set([item['file_name'] for item in entries])
+        try:
+            entries = [dict(file_id=item['run_number'], file_name=item['run_id'],
+                            timestamp=dateparse.parse_datetime(item['timestamp']))
+                       for item in _remote_file_list(request) if item['run_id'] in file_names]
+        except:
+            logging.error("Could not retrieve user files: %s", sys.exc_value)
+            return
+
+    file_ids = [str(item['file_id']) for item in entries]
+    existing = dict(UserData.objects.filter(user=request.user, file_id__in=file_ids).values_list('file_id', 'timestamp'))
+    new_entries = {}
+    for item in entries:
+        if str(item['file_id']) in existing:
+            if not existing[str(item['file_id'])] == item['timestamp']:
+                UserData.objects.filter(user=request.user,
+                                        file_id=str(item['file_id'])).update(timestamp=item['timestamp'])
+        else:
+            new_entries[str(item['file_id'])] = UserData(user=request.user, file_id=item['file_id'],
+                                                         file_name=item['file_name'], timestamp=item['timestamp'])
+    UserData.objects.bulk_create(new_entries.values())
+
 def _local_store(request, file_name, plot):
     """
         Store user data locally
@@ -101,14 +156,9 @@ def _local_store(request, file_name, plot):
     plot_data.timestamp = timezone.now()
     plot_data.save()
 
-    user_data, created = UserData.objects.get_or_create(user=request.user, file_id=run_obj.id, defaults={'timestamp': timezone.now()})
-    if created:
-        user_data.file_name = file_name
-        user_data.timestamp = plot_data.timestamp
-        user_data.save()
-
-    return True, ""
+    return True, "", dict(file_id=run_obj.id, file_name=file_name, timestamp=plot_data.timestamp)
 
+@timing.timed('data')
 def _remote_store(request, file_name, plot):
     """
         Store user data in a remove data server
@@ -128,11 +178,10 @@ def _remote_store(request, file_name, plot):
     http_request = requests.post(live_data_url, data=monitor_user, files=files, verify=True)
 
     if http_request.status_code == 200:
-        get_user_files_from_server(request, filter_file_name=file_name)
-        return True, ""
+        return True, "", dict(file_id=None, file_name=file_name, timestamp=None)
     else:
         logging.error("Return code %s for %s:", http_request.status_code, live_data_url)
-        return False, "Could not send data to server"
+        return False, "Could not send data to server", None
 
 def get_plot_data_from_server(instrument, run_id, data_type='html'):
     """
@@ -170,6 +219,7 @@ def _local_fetch(instrument, run_id, data_type='html'):
             return plot_data_list[0].data
     return None
 
+@timing.timed('data')
 def _remote_fetch(instrument, run_id, data_type='html'):
     """
         Get json data from the live data server
@@ -184,7 +234,10 @@ def _remote_fetch(instrument, run_id, data_type='html'):
         live_data_url = url_template.substitute(instrument=instrument, run_number=run_id)
         live_data_url += "/%s/" % data_type
         live_data_url = append_key(live_data_url, instrument, run_id)
-        conn = httplib.HTTPSConnection(settings.LIVE_DATA_SERVER_DOMAIN, timeout=5.5)
+        if getattr(settings, 'LIVE_DATA_SERVER_HTTPS', True):
+            conn = httplib.HTTPSConnection(settings.LIVE_DATA_SERVER_DOMAIN, timeout=5.5)
+        else:
+            conn = httplib.HTTPConnection(settings.LIVE_DATA_SERVER_DOMAIN, settings.LIVE_DATA_SERVER_PORT, timeout=5.5)
         conn.request('GET', live_data_url)
         data_request = conn.getresponse()
         if data_request.status == 200:
@@ -195,6 +248,21 @@ def _remote_fetch(instrument, run_id, data_type='html'):
         logging.error("Could not pull data from live data server:\n%s", sys.exc_value)
     return json_data
 
+@timing.timed('data')
+def _remote_file_list(request):
+    """
+        Get the list of the user's data on the live data server
+
+        :param Request request: request object
+    """
+    url_template = string.Template(settings.LIVE_DATA_USER_FILES_URL)
+    live_data_url = url_template.substitute(user=str(request.user),
+                                            domain=settings.LIVE_DATA_SERVER_DOMAIN,
+                                            port=settings.LIVE_DATA_SERVER_PORT)
+    monitor_user = {'username': settings.LIVE_DATA_API_USER, 'password': settings.LIVE_DATA_API_PWD}
+    http_request = requests.post(live_data_url, data=monitor_user, files={}, verify=True)
+    return json.loads(http_request.content)
+
 def get_user_files_from_server(request, filter_file_name=None):
     """
         Get a list of the user's data on the live data server and update the local database
@@ -203,19 +271,11 @@ def get_user_files_from_server(request, filter_file_name=None):
         :param str filter_file_name: If this parameter is not None, we will only update the entry with that file name
     """
     # If we are running locally, we have all the data we need
-    if 'datahandler' in settings.INSTALLED_APPS:
+    if is_local():
         return
 
     try:
-        # Upload plot to live data server
-        url_template = string.Template(settings.LIVE_DATA_USER_FILES_URL)
-        live_data_url = url_template.substitute(user=str(request.user),
-                                                domain=settings.LIVE_DATA_SERVER_DOMAIN,
-                                                port=settings.LIVE_DATA_SERVER_PORT)
-        monitor_user = {'username': settings.LIVE_DATA_API_USER, 'password': settings.LIVE_DATA_API_PWD}
-        http_request = requests.post(live_data_url, data=monitor_user, files={}, verify=True)
-
-        data_list = json.loads(http_request.content)
+        data_list = _remote_file_list(request)
         for item in data_list:
             if filter_file_name and not item['run_id'] == filter_file_name:
                 continue
@@ -17,9 +17,9 @@ class SimultaneousModelForm(forms.Form):
 
 class UploadFileForm(forms.Form):
     """
-        Simple form to select a data file on the user's machine
+        Simple form to select data files on the user's machine
     """
-    file = forms.FileField()
+    file = forms.FileField(widget=forms.ClearableFileInput(attrs={'multiple': True}))
 
 class UserDataUpdateForm(ModelForm):
     """
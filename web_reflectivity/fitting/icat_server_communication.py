@@ -11,6 +11,8 @@ import httplib
 import xml.dom.minidom
 import logging
 from fitting.models import CatalogCache
+from fitting import timing
+from fitting import signals
 
 try:
     from django.conf import settings
@@ -32,6 +34,7 @@ def get_text_from_xml(nodelist):
             rc.append(node.data)
     return ''.join(rc)
 
+@timing.timed('catalog')
 def get_run_info(instrument, run_number):
     """
         Get ICAT info for the specified run
@@ -41,6 +44,7 @@ def get_run_info(instrument, run_number):
 
     run_info = {}
     cached_entry = CatalogCache.objects.filter(data_path="%s/%s" % (instrument, run_number))
+    signals.cache_lookup.send_robust(sender=CatalogCache, cache='catalog', hit=len(cached_entry) > 0)
     if len(cached_entry) > 0:
         return dict(title=cached_entry[0].title, proposal=cached_entry[0].proposal)
 
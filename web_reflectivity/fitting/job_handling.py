@@ -7,11 +7,54 @@ import sys
 import string
 import os
 import numpy as np
-import refl1d
-import refl1d.names as rf
 
 from django.conf import settings
 
+from . import timing
+from . import signals
+
+# refl1d is only needed when generating scripts or computing a theory curve.
+# It is imported where it is used to keep process start-up (web workers,
+# management commands, celery workers) free of the scientific stack.
+
+def get_refl1d_version():
+    """
+        Return the version of the refl1d package available to the web application.
+    """
+    import refl1d
+    return refl1d.__version__
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'job_templates')
+
+# Compiled job templates, keyed by template file name: {name: (mtime, string.Template)}
+_TEMPLATE_CACHE = {}
+
+def get_template(template_name):
+    """
+        Return the compiled string.Template for a file in job_templates/.
+        Templates are read and compiled once per process. In DEBUG mode,
+        the file's modification time is checked so that edits are picked up
+        without restarting the server.
+
+        :param str template_name: name of the template file
+    """
+    template_path = os.path.join(TEMPLATE_DIR, template_name)
+    cached = _TEMPLATE_CACHE.get(template_name, None)
+    if cached is not None and not settings.DEBUG:
+        signals.cache_lookup.send_robust(sender=None, cache='templates', hit=True)
+        return cached[1]
+
+    mtime = os.path.getmtime(template_path)
+    hit = cached is not None and cached[0] == mtime
+    signals.cache_lookup.send_robust(sender=None, cache='templates', hit=hit)
+    if hit:
+        return cached[1]
+
+    with open(template_path, 'r') as fd:
+        compiled = string.Template(fd.read())
+    _TEMPLATE_CACHE[template_name] = (mtime, compiled)
+    return compiled
+
 def create_model_file(data_form, layer_forms, data_file=None, ascii_data="", output_dir='/tmp',
                       fit=True, options={}, constraints=[], template='reflectivity_model.py.template',
                       sample_name='sample', probe_name='probe', expt_name='expt'):
@@ -47,86 +90,72 @@ def create_model_file(data_form, layer_forms, data_file=None, ascii_data="", out
     else:
         sample_ranges = data_form.get_predefined_intensity_range(probe_name=probe_name)
 
-    template_dir, _ = os.path.split(os.path.abspath(__file__))
-    with open(os.path.join(template_dir, 'job_templates', template), 'r') as fd:
-        template = fd.read()
-        model_template = string.Template(template)
-
-        # Fitting engine
-        engine = options.get('engine', 'dream')
-
-        # Determine number of steps for refl1d
-        default_value = 1000 if fit else 1
-        if fit is False:
-            steps = default_value
-            burn = default_value
-            engine = 'amoeba'
-        else:
-            steps = options.get('steps', default_value)
-            burn = options.get('burn', default_value)
-
-        # If we are running locally, find the environment's REFL1D
-        refl1d_path = settings.REFL1D_PATH
-        if settings.JOB_HANDLING_HOST == 'localhost':
-            refl1d_path = os.path.split(sys.executable)[0]
-
-        script = model_template.substitute(REDUCED_FILE=data_file,
-                                           REFL1D_VERSION=refl1d.__version__,
-                                           Q_MIN=data_form.cleaned_data['q_min'],
-                                           Q_MAX=data_form.cleaned_data['q_max'],
-                                           MATERIALS=materials,
-                                           SAMPLE=sample,
-                                           SAMPLE_NAME=sample_name,
-                                           PROBE_NAME=probe_name,
-                                           EXPT_NAME=expt_name,
-                                           RANGES=ranges,
-                                           ENGINE=engine,
-                                           ASCII_DATA=ascii_data,
-                                           OUTPUT_DIR=output_dir,
-                                           REFL1D_PATH=refl1d_path,
-                                           REFL1D_STEPS=steps,
-                                           REFL1D_BURN=burn,
-                                           SAMPLE_RANGES=sample_ranges)
+    model_template = get_template(template)
+
+    # Fitting engine
+    engine = options.get('engine', 'dream')
+
+    # Determine number of steps for refl1d
+    default_value = 1000 if fit else 1
+    if fit is False:
+        steps = default_value
+        burn = default_value
+        engine = 'amoeba'
+    else:
+        steps = options.get('steps', default_value)
+        burn = options.get('burn', default_value)
+
+    # If we are running locally, find the environment's REFL1D
+    refl1d_path = settings.REFL1D_PATH
+    if settings.JOB_HANDLING_HOST == 'localhost':
+        refl1d_path = os.path.split(sys.executable)[0]
+
+    script = model_template.substitute(REDUCED_FILE=data_file,
+                                       REFL1D_VERSION=get_refl1d_version(),
+                                       Q_MIN=data_form.cleaned_data['q_min'],
+                                       Q_MAX=data_form.cleaned_data['q_max'],
+                                       MATERIALS=materials,
+                                       SAMPLE=sample,
+                                       SAMPLE_NAME=sample_name,
+                                       PROBE_NAME=probe_name,
+                                       EXPT_NAME=expt_name,
+                                       RANGES=ranges,
+                                       ENGINE=engine,
+                                       ASCII_DATA=ascii_data,
+                                       OUTPUT_DIR=output_dir,
+                                       REFL1D_PATH=refl1d_path,
+                                       REFL1D_STEPS=steps,
+                                       REFL1D_BURN=burn,
+                                       SAMPLE_RANGES=sample_ranges)
 
     return script
 
 def assemble_data_setup(data_list):
     """ Write the portion of the job script related to data files """
-    template_dir, _ = os.path.split(os.path.abspath(__file__))
-    script = ''
-    with open(os.path.join(template_dir, 'job_templates', 'simultaneous_data.py.template'), 'r') as fd:
-        template = fd.read()
-        model_template = string.Template(template)
-
-    for data_file, ascii_data in data_list:
-        script += model_template.substitute(REDUCED_FILE=data_file,
-                                            ASCII_DATA=ascii_data)
-    return script
+    model_template = get_template('simultaneous_data.py.template')
+    return ''.join([model_template.substitute(REDUCED_FILE=data_file, ASCII_DATA=ascii_data)
+                    for data_file, ascii_data in data_list])
 
 def assemble_job(model_script, data_script, expt_names, data_ids, options, work_dir, output_dir='/tmp'):
     """ Write the portion of the job script related to data files """
-    template_dir, _ = os.path.split(os.path.abspath(__file__))
-    script = ''
-    with open(os.path.join(template_dir, 'job_templates', 'simultaneous_job.py.template'), 'r') as fd:
-        template = fd.read()
-        model_template = string.Template(template)
-        # If we are running locally, find the environment's REFL1D
-        refl1d_path = settings.REFL1D_PATH
-        if settings.JOB_HANDLING_HOST == 'localhost':
-            refl1d_path = os.path.split(sys.executable)[0]
-        script += model_template.substitute(PROCESS_DATA=data_script,
-                                            REFL1D_VERSION=refl1d.__version__,
-                                            MODELS=model_script,
-                                            WORK_DIR=work_dir,
-                                            EXPT_LIST='[%s]' % ','.join(expt_names),
-                                            EXPT_IDS = '[%s]' % ','.join(['\"%s\"' % d for d in data_ids]),
-                                            ENGINE=options.get('engine', 'dream'),
-                                            OUTPUT_DIR=output_dir,
-                                            REFL1D_PATH=refl1d_path,
-                                            REFL1D_STEPS=options.get('steps', 1000),
-                                            REFL1D_BURN=options.get('burn', 1000))
-    return script
-
+    model_template = get_template('simultaneous_job.py.template')
+    # If we are running locally, find the environment's REFL1D
+    refl1d_path = settings.REFL1D_PATH
+    if settings.JOB_HANDLING_HOST == 'localhost':
+        refl1d_path = os.path.split(sys.executable)[0]
+    return model_template.substitute(PROCESS_DATA=data_script,
+                                     REFL1D_VERSION=get_refl1d_version(),
+                                     MODELS=model_script,
+                                     WORK_DIR=work_dir,
+                                     EXPT_LIST='[%s]' % ','.join(expt_names),
+                                     EXPT_IDS='[%s]' % ','.join(['\"%s\"' % d for d in data_ids]),
+                                     ENGINE=options.get('engine', 'dream'),
+                                     OUTPUT_DIR=output_dir,
+                                     REFL1D_PATH=refl1d_path,
+                                     REFL1D_STEPS=options.get('steps', 1000),
+                                     REFL1D_BURN=options.get('burn', 1000))
+
+@timing.timed('refl1d')
 def compute_reflectivity(q, r, dr, dq, fit_problem):
     """
         Create a refl1d model file from a template
@@ -136,6 +165,8 @@ def compute_reflectivity(q, r, dr, dq, fit_problem):
         :param list dq: q resolution as FWHM
         :param FitProblem fit_problem: fit problem object
     """
+    import refl1d.names as rf
+
     q = np.asarray(q)
     dq = np.asarray(dq)
     zeros = np.zeros(len(q))
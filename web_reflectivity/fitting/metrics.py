@@ -0,0 +1,369 @@
+#pylint: disable=bare-except, invalid-name, unused-argument
+"""
+    Application metrics, reported in the Prometheus text exposition format.
+
+    Counters and histograms are updated by signal receivers: the status transitions
+    of remote jobs, and the signals sent by the fitting application for instrumented
+    calls, cache lookups and queued jobs. Each process adds to its own counts in memory,
+    and adds them to the counters shared by the web server and the Celery workers in
+    Redis at most every METRICS_FLUSH_INTERVAL seconds. Gauges are read from the
+    database when the metrics are reported.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import sys
+import re
+import time
+import atexit
+import bisect
+import logging
+import threading
+import collections
+
+from django.conf import settings
+from django.db.models import Count
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django_remote_submission.models import Job
+
+from .models import FitterOptions
+from . import signals
+from . import timing
+
+## Redis hashes holding the counters, and the submission time of the queued jobs
+METRICS_KEY = 'fitting-metrics:%s'
+QUEUED_KEY = 'fitting-metrics-queued:%s'
+
+ENGINES = [engine for engine, _ in FitterOptions.ENGINE_CHOICES] + ['unknown']
+FINISHED_STATUSES = [Job.STATUS.success, Job.STATUS.failure]
+CACHES = ['plots', 'theory', 'catalog', 'templates', 'constraints']
+
+## Upper bounds of the histogram buckets, in seconds
+CALL_BUCKETS = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+JOB_BUCKETS = [1, 10, 60, 300, 900, 3600, 4*3600, 24*3600]
+
+## Counters: name, description and label sets
+COUNTERS = [('fitting_jobs_submitted_total', 'Jobs queued for submission to the compute host',
+             [dict(engine=engine) for engine in ENGINES]),
+            ('fitting_jobs_started_total', 'Jobs started on the compute host',
+             [dict(engine=engine) for engine in ENGINES]),
+            ('fitting_jobs_finished_total', 'Jobs finished on the compute host',
+             [dict(engine=engine, status=status) for engine in ENGINES for status in FINISHED_STATUSES]),
+            ('fitting_cache_requests_total', 'Cache lookups',
+             [dict(cache=name, result=result) for name in CACHES for result in ['hit', 'miss']])]
+
+## Histograms: name, description, buckets and label sets
+HISTOGRAMS = [('fitting_job_start_seconds', 'Time from the submission of a job to its start',
+               JOB_BUCKETS, [dict(engine=engine) for engine in ENGINES]),
+              ('fitting_job_finish_seconds', 'Time from the submission of a job to its end',
+               JOB_BUCKETS, [dict(engine=engine) for engine in ENGINES]),
+              ('fitting_call_duration_seconds', 'Duration of calls to the data server, the catalog, refl1d and plotting',
+               CALL_BUCKETS, [dict(call=name) for name, _ in timing.TIMERS])]
+
+def _series(name, labels):
+    """
+        Return the name of a time series, as written in the exposition format
+        :param str name: metric name
+        :param dict labels: label values
+    """
+    label_str = ','.join(['%s="%s"' % (key, labels[key]) for key in sorted(labels)])
+    return '%s{%s}' % (name, label_str)
+
+## Redis clients, by URL
+_stores = {}
+
+def metrics_store():
+    """
+        Return the Redis client holding the shared counters, or None if METRICS_REDIS_URL
+        is not set, in which case each process only reports its own counts.
+    """
+    url = getattr(settings, 'METRICS_REDIS_URL', None)
+    if not url:
+        return None
+    if url not in _stores:
+        import redis
+        _stores[url] = redis.StrictRedis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+    return _stores[url]
+
+def _namespace():
+    """
+        Return the name of the database the metrics are about. The counters are kept
+        for each database, like the gauges, so that test databases don't share them.
+    """
+    return settings.DATABASES['default']['NAME']
+
+class _Counters(object):
+    """
+        Counts of the current process that are not in the shared counters yet
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = collections.defaultdict(int)
+        self.last_flush = time.time()
+
+    def add(self, key, amount):
+        """
+            Add to a counter, and add the pending counts to the shared counters when they are due
+            :param str key: counter key
+            :param int amount: amount to add
+        """
+        with self.lock:
+            self.pending[key] += amount
+            due = time.time() - self.last_flush >= getattr(settings, 'METRICS_FLUSH_INTERVAL', 10)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+            Add the pending counts to the shared counters, with atomic increments.
+            The counts are kept if Redis can't be reached.
+        """
+        store = metrics_store()
+        with self.lock:
+            self.last_flush = time.time()
+            if store is None or len(self.pending) == 0:
+                return
+            pending = self.pending
+            self.pending = collections.defaultdict(int)
+        try:
+            pipeline = store.pipeline()
+            for key, amount in pending.items():
+                pipeline.hincrby(METRICS_KEY % _namespace(), key, amount)
+            pipeline.execute()
+        except:
+            logging.error("Could not store the metrics: %s", sys.exc_value)
+            with self.lock:
+                for key, amount in pending.items():
+                    self.pending[key] += amount
+
+    def values(self):
+        """
+            Return the shared counters, with the counts of this process not added to them yet
+        """
+        self.flush()
+        values = collections.defaultdict(int)
+        store = metrics_store()
+        if store is not None:
+            try:
+                for key, value in store.hgetall(METRICS_KEY % _namespace()).items():
+                    values[key.decode('utf-8')] = int(value)
+            except:
+                logging.error("Could not read the metrics: %s", sys.exc_value)
+        with self.lock:
+            for key, amount in self.pending.items():
+                values[key] += amount
+        return values
+
+    def reset(self):
+        """
+            Reset the counters of the current database
+        """
+        with self.lock:
+            self.pending.clear()
+        store = metrics_store()
+        if store is not None:
+            try:
+                store.delete(METRICS_KEY % _namespace(), QUEUED_KEY % _namespace())
+            except:
+                logging.error("Could not reset the metrics: %s", sys.exc_value)
+
+_counters = _Counters()
+atexit.register(_counters.flush)
+
+def _incr(key, amount=1):
+    """
+        Increment a counter
+        :param str key: counter key
+        :param int amount: amount to add
+    """
+    _counters.add(key, amount)
+
+def reset():
+    """
+        Reset all the counters
+    """
+    _counters.reset()
+
+def increment(name, **labels):
+    """
+        Increment a counter
+        :param str name: metric name
+        :param labels: label values
+    """
+    _incr(_series(name, labels))
+
+def observe(name, buckets, value, **labels):
+    """
+        Add an observation to a histogram. We keep the number of observations
+        in each bucket, their number and their sum in microseconds.
+
+        :param str name: metric name
+        :param list buckets: upper bounds of the buckets
+        :param float value: observed value
+        :param labels: label values
+    """
+    series = _series(name, labels)
+    _incr('%s:bucket:%s' % (series, bisect.bisect_left(buckets, value)))
+    _incr('%s:count' % series)
+    _incr('%s:sum' % series, int(1e6 * value))
+
+def job_engine(job):
+    """
+        Return the fitting engine used by a job, read from its refl1d command line
+        :param Job job: remote job
+    """
+    program = job.program or ''
+    index = program.rfind('--fit=')
+    if index >= 0:
+        result = re.match(r'--fit=(\w+)', program[index:])
+        if result is not None and result.group(1) in ENGINES:
+            return result.group(1)
+    return 'unknown'
+
+@receiver(post_init, sender=Job)
+def remember_job_status(sender, instance, **kwargs):
+    """
+        Keep the status a job was loaded with, so that we can see it change.
+        The status is read from the instance dictionary so that a deferred field is not loaded.
+    """
+    instance.metrics_status = instance.__dict__.get('status', None)
+
+@receiver(signals.job_queued)
+def record_job_queued(sender, job, **kwargs):
+    """
+        Count a queued job and remember when it was queued
+    """
+    increment('fitting_jobs_submitted_total', engine=job_engine(job))
+    # Jobs are rare, so their counts are shared right away
+    _counters.flush()
+    store = metrics_store()
+    if store is not None:
+        try:
+            store.hset(QUEUED_KEY % _namespace(), job.pk, time.time())
+        except:
+            logging.error("Could not store the submission time of job %s: %s", job.pk, sys.exc_value)
+
+@receiver(post_save, sender=Job)
+def record_job_transition(sender, instance, **kwargs):
+    """
+        Count jobs starting and finishing, and the time they took since they were queued
+    """
+    status = instance.status
+    if status == getattr(instance, 'metrics_status', None):
+        return
+    instance.metrics_status = status
+    if status != Job.STATUS.submitted and status not in FINISHED_STATUSES:
+        return
+
+    engine = job_engine(instance)
+    store = metrics_store()
+    queued = None
+    if store is not None:
+        try:
+            queued = store.hget(QUEUED_KEY % _namespace(), instance.pk)
+        except:
+            logging.error("Could not read the submission time of job %s: %s", instance.pk, sys.exc_value)
+    if queued is not None:
+        elapsed = time.time() - float(queued)
+    else:
+        elapsed = (timezone.now() - instance.created).total_seconds()
+
+    if status == Job.STATUS.submitted:
+        increment('fitting_jobs_started_total', engine=engine)
+        observe('fitting_job_start_seconds', JOB_BUCKETS, elapsed, engine=engine)
+    else:
+        increment('fitting_jobs_finished_total', engine=engine, status=status)
+        observe('fitting_job_finish_seconds', JOB_BUCKETS, elapsed, engine=engine)
+        if store is not None:
+            try:
+                store.hdel(QUEUED_KEY % _namespace(), instance.pk)
+            except:
+                logging.error("Could not remove the submission time of job %s: %s", instance.pk, sys.exc_value)
+    _counters.flush()
+
+@receiver(signals.call_timed)
+def record_call(sender, name, duration, **kwargs):
+    """
+        Add the duration of an instrumented call to its histogram
+    """
+    observe('fitting_call_duration_seconds', CALL_BUCKETS, duration, call=name)
+
+@receiver(signals.cache_lookup)
+def record_cache_lookup(sender, cache, hit, **kwargs):
+    """
+        Count a cache hit or miss
+    """
+    increment('fitting_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+def celery_queue_length():
+    """
+        Return the number of tasks waiting in the Celery queue, or None
+        if the broker can't be reached.
+    """
+    from .celery import app
+    try:
+        with app.connection_for_read() as connection:
+            connection.ensure_connection(max_retries=1, interval_start=0)
+            queue = connection.default_channel.queue_declare(queue=app.conf.task_default_queue, passive=True)
+            return queue.message_count
+    except:
+        logging.error("Could not read the length of the Celery queue: %s", sys.exc_value)
+    return None
+
+def report():
+    """
+        Return all the metrics in the Prometheus text exposition format
+    """
+    lines = []
+    def _header(name, description, metric_type):
+        """ Add the description of a metric """
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+
+    # Read all the counters and histograms at once
+    values = _counters.values()
+    def _value(key):
+        """ Return the value of a counter """
+        return values.get(key, 0)
+
+    for name, description, label_sets in COUNTERS:
+        _header(name, description, 'counter')
+        lines.extend(['%s %s' % (_series(name, labels), _value(_series(name, labels))) for labels in label_sets])
+
+    _header('fitting_cache_hit_ratio', 'Fraction of the cache lookups that were hits', 'gauge')
+    for name in CACHES:
+        hits = _value(_series('fitting_cache_requests_total', dict(cache=name, result='hit')))
+        misses = _value(_series('fitting_cache_requests_total', dict(cache=name, result='miss')))
+        if hits + misses > 0:
+            lines.append('%s %g' % (_series('fitting_cache_hit_ratio', dict(cache=name)), hits / (hits + misses)))
+
+    for name, description, buckets, label_sets in HISTOGRAMS:
+        _header(name, description, 'histogram')
+        for labels in label_sets:
+            series = _series(name, labels)
+            total = 0
+            for i, upper in enumerate(buckets + ['+Inf']):
+                total += _value('%s:bucket:%s' % (series, i))
+                bucket_labels = dict(labels, le='%g' % upper if i < len(buckets) else upper)
+                lines.append('%s %s' % (_series('%s_bucket' % name, bucket_labels), total))
+            lines.append('%s %g' % (_series('%s_sum' % name, labels), _value('%s:sum' % series) / 1e6))
+            lines.append('%s %s' % (_series('%s_count' % name, labels), _value('%s:count' % series)))
+
+    # Current state of the jobs
+    _header('fitting_jobs', 'Jobs in each status', 'gauge')
+    counts = dict(Job.objects.values_list('status').annotate(Count('id')))
+    for status, _ in Job.STATUS:
+        lines.append('%s %s' % (_series('fitting_jobs', dict(status=status)), counts.get(status, 0)))
+
+    _header('fitting_jobs_running', 'Jobs running on the compute host', 'gauge')
+    running = dict((engine, 0) for engine in ENGINES)
+    for job in Job.objects.filter(status=Job.STATUS.submitted).only('program'):
+        running[job_engine(job)] += 1
+    lines.extend(['%s %s' % (_series('fitting_jobs_running', dict(engine=engine)), running[engine]) for engine in ENGINES])
+
+    queue_length = celery_queue_length()
+    if queue_length is not None:
+        _header('fitting_celery_queue_length', 'Tasks waiting in the Celery queue', 'gauge')
+        lines.append('fitting_celery_queue_length %s' % queue_length)
+
+    return '\n'.join(lines) + '\n'
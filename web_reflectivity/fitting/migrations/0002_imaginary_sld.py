@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#pylint: disable=invalid-name
+"""
+    Bring the migrations in line with the models: the imaginary part
+    of the layer SLD was added to the models without a migration.
+"""
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_remote_submission', '0001_initial'),
+        ('fitting', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reflectivitylayer',
+            name='i_sld',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='reflectivitylayer',
+            name='i_sld_error',
+            field=models.FloatField(blank=True, default=0, null=True),
+        ),
+        migrations.AddField(
+            model_name='reflectivitylayer',
+            name='i_sld_is_fixed',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='reflectivitylayer',
+            name='i_sld_max',
+            field=models.FloatField(blank=True, default=1.0),
+        ),
+        migrations.AddField(
+            model_name='reflectivitylayer',
+            name='i_sld_min',
+            field=models.FloatField(blank=True, default=0.0),
+        ),
+        migrations.AlterField(
+            model_name='simultaneousfit',
+            name='remote_job',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='django_remote_submission.Job'),
+        ),
+    ]
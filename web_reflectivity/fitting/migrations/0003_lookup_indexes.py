@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#pylint: disable=invalid-name
+"""
+    Add indexes for the most frequent lookups, and copy the data path
+    of each FitProblem so that it can be looked up without a join.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_data_path(apps, schema_editor):
+    """ Fill the new FitProblem.data_path column from the reflectivity model """
+    FitProblem = apps.get_model('fitting', 'FitProblem')
+    ReflectivityModel = apps.get_model('fitting', 'ReflectivityModel')
+    data_path = ReflectivityModel.objects.filter(pk=OuterRef('reflectivity_model_id')).values('data_path')[:1]
+    FitProblem.objects.update(data_path=Subquery(data_path))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_remote_submission', '0001_initial'),
+        ('fitting', '0002_imaginary_sld'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fitproblem',
+            name='data_path',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.RunPython(copy_data_path, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='fitproblem',
+            index=models.Index(fields=['user', 'data_path'], name='fitting_fit_user_path_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fitproblem',
+            index=models.Index(fields=['user', 'timestamp'], name='fitting_fit_user_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userdata',
+            index=models.Index(fields=['user', 'file_id'], name='fitting_data_user_file_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogcache',
+            index=models.Index(fields=['data_path'], name='fitting_catalog_path_idx'),
+        ),
+        # The job logs belong to django_remote_submission, so we can't declare
+        # the index on the model. Results are read from the latest log of a job.
+        migrations.RunSQL(
+            ["CREATE INDEX fitting_log_job_time_idx ON django_remote_submission_log (job_id, time)"],
+            ["DROP INDEX fitting_log_job_time_idx"],
+        ),
+    ]
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#pylint: disable=invalid-name
+"""
+    Store the resources used by each fitting job.
+"""
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_remote_submission', '0001_initial'),
+        ('fitting', '0003_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobTelemetry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('engine', models.CharField(blank=True, default='', max_length=32)),
+                ('steps', models.IntegerField(default=0)),
+                ('burn', models.IntegerField(default=0)),
+                ('n_parameters', models.IntegerField(default=0, help_text='Number of fitted parameters')),
+                ('n_points', models.IntegerField(default=0, help_text='Number of data points')),
+                ('n_models', models.IntegerField(default=1, help_text='Number of data sets fitted together')),
+                ('wall_time', models.FloatField(default=0, help_text='Run time of the job script, in seconds')),
+                ('fit_time', models.FloatField(default=0, help_text='Run time of refl1d, in seconds')),
+                ('steps_per_second', models.FloatField(blank=True, null=True)),
+                ('host', models.CharField(blank=True, default='', max_length=128)),
+                ('timestamp', models.DateTimeField(auto_now_add=True, verbose_name='timestamp')),
+                ('job', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='telemetry', to='django_remote_submission.Job')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='jobtelemetry',
+            index=models.Index(fields=['engine', 'timestamp'], name='fitting_telemetry_engine_idx'),
+        ),
+    ]
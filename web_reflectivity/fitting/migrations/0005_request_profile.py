@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+#pylint: disable=invalid-name
+"""
+    Store the profiles of requests taken for staff users.
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('fitting', '0004_job_telemetry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=8)),
+                ('path', models.TextField()),
+                ('status', models.IntegerField(default=200)),
+                ('total_time', models.FloatField(default=0, help_text='Time taken by the view, in seconds')),
+                ('python_time', models.FloatField(default=0, help_text='Time measured by the profiler, in seconds')),
+                ('n_queries', models.IntegerField(default=0, help_text='Number of SQL queries')),
+                ('sql_time', models.FloatField(default=0, help_text='Time spent in SQL queries, in seconds')),
+                ('functions', models.TextField(blank=True, default='', help_text='Functions taking the most time')),
+                ('queries', models.TextField(blank=True, default='[]', help_text='SQL statements taking the most time, as JSON')),
+                ('stats', models.BinaryField(help_text='Profile statistics, in the pstats format')),
+                ('timestamp', models.DateTimeField(auto_now_add=True, verbose_name='timestamp')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -5,13 +5,20 @@
 #TODO: move the script generation from the forms to the models
 from __future__ import unicode_literals
 import sys
+import json
 import logging
 import re
+import hashlib
 from math import *
 from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import User
-from django_remote_submission.models import Job
+from django_remote_submission.models import Job, Log
 from django.forms import model_to_dict
+import numpy as np
+from .parsing.refl1d import parse_telemetry
+from . import signals
 
 class ReflectivityModel(models.Model):
     """
@@ -54,6 +61,20 @@ class ReflectivityModel(models.Model):
     back_roughness_max = models.FloatField(blank=True, default=5)
     back_roughness_error = models.FloatField(null=True, blank=True, default=0)
 
+    def __init__(self, *args, **kwargs):
+        super(ReflectivityModel, self).__init__(*args, **kwargs)
+        self._saved_data_path = self.data_path
+
+    def save(self, *args, **kwargs):
+        """
+            Keep the data path of the fit problems using this model in sync
+        """
+        changed = self.pk is not None and self.data_path != self._saved_data_path
+        super(ReflectivityModel, self).save(*args, **kwargs)
+        if changed:
+            FitProblem.objects.filter(reflectivity_model=self).update(data_path=self.data_path)
+        self._saved_data_path = self.data_path
+
     def __unicode__(self):
         return u"id %s: %s" % (self.id, self.data_path)
 
@@ -103,6 +124,21 @@ class FitProblem(models.Model):
     layers = models.ManyToManyField(ReflectivityLayer, related_name='_model_layers+')
     remote_job = models.ForeignKey(Job, models.SET_NULL, null=True)
     timestamp = models.DateTimeField('timestamp', auto_now_add=True)
+    ## Copy of reflectivity_model.data_path, so that lookups don't need a join
+    data_path = models.TextField(blank=True, default='')
+
+    class Meta: #pylint: disable=old-style-class, no-init, too-few-public-methods
+        """ Special options """
+        indexes = [models.Index(fields=['user', 'data_path'], name='fitting_fit_user_path_idx'),
+                   models.Index(fields=['user', 'timestamp'], name='fitting_fit_user_time_idx')]
+
+    def save(self, *args, **kwargs):
+        """
+            Keep the data path in sync with the reflectivity model
+        """
+        if self.reflectivity_model_id is not None:
+            self.data_path = self.reflectivity_model.data_path
+        super(FitProblem, self).save(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
         """
@@ -131,7 +167,8 @@ class FitProblem(models.Model):
         """ Useful method to return the layers as a concise string """
         front_name = self.reflectivity_model.front_name
         back_name = self.reflectivity_model.back_name
-        layers = [str(i) for i in self.layers.all().order_by('layer_number')]
+        # Sort in memory so that prefetched layers don't trigger a query
+        layers = [str(i) for i in sorted(self.layers.all(), key=lambda layer: layer.layer_number)]
         if len(layers) > 0:
             layers_str = ', '.join(layers)+', '
         else:
@@ -162,6 +199,10 @@ class UserData(models.Model):
     tags = models.TextField(blank=True, default='')
     timestamp = models.DateTimeField('timestamp')
 
+    class Meta: #pylint: disable=old-style-class, no-init, too-few-public-methods
+        """ Special options """
+        indexes = [models.Index(fields=['user', 'file_id'], name='fitting_data_user_file_idx')]
+
 class FitterOptions(models.Model):
     """
         Reflectivity model
@@ -190,6 +231,10 @@ class FitterOptions(models.Model):
         return dict(steps=self.steps, burn=self.burn, engine=self.engine)
 
 
+## Compiled constraint functions, keyed by (constraint ID, source hash)
+_CONSTRAINT_CACHE = {}
+CONSTRAINT_CACHE_SIZE = 1000
+
 class Constraint(models.Model):
     """
         Fitting parameter constraints
@@ -224,11 +269,29 @@ class Constraint(models.Model):
 
         return function_name, constraint_function
 
-    def apply_constraint(self, fit_problem):
+    def compile_constraint(self):
+        """
+            Return the compiled constraint function.
+            Compiled functions are cached by constraint ID and source hash,
+            so a constraint is only compiled again when its definition changes.
+        """
+        _, constraint_function = self.get_constraint_function(alternate_name='constraint_func')
+        key = (self.id, hashlib.sha1(constraint_function.encode('utf-8')).hexdigest())
+        signals.cache_lookup.send_robust(sender=Constraint, cache='constraints', hit=key in _CONSTRAINT_CACHE)
+        if key not in _CONSTRAINT_CACHE:
+            if len(_CONSTRAINT_CACHE) > CONSTRAINT_CACHE_SIZE:
+                _CONSTRAINT_CACHE.clear()
+            namespace = {}
+            code = compile(constraint_function, 'constraint_%s.py' % self.id, 'exec')
+            exec code in globals(), namespace #pylint: disable=exec-used
+            _CONSTRAINT_CACHE[key] = namespace['constraint_func']
+        return _CONSTRAINT_CACHE[key]
+
+    def get_parameters(self, layer_map):
         """
-            Apply the constraint to a fit problem
+            Parse the variables and get their values
+            :param dict layer_map: dictionary of layers, keyed by name
         """
-        # Parse the variables and get their values
         # See comment in get_ranges()
         parameters = {}
         variable_list = self.variables.split(',')
@@ -237,23 +300,82 @@ class Constraint(models.Model):
             for layer_parameter in self.ORDERED_NAMES:
                 if layer_parameter in clean_variable:
                     layer_name = clean_variable.replace('_%s' % layer_parameter, '').strip()
-                    layer_objects = fit_problem.layers.filter(name=layer_name)
-                    if len(layer_objects) > 0:
-                        if hasattr(layer_objects[0], layer_parameter):
-                            parameters[clean_variable] = getattr(layer_objects[0], layer_parameter)
+                    if layer_name in layer_map and hasattr(layer_map[layer_name], layer_parameter):
+                        parameters[clean_variable] = getattr(layer_map[layer_name], layer_parameter)
                     break
-        _, constraint_function = self.get_constraint_function(alternate_name='constraint_func')
+        return parameters
+
+    def apply_constraint(self, fit_problem, layers=None):
+        """
+            Apply the constraint to a fit problem.
+
+            :param FitProblem fit_problem: fit problem the constraint belongs to
+            :param list layers: layers of the fit problem, if already loaded. In that case
+                the constrained layer is only updated in memory and the caller saves it.
+            :returns: the updated layer, or None if the constraint could not be evaluated
+        """
+        save = layers is None
+        if layers is None:
+            layers = fit_problem.layers.all().order_by('id')
+
+        # Use the first layer with a given name
+        layer_map = {}
+        target = None
+        for layer in layers:
+            layer_map.setdefault(layer.name, layer)
+            if layer.pk == self.layer_id:
+                target = layer
+        # Constraints on layers that are no longer part of the fit are saved right away
+        if target is None:
+            target = self.layer
+            save = True
 
         try:
-            def constraint_func():
-                """ Dummy function to avoid pylint error """
-                return 1
-            exec constraint_function #pylint: disable=exec-used
-            setattr(self.layer, self.parameter, constraint_func(**parameters))
-            self.layer.save()
-            fit_problem.save()
+            constraint_func = self.compile_constraint()
+            setattr(target, self.parameter, constraint_func(**self.get_parameters(layer_map)))
         except:
             logging.error("Could not evaluate constraint: %s", sys.exc_value)
+            return None
+        if save:
+            target.save()
+        return target
+
+    @classmethod
+    def apply_constraints(cls, fit_problem, constraints=None):
+        """
+            Apply all the constraints of a fit problem. The layers are loaded once,
+            and the values that changed are written with a single query.
+
+            :param FitProblem fit_problem: fit problem to update
+            :param list constraints: constraints to apply, or None for all the constraints of the fit problem
+        """
+        if constraints is None:
+            constraints = cls.objects.filter(fit_problem=fit_problem)
+        constraints = list(constraints)
+        if len(constraints) == 0:
+            return
+
+        layers = list(fit_problem.layers.all().order_by('id'))
+        original = dict((layer.pk, model_to_dict(layer)) for layer in layers)
+        updates = {}
+        for constraint in constraints:
+            layer = constraint.apply_constraint(fit_problem, layers=layers)
+            if layer is not None and layer.pk in original:
+                updates.setdefault(constraint.parameter, set()).add(layer.pk)
+
+        # Only write the values that changed
+        layer_dict = dict((layer.pk, layer) for layer in layers)
+        fields = {}
+        changed = set()
+        for parameter, pk_list in updates.items():
+            pk_list = [pk for pk in pk_list if not getattr(layer_dict[pk], parameter) == original[pk][parameter]]
+            if len(pk_list) > 0:
+                whens = [models.When(pk=pk, then=models.Value(getattr(layer_dict[pk], parameter))) for pk in pk_list]
+                fields[parameter] = models.Case(*whens, default=models.F(parameter),
+                                                output_field=ReflectivityLayer._meta.get_field(parameter))
+                changed.update(pk_list)
+        if len(fields) > 0:
+            ReflectivityLayer.objects.filter(pk__in=changed).update(**fields)
 
     def get_ranges(self, sample_name='sample', probe_name='probe'):
         """
@@ -418,16 +540,61 @@ class SimultaneousConstraint(models.Model):
                 return fitp
         return None
 
-    def _retrieve_info(self, obj_id, par_name):
-        """ Retrieve name and id of an encoded parameter """
+    @staticmethod
+    def _is_model_parameter(par_name):
+        """ Return True if the parameter belongs to the ReflectivityModel rather than a layer """
+        return 'back' in par_name or 'front' in par_name
+
+    @classmethod
+    def load_graph(cls, constraints):
+        """
+            Load the layers, reflectivity models and FitProblems referenced by a list of
+            constraints, using a fixed number of queries.
+            Returns a dict of {('model'|'layer', id): (object, [FitProblem, ...])}, where the
+            FitProblems are ordered by decreasing id.
+
+            :param list constraints: list of SimultaneousConstraint objects
+        """
+        model_ids = set()
+        layer_ids = set()
+        for item in constraints:
+            for obj_id, par_name in [(item.dependent_id, item.dependent_parameter),
+                                     (item.variable_id, item.variable_parameter)]:
+                if cls._is_model_parameter(par_name):
+                    model_ids.add(obj_id)
+                else:
+                    layer_ids.add(obj_id)
+
+        graph = {}
+        if len(model_ids) > 0:
+            for refl_model in ReflectivityModel.objects.filter(id__in=model_ids):
+                graph[('model', refl_model.id)] = (refl_model, [])
+            for fit_problem in FitProblem.objects.filter(reflectivity_model__in=model_ids).select_related('reflectivity_model').order_by('-id'):
+                graph[('model', fit_problem.reflectivity_model_id)][1].append(fit_problem)
+        if len(layer_ids) > 0:
+            for layer in ReflectivityLayer.objects.filter(id__in=layer_ids):
+                graph[('layer', layer.id)] = (layer, [])
+            through = FitProblem.layers.through
+            for item in through.objects.filter(reflectivitylayer_id__in=layer_ids).select_related('fitproblem__reflectivity_model').order_by('-fitproblem_id'):
+                graph[('layer', item.reflectivitylayer_id)][1].append(item.fitproblem)
+        return graph
+
+    def _retrieve_info(self, obj_id, par_name, graph):
+        """
+            Retrieve name and id of an encoded parameter
+            :param int obj_id: id of the layer or reflectivity model
+            :param str par_name: encoded parameter name
+            :param dict graph: preloaded objects, see load_graph()
+        """
         dependent_name = ''
         problem_id = ''
         parameter_name = par_name
-        if 'back' in par_name or 'front' in par_name:
-            try:
-                refl_model = ReflectivityModel.objects.get(id=obj_id)
-                fit_problem_list = FitProblem.objects.filter(reflectivity_model=refl_model).order_by('-id')
-                fit_problem = self._select_valid_problem(fit_problem_list)
+        if self._is_model_parameter(par_name):
+            refl_model, fit_problem_list = graph.get(('model', obj_id), (None, []))
+            fit_problem = self._select_valid_problem(fit_problem_list) if refl_model is not None else None
+            if fit_problem is None:
+                logging.error("Could not retrieve ReflectivityModel id=%s", obj_id)
+            else:
                 problem_id = fit_problem.id
                 if 'back' in par_name:
                     dependent_name = refl_model.back_name
@@ -435,29 +602,31 @@ class SimultaneousConstraint(models.Model):
                 else:
                     dependent_name = refl_model.front_name
                     parameter_name = par_name.replace('front_', '')
-            except:
-                logging.error("Could not retrieve ReflectivityModel id=%s", obj_id)
         else:
-            try:
-                layer = ReflectivityLayer.objects.get(id=obj_id)
-                fit_problem_list = FitProblem.objects.filter(layers__id=layer.id).order_by('-id')
-                fit_problem = self._select_valid_problem(fit_problem_list)
+            layer, fit_problem_list = graph.get(('layer', obj_id), (None, []))
+            fit_problem = self._select_valid_problem(fit_problem_list) if layer is not None else None
+            if fit_problem is None:
+                logging.error("Could not retrieve layer id=%s", obj_id)
+            else:
                 problem_id = fit_problem.id
                 dependent_name = layer.name
-            except:
-                logging.error(sys.exc_value)
-                logging.error("Could not retrieve layer id=%s", obj_id)
         return dependent_name, parameter_name, problem_id
 
-    def get_constraint(self, sample_name='sample'):
+    def get_constraint(self, sample_name='sample', graph=None):
         """
             Return the constraint code for the refl1d script
 
             Example: sample123['SiOx'].material.rho = sample345['SiOx'].material.rho
+
+            :param str sample_name: prefix of the sample variables in the script
+            :param dict graph: preloaded objects, see load_graph()
         """
+        if graph is None:
+            graph = self.load_graph([self])
+
         # Fish out the name of the layer
-        dep_layer, dep_par, dep_prob_id = self._retrieve_info(self.dependent_id, self.dependent_parameter)
-        var_layer, var_par, var_prob_id = self._retrieve_info(self.variable_id, self.variable_parameter)
+        dep_layer, dep_par, dep_prob_id = self._retrieve_info(self.dependent_id, self.dependent_parameter, graph)
+        var_layer, var_par, var_prob_id = self._retrieve_info(self.variable_id, self.variable_parameter, graph)
 
         dep_layer_parameter = Constraint.LAYER_PARAMETER.get(dep_par, dep_par)
         var_layer_parameter = Constraint.LAYER_PARAMETER.get(var_par, var_par)
@@ -468,6 +637,19 @@ class SimultaneousConstraint(models.Model):
                                                         var_layer, var_layer_parameter)
         return constraint
 
+    @classmethod
+    def get_constraints(cls, constraints, sample_name='sample'):
+        """
+            Return the constraint code for a list of constraints.
+            All the objects they refer to are loaded at once.
+
+            :param list constraints: list of SimultaneousConstraint objects
+            :param str sample_name: prefix of the sample variables in the script
+        """
+        constraints = list(constraints)
+        graph = cls.load_graph(constraints)
+        return [item.get_constraint(sample_name=sample_name, graph=graph) for item in constraints]
+
 class SimultaneousFit(models.Model):
     """
         Top level entry for a simultaneous fit. The FitProblem referenced here
@@ -489,3 +671,149 @@ class CatalogCache(models.Model):
     title = models.TextField(blank=True, default='')
     proposal = models.CharField(max_length=64, blank=True, default='')
     timestamp = models.DateTimeField('timestamp', auto_now_add=True)
+
+    class Meta: #pylint: disable=old-style-class, no-init, too-few-public-methods
+        """ Special options """
+        indexes = [models.Index(fields=['data_path'], name='fitting_catalog_path_idx')]
+
+class JobTelemetry(models.Model):
+    """
+        Resources used by a fitting job, as reported at the end of its log
+    """
+    job = models.OneToOneField(Job, models.CASCADE, related_name='telemetry')
+    engine = models.CharField(max_length=32, blank=True, default='')
+    steps = models.IntegerField(default=0)
+    burn = models.IntegerField(default=0)
+    n_parameters = models.IntegerField(default=0, help_text='Number of fitted parameters')
+    n_points = models.IntegerField(default=0, help_text='Number of data points')
+    n_models = models.IntegerField(default=1, help_text='Number of data sets fitted together')
+    wall_time = models.FloatField(default=0, help_text='Run time of the job script, in seconds')
+    fit_time = models.FloatField(default=0, help_text='Run time of refl1d, in seconds')
+    steps_per_second = models.FloatField(null=True, blank=True)
+    host = models.CharField(max_length=128, blank=True, default='')
+    timestamp = models.DateTimeField('timestamp', auto_now_add=True)
+
+    class Meta: #pylint: disable=old-style-class, no-init, too-few-public-methods
+        """ Special options """
+        indexes = [models.Index(fields=['engine', 'timestamp'], name='fitting_telemetry_engine_idx')]
+
+    def __unicode__(self):
+        return u"%s: %s %g sec" % (self.job_id, self.engine, self.wall_time)
+
+    @classmethod
+    def record(cls, job_id, telemetry):
+        """
+            Store the resources reported by a job
+            :param int job_id: ID of the remote job
+            :param dict telemetry: dictionary parsed from the job log
+        """
+        fields = dict((name, telemetry[name]) for name in ['engine', 'steps', 'burn', 'n_parameters', 'n_points',
+                                                           'n_models', 'wall_time', 'fit_time', 'host']
+                      if name in telemetry)
+        total_steps = fields.get('steps', 0) + fields.get('burn', 0)
+        if fields.get('fit_time', 0) > 0:
+            fields['steps_per_second'] = total_steps / float(fields['fit_time'])
+        return cls.objects.update_or_create(job_id=job_id, defaults=fields)[0]
+
+    @classmethod
+    def estimate_runtime(cls, engine, steps, burn, n_parameters, n_points, history=200):
+        """
+            Predict the refl1d run time of a fit from the latest jobs using the same engine.
+            The cost of a DREAM fit grows with the number of steps, with the size of
+            the population, which is proportional to the number of parameters, and with
+            the number of points in each evaluation. Returns None without history.
+
+            :param str engine: fitting engine
+            :param int steps: number of fitter steps
+            :param int burn: number of burn steps
+            :param int n_parameters: number of fitted parameters
+            :param int n_points: number of data points
+            :param int history: number of past jobs to use
+        """
+        past_jobs = cls.objects.filter(engine=engine, fit_time__gt=0).order_by('-timestamp')
+        past_jobs = past_jobs.values_list('fit_time', 'steps', 'burn', 'n_parameters', 'n_points')[:history]
+        costs = [fit_time / float(max(steps_ + burn_, 1) * max(n_parameters_, 1) * max(n_points_, 1))
+                 for fit_time, steps_, burn_, n_parameters_, n_points_ in past_jobs]
+        if len(costs) == 0:
+            return None
+        return np.median(costs) * max(steps + burn, 1) * max(n_parameters, 1) * max(n_points, 1)
+
+    @staticmethod
+    def runtime_summary(queryset):
+        """
+            Summarize the run-time distribution of a set of jobs for each engine.
+            Returns a list of dictionaries, with a histogram of wall times
+            in bins of increasing size.
+
+            :param QuerySet queryset: JobTelemetry objects to summarize
+        """
+        bins = [(10, '< 10 sec'), (60, '< 1 min'), (600, '< 10 min'), (3600, '< 1 hour'),
+                (6*3600, '< 6 hours'), (None, '> 6 hours')]
+        times = {}
+        for engine, wall_time, steps_per_second in queryset.values_list('engine', 'wall_time', 'steps_per_second'):
+            times.setdefault(engine, ([], []))
+            times[engine][0].append(wall_time)
+            if steps_per_second is not None:
+                times[engine][1].append(steps_per_second)
+
+        summary = []
+        for engine in sorted(times):
+            wall_times = np.asarray(times[engine][0])
+            counts = []
+            lower = 0
+            for upper, label in bins:
+                in_bin = wall_times >= lower if upper is None else (wall_times >= lower) & (wall_times < upper)
+                counts.append([label, int(np.sum(in_bin))])
+                lower = upper
+            for item in counts:
+                item.append(100 * item[1] // len(wall_times))
+            summary.append(dict(engine=engine, count=len(wall_times),
+                                median=np.median(wall_times),
+                                p90=np.percentile(wall_times, 90),
+                                max=np.max(wall_times),
+                                steps_per_second=np.median(times[engine][1]) if len(times[engine][1]) > 0 else None,
+                                histogram=counts))
+        return summary
+
+class RequestProfile(models.Model):
+    """
+        Profile of a request, taken when a staff user adds ?profile to its URL
+    """
+    user = models.ForeignKey(User, models.CASCADE)
+    method = models.CharField(max_length=8)
+    path = models.TextField()
+    status = models.IntegerField(default=200)
+    total_time = models.FloatField(default=0, help_text='Time taken by the view, in seconds')
+    python_time = models.FloatField(default=0, help_text='Time measured by the profiler, in seconds')
+    n_queries = models.IntegerField(default=0, help_text='Number of SQL queries')
+    sql_time = models.FloatField(default=0, help_text='Time spent in SQL queries, in seconds')
+    functions = models.TextField(blank=True, default='', help_text='Functions taking the most time')
+    queries = models.TextField(blank=True, default='[]', help_text='SQL statements taking the most time, as JSON')
+    stats = models.BinaryField(help_text='Profile statistics, in the pstats format')
+    timestamp = models.DateTimeField('timestamp', auto_now_add=True)
+
+    def __unicode__(self):
+        return u"%s %s: %g sec" % (self.method, self.path, self.total_time)
+
+    def sql_summary(self):
+        """
+            Return the SQL statements taking the most time, as a list
+            of dictionaries with the statement, its count and its total time
+        """
+        try:
+            return json.loads(self.queries)
+        except:
+            logging.error("Could not read the queries of profile %s: %s", self.id, sys.exc_value)
+            return []
+
+@receiver(post_save, sender=Log)
+def record_job_telemetry(sender, instance, **kwargs):
+    """
+        Store the resources used by a job once its log reports them
+    """
+    telemetry = parse_telemetry(instance.content or '')
+    if telemetry is not None:
+        try:
+            JobTelemetry.record(instance.job_id, telemetry)
+        except:
+            logging.error("Could not store telemetry for job %s: %s", instance.job_id, sys.exc_value)
@@ -74,15 +74,31 @@ def update_with_results(fit_problem, par_name, value, error):
                     layer.save()
     fit_problem.save()
 
+def index_error_output(error_output):
+    """
+        Index the list of DREAM output parameters by parameter name, so that
+        the errors of a large simultaneous fit can be looked up in constant time.
+
+        :param list error_output: list of fit output parameters [ [parameter name, value, error], ... ]
+        :returns: dict of {parameter name: [(value, error), ...]}, in output order
+    """
+    if error_output is None or isinstance(error_output, dict):
+        return error_output
+    error_index = {}
+    for par, val, err in error_output:
+        error_index.setdefault(par, []).append((float(val), err))
+    return error_index
+
 def find_error(layer_name, par_name, value, error_output, tolerance=0.001, pretty_print=False):
     """
         Find the error of a parameter in the list of output parameters.
         @param layer_name: name of the layer
         @param par_name: name of the parameter
         @param value: output value, so we can recognize the entry
-        @param error_output: list of fit output parameters from the DREAM output
+        @param error_output: list of fit output parameters from the DREAM output, or its index
 
         The output parameter list should be in the format: [ [parameter name, value, error], ... ]
+        or be the index returned by index_error_output(), which callers should build once per log.
         The DREAM outputs are not grouped by sample/experiment, so we have to use the
         parameter values to determine which is which.
 
@@ -98,18 +114,28 @@ def find_error(layer_name, par_name, value, error_output, tolerance=0.001, prett
     long_name = long_name.strip()
     _value = value
     _error = 0
-    for par, val, err in error_output:
-        if par == long_name:
-            if value == 0:
-                diff = np.abs(float(val))
-            else:
-                diff = np.abs((float(val)-value)/value)
-            if diff < tolerance:
-                _error = err
+    for val, err in index_error_output(error_output).get(long_name, []):
+        if value == 0:
+            diff = np.abs(val)
+        else:
+            diff = np.abs((val-value)/value)
+        if diff < tolerance:
+            _error = err
     if pretty_print:
         _value = "%.4g &#177; %.4g" % (value, _error) if _error > 0 else value
     return _value, _error
 
+def get_layer_parameter(layer, par_name):
+    """
+        Return the dict describing a layer parameter from the refl1d JSON output.
+        Starting with refl1d 0.8.11, SLD information is one level deeper, under 'material'.
+        :param dict layer: json representation of a layer
+        :param str par_name: name of the parameter
+    """
+    if par_name in ['rho', 'irho'] and 'material' in layer:
+        return layer['material'][par_name]
+    return layer[par_name]
+
 def update_model_from_dict(fit_problem, experiment, error_output=None, pretty_print=False):
     """
         Parse a json representation of the experiment
@@ -118,6 +144,7 @@ def update_model_from_dict(fit_problem, experiment, error_output=None, pretty_pr
         :param list error_output: list of DREAM output parameters, with errors.
         :param bool pretty_print: if True, the value will be turned into a value +- error string
     """
+    error_output = index_error_output(error_output)
     def _process_par(par_name, par_dict, layer_name):
         """ Parse the value of a fit parameter """
         _value = par_dict['value']
@@ -157,6 +184,7 @@ def update_model_from_dict_legacy(fit_problem, experiment, error_output=None, pr
         :param list error_output: list of DREAM output parameters, with errors.
         :param bool pretty_print: if True, the value will be turned into a value +- error string
     """
+    error_output = index_error_output(error_output)
     for layer in experiment['sample']['layers']:
         for par_name in ['thickness', 'rho', 'irho', 'interface']:
             _value = layer[par_name]['value']
@@ -202,7 +230,8 @@ def update_model_from_json(content, fit_problem):
             # Call legacy reader for version < 0.8.11
             if toks[0] == '0' and toks[1] == '8' and int(toks[2]) < 11:
                 update_model_from_dict_legacy(fit_problem, _expt)
-            
+                return
+
         # Call most recent reader
         update_model_from_dict(fit_problem, _expt)
 
@@ -245,6 +274,25 @@ def update_model(content, fit_problem):
         update_model_from_json(content, fit_problem)
     return chi2
 
+def parse_telemetry(content):
+    """
+        Extract the resources used by a job, which the job script reports
+        on a JOB_TELEMETRY line at the end of its log. Returns None if the
+        job hasn't reported them.
+
+        :param str content: log contents
+    """
+    key = 'JOB_TELEMETRY'
+    _index_start = content.rfind(key)
+    if _index_start < 0:
+        return None
+    line = content[_index_start+len(key):].split('\n', 1)[0]
+    try:
+        return json.loads(line)
+    except:
+        logging.error("Could not parse job telemetry: %s", line)
+    return None
+
 def extract_multi_data_from_log(log_content):
     """
         Extract data block from a log. For simultaneous fits, an EXPT_START tag
@@ -9,7 +9,7 @@ import re
 import math
 import logging
 
-from .refl1d import parse_single_param
+from .refl1d import parse_single_param, index_error_output
 
 def find_error(layer_name, par_name, layer_dict, output_params):
     """
@@ -17,9 +17,10 @@ def find_error(layer_name, par_name, layer_dict, output_params):
         @param layer_name: name of the layer
         @param par_name: name of the parameter
         @param layer_dict: dictionary of layer parameters
-        @param output_params: list of fit output parameters
+        @param output_params: list of fit output parameters, or its index
 
         The output parameter list should be in the format: [ [parameter name, value, error], ... ]
+        or be the index returned by index_error_output().
     """
     # Because of constraints, the parameter name we are looking for
     # may not be in the layer dictionary. If it's not, find the right one.
@@ -37,15 +38,14 @@ def find_error(layer_name, par_name, layer_dict, output_params):
     value = float(layer_dict[long_name])
     error = 0
     _value = value
-    for par, val, err in output_params:
-        if par == long_name:
-            if value == 0:
-                diff = math.fabs(float(val))
-            else:
-                diff = math.fabs((float(val)-_value)/_value)
-            if diff < 0.001:
-                value = val
-                error = err
+    for val, err in index_error_output(output_params).get(long_name, []):
+        if value == 0:
+            diff = math.fabs(val)
+        else:
+            diff = math.fabs((val-_value)/_value)
+        if diff < 0.001:
+            value = val
+            error = err
     return value, error
 
 def update_parameter(output_name, layer_name, par_name, layer_dict,
@@ -77,6 +77,7 @@ def translate_model(refl_model, layers, output_params=None):
         See note below.
     """
     clean_layers = []
+    output_params = index_error_output(output_params)
     refl_model = update_parameter('scale', '', 'intensity', refl_model, output_params, **refl_model)
     refl_model = update_parameter('background', '', 'background', refl_model, output_params, **refl_model)
     for i in range(len(layers)):
@@ -196,6 +197,7 @@ def parse_slabs(content):
             model_list.append([refl_model, layers])
 
     # Add errors if they are available
+    output_params = index_error_output(output_params)
     clean_model_list = []
     for r_model, l_model in model_list:
         clean_model_list.append(translate_model(r_model, l_model, output_params))
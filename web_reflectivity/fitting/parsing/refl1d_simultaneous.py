@@ -5,10 +5,8 @@
 import json
 import re
 import logging
-from django.forms import model_to_dict
 
-from .refl1d import parse_single_param, extract_multi_json_from_log, update_model_from_dict
-from ..models import ReflectivityModel, ReflectivityLayer
+from .refl1d import parse_single_param, extract_multi_json_from_log, find_error, get_layer_parameter, round_, index_error_output
 
 
 class LayerList(list):
@@ -21,50 +19,117 @@ class LayerList(list):
         """ Emulate order_by() of a query set. """
         return self
 
-class DummyLayer(ReflectivityLayer):
-    """
-        Dummy layer defined to hold temporary model data
-    """
-    def save(self, *args, **kwargs):
-        """ Dummy save() method """
-        return
+
+def _pretty(value, error):
+    """ Return a value +- error string for display, or the value itself if there is no error """
+    return "%.4g &#177; %.4g" % (value, error) if error > 0 else value
 
 
-class DummyProblem(object):
+class LayerResult(object):
+    """
+        Fit result for a single layer, as read from the refl1d JSON output.
+    """
+    __slots__ = ['name', 'layer_number', 'thickness', 'thickness_error', 'sld', 'sld_error',
+                 'i_sld', 'i_sld_error', 'roughness', 'roughness_error']
+
+    def __init__(self, name, layer_number):
+        self.name = name
+        self.layer_number = layer_number
+        self.thickness = self.sld = self.i_sld = self.roughness = 0
+        self.thickness_error = self.sld_error = self.i_sld_error = self.roughness_error = 0
+
+    def to_dict(self, pretty_print=True):
+        """ Return a dict representation suitable for our templates """
+        _fmt = _pretty if pretty_print else lambda value, _: value
+        return dict(id=None, name=self.name, layer_number=self.layer_number,
+                    thickness=_fmt(self.thickness, self.thickness_error), thickness_error=self.thickness_error,
+                    sld=_fmt(self.sld, self.sld_error), sld_error=self.sld_error,
+                    i_sld=_fmt(self.i_sld, self.i_sld_error), i_sld_error=self.i_sld_error,
+                    roughness=_fmt(self.roughness, self.roughness_error), roughness_error=self.roughness_error)
+
+
+class ModelResult(object):
     """
-        Dummy FitProblem class used to read in JSON data and produce a dict
-        representation that we can feed our forms.
+        Lightweight, non-ORM, fit result read from the refl1d JSON output.
+        It mimics the parts of a FitProblem used to compute reflectivity curves:
+        it is its own reflectivity_model and its layers are held in a LayerList,
+        ordered from the backing medium to the front.
     """
-    def __init__(self, json_data, model_name):
-        self.reflectivity_model = ReflectivityModel(data_path=model_name)
+    __slots__ = ['data_path', 'q_min', 'q_max', 'scale', 'scale_error', 'background', 'background_error',
+                 'front_name', 'front_sld', 'front_sld_error', 'back_name', 'back_sld', 'back_sld_error',
+                 'back_roughness', 'back_roughness_error', 'layers']
+
+    def __init__(self, json_data, model_name, error_output=None):
+        """
+            :param dict json_data: dict extracted from the json section of the log
+            :param str model_name: name of the model
+            :param list error_output: list of parameters and values taken from the DREAM output
+        """
+        self.data_path = model_name
+        # The whole Q range is used for simultaneous fits
+        self.q_min = 0
+        self.q_max = 1
         self.layers = LayerList()
+        error_output = index_error_output(error_output)
+
+        def _read(par_dict, par_name, layer_name='', tolerance=0.001):
+            """ Return the rounded value and error of a fit parameter """
+            _value = par_dict['value']
+            _error = 0
+            if par_dict['fixed'] is False:
+                _value, _error = find_error(layer_name, par_name, _value, error_output, tolerance=tolerance)
+            return round_(_value), round_(_error)
+
+        probe = json_data['probe']
+        self.scale, self.scale_error = _read(probe['intensity'], 'intensity', tolerance=0.01)
+        self.background, self.background_error = _read(probe['background'], 'background', tolerance=0.01)
 
         # The refl1d JSON output is in reverse order. The first layer
         # in the list is actually the backing medium.
-        for i, layer in enumerate(json_data['sample']['layers']):
+        json_layers = json_data['sample']['layers']
+        for i, layer in enumerate(json_layers):
+            name = layer['name']
             if i == 0:
-                self.reflectivity_model.back_name = layer['name']
-            elif i == len(json_data['sample']['layers']) - 1:
-                self.reflectivity_model.front_name = layer['name']
+                self.back_name = name
+                self.back_sld, self.back_sld_error = _read(get_layer_parameter(layer, 'rho'), 'rho', name)
+                self.back_roughness, self.back_roughness_error = _read(layer['interface'], 'interface', name)
+            elif i == len(json_layers) - 1:
+                self.front_name = name
+                self.front_sld, self.front_sld_error = _read(get_layer_parameter(layer, 'rho'), 'rho', name)
             else:
-                self.layers.append(DummyLayer(name=layer['name'],layer_number=i))
-
-    def model_to_dicts(self):
-        """ Return a dict with all the data values """
-        refl_model_dict = model_to_dict(self.reflectivity_model)
-        model_layers = []
-        i = 0
-        for layer in self.layers.all():
-            i += 1
-            layer_dict = model_to_dict(layer)
-            # Start the ordering number at 1.
-            layer_dict['layer_number'] = len(self.layers)-i
-            model_layers.insert(0, layer_dict)
-        return [refl_model_dict, model_layers]
+                _layer = LayerResult(name, len(json_layers) - 2 - i)
+                _layer.thickness, _layer.thickness_error = _read(layer['thickness'], 'thickness', name)
+                _layer.sld, _layer.sld_error = _read(get_layer_parameter(layer, 'rho'), 'rho', name)
+                _layer.i_sld, _layer.i_sld_error = _read(get_layer_parameter(layer, 'irho'), 'irho', name)
+                _layer.roughness, _layer.roughness_error = _read(layer['interface'], 'interface', name)
+                self.layers.append(_layer)
+
+    @property
+    def reflectivity_model(self):
+        """ Emulate the reflectivity_model attribute of a FitProblem """
+        return self
 
-    def save(self, *args, **kwargs):
-        """ Dummy save() method """
-        return
+    def model_to_dicts(self, pretty_print=True):
+        """
+            Return a dict with all the data values, and a list of layer dicts
+            ordered from the front to the back.
+            :param bool pretty_print: if True, the values will be turned into value +- error strings
+        """
+        _fmt = _pretty if pretty_print else lambda value, _: value
+        refl_model_dict = dict(id=None, data_path=self.data_path, q_min=self.q_min, q_max=self.q_max,
+                               scale=_fmt(self.scale, self.scale_error), scale_error=self.scale_error,
+                               background=_fmt(self.background, self.background_error),
+                               background_error=self.background_error,
+                               front_name=self.front_name,
+                               front_sld=_fmt(self.front_sld, self.front_sld_error),
+                               front_sld_error=self.front_sld_error,
+                               back_name=self.back_name,
+                               back_sld=_fmt(self.back_sld, self.back_sld_error),
+                               back_sld_error=self.back_sld_error,
+                               back_roughness=_fmt(self.back_roughness, self.back_roughness_error),
+                               back_roughness_error=self.back_roughness_error)
+        model_layers = [layer.to_dict(pretty_print=pretty_print) for layer in reversed(self.layers)]
+        return [refl_model_dict, model_layers]
 
 
 def check_compatibility(content):
@@ -76,18 +141,15 @@ def check_compatibility(content):
     """
     return content.find('REFL1D_VERSION') >= 0
 
-def json_to_fit_problem(json_data, model_name, error_output, pretty_print=False):
+def json_to_fit_problem(json_data, model_name, error_output):
     """
-        Turn a json representation of a model into a dictionary compatible with
-        our forms.
+        Turn a json representation of a model into a FitProblem-like object
+        that can be used both for display and to compute reflectivity curves.
         :param dict json_data: dict extracted from the json section of the log
         :param str model_name: name of the model
         :param list error_output: list of parameters and values taken from the DREAM output
-        :param bool pretty_print: if True, the value will be turned into a value +- error string
     """
-    problem = DummyProblem(json_data, model_name)
-    update_model_from_dict(problem, json_data, error_output, pretty_print=pretty_print)
-    return problem
+    return ModelResult(json_data, model_name, error_output)
 
 def parse_models_from_log(content):
     """
@@ -131,11 +193,12 @@ def parse_models_from_log(content):
                       len(model_list), len(model_names))
 
     # Add errors if they are available
+    error_params = index_error_output(error_params)
     clean_model_list = []
     problem_list = []
     for i, [_name, _json_model] in enumerate(model_list):
-        problem_list.append(json_to_fit_problem(_json_model, _name, error_params))
-        _problem = json_to_fit_problem(_json_model, _name, error_params, pretty_print=True)
+        _problem = json_to_fit_problem(_json_model, _name, error_params)
+        problem_list.append(_problem)
         refl_dict, layer_dict = _problem.model_to_dicts()
         refl_dict['chi2'] = chi2_per_model[i]
         clean_model_list.append([refl_dict, layer_dict])
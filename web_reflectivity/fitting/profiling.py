@@ -0,0 +1,121 @@
+#pylint: disable=bare-except, invalid-name, too-few-public-methods
+"""
+    On-demand request profiling.
+
+    Staff users can add ?profile to the URL of a page to profile the view
+    serving it with cProfile. The SQL queries made by the view are recorded too.
+    Streamed responses are produced in full while profiling, so that the work
+    done as their content is consumed is part of the profile.
+    The profile is stored as a RequestProfile, which is summarized in the admin,
+    where the statistics can be downloaded for pstats or snakeviz.
+"""
+from __future__ import absolute_import, division, print_function
+import re
+import sys
+import time
+import json
+import marshal
+import pstats
+import logging
+import cProfile
+import StringIO
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.utils.deprecation import MiddlewareMixin
+
+from .models import RequestProfile
+from .timing import record_queries, recorded_queries
+
+## Query string parameter asking for a profile
+QUERY_FLAG = 'profile'
+
+def group_queries(queries, limit=20):
+    """
+        Group SQL queries that only differ by their literal values,
+        and return the groups taking the most time, as a list of dictionaries
+        :param list queries: queries, as recorded in connection.queries_log
+        :param int limit: maximum number of groups to return
+    """
+    groups = {}
+    for query in queries:
+        statement = re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", '?', query['sql'])
+        count, total = groups.get(statement, (0, 0.0))
+        groups[statement] = (count + 1, total + float(query['time']))
+    ordered = sorted(groups.items(), key=lambda item: item[1][1], reverse=True)
+    return [dict(sql=sql, count=count, time=total) for sql, (count, total) in ordered[:limit]]
+
+def function_summary(stats, limit=40):
+    """
+        Return the functions taking the most cumulative time, as printed by pstats
+        :param Stats stats: profile statistics
+        :param int limit: maximum number of functions to list
+    """
+    stream = StringIO.StringIO()
+    stats.stream = stream
+    stats.sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+def store_profile(request, status, profiler, queries, total_time):
+    """
+        Store the profile of a request, and keep only the latest PROFILE_HISTORY profiles
+        :param Request request: request that was profiled
+        :param int status: status code of the response, 500 if the view raised an exception
+        :param Profile profiler: profiler that ran the view
+        :param list queries: SQL queries made by the view
+        :param float total_time: time taken by the view, in seconds
+    """
+    stats = pstats.Stats(profiler)
+    profile = RequestProfile.objects.create(user=request.user, method=request.method,
+                                            path=request.get_full_path(), status=status,
+                                            total_time=total_time, python_time=stats.total_tt,
+                                            n_queries=len(queries),
+                                            sql_time=sum([float(query['time']) for query in queries]),
+                                            queries=json.dumps(group_queries(queries)),
+                                            stats=marshal.dumps(stats.stats),
+                                            functions=function_summary(stats))
+    history = getattr(settings, 'PROFILE_HISTORY', 100)
+    stale = RequestProfile.objects.order_by('-timestamp', '-id').values_list('id', flat=True)[history:]
+    RequestProfile.objects.filter(id__in=list(stale)).delete()
+    return profile
+
+def _call_view(view_func, request, view_args, view_kwargs):
+    """ Call a view, including the rendering of its template and the content of streamed responses """
+    response = view_func(request, *view_args, **view_kwargs)
+    # Template responses are otherwise rendered after the middleware
+    if hasattr(response, 'render') and callable(response.render):
+        response = response.render()
+    if getattr(response, 'streaming', False):
+        response.streaming_content = list(response.streaming_content)
+    return response
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """
+        Profile the view serving a request when a staff user adds ?profile to its URL.
+        It comes last in MIDDLEWARE_CLASSES, so that only the view is profiled.
+        The admin page of the stored profile is given in the X-Profile header.
+    """
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """ Call the view with the profiler if a profile was asked for """
+        user = getattr(request, 'user', None)
+        if QUERY_FLAG not in request.GET or user is None or not user.is_staff:
+            return None
+
+        query_state = record_queries()
+        profiler = cProfile.Profile()
+        status = 500
+        profile = None
+        t_0 = time.time()
+        try:
+            response = profiler.runcall(_call_view, view_func, request, view_args, view_kwargs)
+            status = response.status_code
+        finally:
+            total_time = time.time() - t_0
+            queries = recorded_queries(query_state)
+            try:
+                profile = store_profile(request, status, profiler, queries, total_time)
+            except:
+                logging.error("Could not store the profile of %s: %s", request.path, sys.exc_value)
+        if profile is not None:
+            response['X-Profile'] = reverse('admin:fitting_requestprofile_change', args=(profile.id,))
+        return response
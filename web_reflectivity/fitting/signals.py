@@ -0,0 +1,14 @@
+"""
+    Signals sent by the fitting application, so that monitoring code
+    can follow what the application does without being called directly.
+"""
+from django.dispatch import Signal
+
+## Sent when an instrumented call site returns, with its name and duration in seconds
+call_timed = Signal(providing_args=['name', 'duration'])
+
+## Sent when a cache is looked up, with the name of the cache and whether the entry was found
+cache_lookup = Signal(providing_args=['cache', 'hit'])
+
+## Sent when a job is queued for submission to the compute host
+job_queued = Signal(providing_args=['job'])
@@ -5,12 +5,13 @@
 import sys
 import logging
 import io
-import pandas
 import numpy as np
+from django.conf import settings
+from django.core.cache import cache
 from django_remote_submission.models import Log
 from ..models import SimultaneousModel, SimultaneousFit
 from ..parsing import refl1d_err_model, refl1d, refl1d_simultaneous
-from .. import view_util, job_handling, data_server
+from .. import view_util, job_handling, data_server, signals
 
 def get_simultaneous_models(request, fit_problem, setup_request=False):
     """
@@ -72,61 +73,102 @@ def get_simultaneous_models(request, fit_problem, setup_request=False):
 
     return model_list, error_list, chi2, fit_exists, can_update, fitproblem_list
 
-def assemble_plots(request, fit_problem, result_fitproblems=None):
+def assemble_plots(request, fit_problem, result_fitproblems=None, as_json=False, encoding='list', rq4=None):
     """
         Find all that needs to be plotted for this fit problem.
+        Plots of fit results are cached, and the cache is checked before the data is retrieved.
 
         :param Request request: http request object
         :param FitProblem fit_problem: FitProblem object
         :param list result_fitproblems: list of FitProblem-like objects
+        :param bool as_json: if True, return a list of figure dictionaries instead of html
+        :param str encoding: encoding of the numerical arrays when returning figures
+        :param bool rq4: if True, the plot will be in R*Q^4 [default: the session's choice]
     """
-    r_plot = ""
+    figures = []
+    encoding = encoding if as_json else None
     # Check whether we need to change the y-axis scale
-    rq4 = request.session.get('rq4', False)
+    if rq4 is None:
+        rq4 = request.session.get('rq4', False)
 
+    cache_key = None
     if result_fitproblems is not None:
-        data_list, data_names, sld_list, sld_names = create_plots_from_fit_problem(result_fitproblems, rq4)
+        # The results come from the log of the simultaneous fit
+        data_paths = [problem.reflectivity_model.data_path for problem in result_fitproblems]
+        job_list = SimultaneousFit.objects.filter(fit_problem=fit_problem).values_list('remote_job_id', flat=True)
+        cache_key = view_util.assembled_plots_key(data_paths, [fit_problem], list(job_list), simultaneous=True,
+                                                  rq4=rq4, as_json=as_json, encoding=encoding)
+        cached = cache.get(cache_key)
+        signals.cache_lookup.send_robust(sender=SimultaneousFit, cache='plots', hit=cached is not None)
+        if cached is not None:
+            return cached
+        html_list = fetch_plot_data(result_fitproblems)
+        data_list, data_names, sld_list, sld_names = create_plots_from_fit_problem(result_fitproblems, rq4, html_list)
     else:
         data_list, data_names, sld_list, sld_names = create_plots_from_legacy_log(request, fit_problem)
 
     y_title = u"Reflectivity x Q<sup>4</sup> (1/A<sup>4</sup>)" if rq4 else u"Reflectivity"
+    # Plots are only downsampled for display
+    max_points = getattr(settings, 'PLOT_MAX_POINTS', 1000)
 
     if len(data_list) > 0:
-        r_plot = view_util.plot1d(data_list, data_names=data_names, x_title=u"Q (1/A)", y_title=y_title)
+        figures.append(view_util.plot1d_figure(data_list, data_names=data_names, x_title=u"Q (1/A)",
+                                               y_title=y_title, encoding=encoding, max_points=max_points))
+        if as_json and not rq4:
+            view_util.add_rq4_titles(figures[0])
 
     # Compute asymmetry
     if len(data_list) == 4:
-        asym_data = compute_asymmetry(data_list[0], data_list[2])
-        asym_theory = compute_asymmetry(data_list[1], data_list[3])
-        chi2_asym = np.sum(np.sqrt((asym_data[1]-asym_theory[1])**2/asym_data[2]**2))/len(asym_data[0])
-        extra_plot = view_util.plot1d([asym_data, asym_theory],
-                                      x_log=True, y_log=False,
-                                      data_names=[u'(r1 - r2) / r1', u'Fit [chi^2 = %2.2g]' % chi2_asym],
-                                      x_title=u"Q (1/A)", y_title=u'Asymmetry')
-        r_plot = "<div>%s</div><div>%s</div>" % (r_plot, extra_plot)
+        asym_data, asym_theory = compute_asymmetries(data_list, pairs=[(0, 2), (1, 3)])
+        # The theory may be computed over a sub-range of Q, so compare matching points only
+        i_data, i_theory = match_q_values(asym_data[0], asym_theory[0])
+        chi2_asym = np.sum(np.sqrt((asym_data[1][i_data]-asym_theory[1][i_theory])**2/asym_data[2][i_data]**2))/max(len(i_data), 1)
+        figures.append(view_util.plot1d_figure([asym_data, asym_theory],
+                                               x_log=True, y_log=False,
+                                               data_names=[u'(r1 - r2) / r1', u'Fit [chi^2 = %2.2g]' % chi2_asym],
+                                               x_title=u"Q (1/A)", y_title=u'Asymmetry', encoding=encoding,
+                                               max_points=max_points))
 
     if len(sld_list) > 0:
-        extra_plot = view_util.plot1d(sld_list, x_log=False, y_log=False,
-                                      data_names=sld_names, x_title=u"Z (A)",
-                                      y_title=u'SLD (10<sup>-6</sup>/A<sup>2</sup>)')
-        r_plot = "<div>%s</div><div>%s</div>" % (r_plot, extra_plot)
+        figures.append(view_util.plot1d_figure(sld_list, x_log=False, y_log=False,
+                                               data_names=sld_names, x_title=u"Z (A)",
+                                               y_title=u'SLD (10<sup>-6</sup>/A<sup>2</sup>)', encoding=encoding,
+                                               max_points=max_points))
 
-    return r_plot
+    output = figures if as_json else view_util.render_figures(figures)
+    if cache_key is not None:
+        cache.set(cache_key, output, view_util.plot_cache_timeout(request, data_paths))
+    return output
 
-def create_plots_from_fit_problem(problem_list, rq4=False):
+def fetch_plot_data(problem_list):
+    """
+        Retrieve the data for a set of FitProblem-like objects.
+        Returns a list with the stored plot data for each problem, or None if the data was not found.
+        :param list problem_list: list of FitProblem-like objects
+    """
+    html_list = []
+    for problem in problem_list:
+        instrument, data_id = view_util.parse_data_path(problem.reflectivity_model.data_path)
+        html_list.append(data_server.data_handler.get_plot_data_from_server(instrument, data_id))
+    return html_list
+
+def create_plots_from_fit_problem(problem_list, rq4=False, html_list=None):
     """
         Create reflectivity and SLD plots from a set of FitProblem-like objects.
         :param list problem_list: list of FitProblem-like objects
         :param bool rq4: if True, we plot R*Q^4
+        :param list html_list: plot data for each problem, as returned by fetch_plot_data()
     """
+    # pandas is slow to import, so it is only loaded when plotting
+    import pandas
+    if html_list is None:
+        html_list = fetch_plot_data(problem_list)
     data_list = []
     data_names = []
     sld_list = []
     sld_names = []
-    for problem in problem_list:
-        instrument, data_id = view_util.parse_data_path(problem.reflectivity_model.data_path)
+    for problem, html_data in zip(problem_list, html_list):
         # If we have the data, compute the theory curve and return it
-        html_data = data_server.data_handler.get_plot_data_from_server(instrument, data_id)
         if html_data is not None:
             current_str = io.StringIO(view_util.extract_ascii_from_div(html_data))
             current_data = pandas.read_csv(current_str, delim_whitespace=True, comment='#', names=['q','r','dr','dq'])
@@ -163,6 +205,8 @@ def create_plots_from_legacy_log(request, fit_problem):
     """
         Legacy log parsing code. Only used when we encounter an old log.
     """
+    # pandas is slow to import, so it is only loaded when plotting
+    import pandas
     data_list = []
     data_names = []
     sld_list = []
@@ -198,35 +242,68 @@ def create_plots_from_legacy_log(request, fit_problem):
     return data_list, data_names, sld_list, sld_names
 # --------------------------------------------------------------------------------------
 
-def compute_asymmetry(data_1, data_2):
+def match_q_values(q_1, q_2, tolerance=0.0001):
+    """
+        Find the pairs of points of two Q arrays that are within a given tolerance.
+        Each point of the first array is matched with the closest point of the
+        second array. Returns two arrays of indices, one for each input array.
+
+        :param array q_1: first array of Q values
+        :param array q_2: second array of Q values
+        :param float tolerance: maximum distance between two matched Q values
+    """
+    q_1 = np.asarray(q_1, dtype=float)
+    q_2 = np.asarray(q_2, dtype=float)
+    if len(q_1) == 0 or len(q_2) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    order = np.argsort(q_2, kind='mergesort')
+    q_sorted = q_2[order]
+
+    # For each point of q_1, the closest point of q_2 is on either side of its insertion point
+    upper = np.clip(np.searchsorted(q_sorted, q_1), 0, len(q_sorted) - 1)
+    lower = np.clip(upper - 1, 0, len(q_sorted) - 1)
+    use_lower = np.fabs(q_1 - q_sorted[lower]) <= np.fabs(q_sorted[upper] - q_1)
+    closest = np.where(use_lower, lower, upper)
+
+    matched = np.fabs(q_1 - q_sorted[closest]) < tolerance
+    return np.nonzero(matched)[0], order[closest[matched]]
+
+def compute_asymmetry(data_1, data_2, tolerance=0.0001):
     """
         Compute asymmetry between two data sets.
 
         :param array data_1: data array
         :param array data_2: data array
+        :param float tolerance: maximum distance between two Q values to consider them equal
+    """
+    i_1, i_2 = match_q_values(data_1[0], data_2[0], tolerance=tolerance)
+    q1 = np.asarray(data_1[0], dtype=float)[i_1]
+    r1 = np.asarray(data_1[1], dtype=float)[i_1]
+    r2 = np.asarray(data_2[1], dtype=float)[i_2]
+    with_errors = len(data_1) == 3 and len(data_2) == 3
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        asym = (r1 - r2) / r1
+        valid = np.isfinite(asym)
+        if with_errors:
+            dr1 = np.asarray(data_1[2], dtype=float)[i_1]
+            dr2 = np.asarray(data_2[2], dtype=float)[i_2]
+            asym_err = np.sqrt(dr2**2/r1**2 + r2**2*dr1**2/r1**4)
+            valid = valid & np.isfinite(asym_err)
+            return [q1[valid], asym[valid], asym_err[valid]]
+    # Skip bad points
+    return [q1[valid], asym[valid]]
+
+def compute_asymmetries(data_list, pairs=None, tolerance=0.0001):
+    """
+        Compute the asymmetry for several pairs of data sets.
+
+        :param list data_list: list of data arrays
+        :param list pairs: list of (i, j) index pairs in data_list. By default,
+                           consecutive data sets are paired: (0, 1), (2, 3), ...
+        :param float tolerance: maximum distance between two Q values to consider them equal
     """
-    asym_q = []
-    asym_values = []
-    asym_errors = []
-
-    q1, r1 = data_1[0], data_1[1]
-    q2, r2 = data_2[0], data_2[1]
-    dr1 = data_1[2] if len(data_1) == 3 else None
-    dr2 = data_2[2] if len(data_2) == 3 else None
-
-    for i in range(len(q1)):
-        for j in range(len(q2)):
-            if np.fabs(q1[i] - q2[j]) < 0.0001:
-                try:
-                    asym = (r1[i] - r2[j]) / r1[i]
-                    if dr1 is not None and dr2 is not None:
-                        asym_err = np.sqrt(dr2[j]**2/r1[i]**2 + r2[j]**2*dr1[i]**2/r1[i]**4)
-                    asym_q.append(q1[i])
-                    asym_values.append(asym)
-                    asym_errors.append(asym_err)
-                except:
-                    # Bad point, skip it
-                    pass
-    if len(asym_errors) == len(asym_q):
-        return [np.asarray(asym_q), np.asarray(asym_values), np.asarray(asym_errors)]
-    return [np.asarray(asym_q), np.asarray(asym_values)]
+    if pairs is None:
+        pairs = [(i, i + 1) for i in range(0, len(data_list) - 1, 2)]
+    return [compute_asymmetry(data_list[i], data_list[j], tolerance=tolerance) for i, j in pairs]
@@ -1,18 +1,43 @@
 """
     Test cases for the fitting application
 """
+import sys
+import os
+import io
+import time
 import json
+import base64
+import marshal
+import shutil
+import logging
 import tempfile
-from django.test import TestCase
-from django.test import Client
+import zipfile
+import unittest
+import subprocess
+import numpy as np
+try:
+    import h5py
+except ImportError:
+    h5py = None
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.test import Client, RequestFactory
 from django.contrib.auth.models import User
 from django.forms import model_to_dict
+from django.core.cache import cache
+from django_remote_submission.models import Server, Interpreter, Job, Log
+from channels.test import ChannelTestCase
 
-from .models import FitterOptions, UserData, FitProblem, SavedModelInfo, SimultaneousModel, Constraint, SimultaneousConstraint
+from .models import FitterOptions, UserData, FitProblem, SavedModelInfo, SimultaneousModel, Constraint, SimultaneousConstraint, JobTelemetry
+from .models import RequestProfile
 from .data_server import data_handler as dh
 from . import view_util
 from . import forms
 from . import job_handling
+from . import timing
+from . import metrics
+from . import signals
+from . import data_readers
 from .parsing import refl1d, refl1d_err_model, refl1d_simultaneous
 from .simultaneous import model_handling
 
@@ -83,6 +108,172 @@ class FileTestCase(TestCase):
         # Error message list should be empty
         self.assertEqual(response.context['user_alert'], [])
 
+    def test_large_file(self):
+        """ Upload a file larger than 1 MB, without a resolution column """
+        q = np.linspace(0.005, 0.2, 50000)
+        fp = tempfile.TemporaryFile()
+        fp.write(b'# Q R dR\n')
+        np.savetxt(fp, np.asarray([q, np.exp(-10 * q), 0.01 * np.exp(-10 * q)]).T)
+        self.assertTrue(fp.tell() > 1024 * 1024)
+        fp.seek(0)
+        response = self.client.post('/fit/files/', {'name': 'large_data.txt', 'file': fp})
+        self.assertEqual(response.status_code, 302)
+
+        # The stored data keeps every point, with a 3% resolution
+        user_data = UserData.objects.get(user=self.user)
+        html_data = dh.get_plot_data_from_server('john', user_data.file_id)
+        data = np.loadtxt(view_util.extract_ascii_from_div(html_data).splitlines())
+        self.assertEqual(data.shape, (50000, 4))
+        self.assertTrue(np.allclose(data[:, 3], 0.03 * q, rtol=1e-5))
+
+        # Chunks are put back together
+        fp.seek(0)
+        q_read, _, _, dq_read = view_util.read_ascii_data(fp, chunk_size=777)
+        self.assertEqual(len(q_read), 50000)
+        self.assertTrue(np.allclose(dq_read, 0.03 * q))
+
+    def test_multiple_upload(self):
+        """ Upload several files and archives in one request """
+        import zipfile
+        import tarfile
+        with open('test_data.txt') as fd:
+            content = fd.read()
+        zip_file = tempfile.NamedTemporaryFile(suffix='.zip')
+        with zipfile.ZipFile(zip_file, 'w') as archive:
+            archive.writestr('data/run_1.txt', content)
+            archive.writestr('data/run_2.txt', content)
+            archive.writestr('__MACOSX/data/._run_1.txt', 'skipped')
+        zip_file.seek(0)
+        tar_file = tempfile.NamedTemporaryFile(suffix='.tar.gz')
+        with tarfile.open(fileobj=tar_file, mode='w:gz') as archive:
+            for name, data in [('run_3.txt', content), ('bad.txt', 'bad data')]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        tar_file.seek(0)
+
+        with open('test_data.txt') as fp:
+            response = self.client.post('/fit/files/', {'file': [fp, zip_file, tar_file]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['user_alert'], ['Loaded 4 of 5 files', 'Could not parse data file bad.txt'])
+        self.assertEqual(sorted(UserData.objects.filter(user=self.user).values_list('file_name', flat=True)),
+                         ['run_1.txt', 'run_2.txt', 'run_3.txt', 'test_data.txt'])
+        # The new files show up in the list
+        self.assertEqual(len(json.loads(response.context['file_list'])), 4)
+
+        # Uploading a file again doesn't create a new entry
+        with open('test_data.txt') as fp:
+            response = self.client.post('/fit/files/', {'file': fp})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(UserData.objects.filter(user=self.user).count(), 4)
+
+    def test_archive_size(self):
+        """ The extracted content of an archive is limited to MAX_UPLOAD_SIZE """
+        zip_file = tempfile.NamedTemporaryFile(suffix='.zip')
+        with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('run_1.txt', b'0' * 500000)
+        zip_file.seek(0)
+        zip_file.size = os.path.getsize(zip_file.name)
+        with override_settings(MAX_UPLOAD_SIZE=100000):
+            data_files, errors = view_util.expand_uploads([zip_file])
+        self.assertEqual(data_files, [])
+        self.assertEqual(errors, ['Could not read archive %s' % zip_file.name])
+
+    def test_orso_file(self):
+        """ Upload an ORSO text file with two data sets """
+        orso_data = b"""# # ORSO reflectivity data file | 1.0 standard | YAML encoding | https://www.reflectometry.org/
+# data_source:
+#   experiment: {instrument: REF_L}
+# data_set: spin_up
+# columns:
+# - {name: Qz, unit: 1/nm, physical_quantity: normal_wavevector_transfer}
+# - {name: R, physical_quantity: reflectivity}
+# - {name: sR, error_of: R}
+# - {name: sQz, error_of: Qz, error_type: uncertainty, value_is: sigma}
+# # Qz (1/nm)    R    sR    sQz
+0.1 1.0 0.1 0.01
+0.2 0.5 0.05 0.02
+0.3 0.25 0.025 0.03
+# data_set: spin_down
+# # Qz (1/nm)    R    sR    sQz
+0.1 0.9 0.1 0.01
+0.2 0.4 0.05 0.02
+"""
+        data_sets = view_util.read_data_file('test.ort', orso_data)
+        self.assertEqual([item[0] for item in data_sets], ['test.ort [spin_up]', 'test.ort [spin_down]'])
+        q, r, dr, dq = data_sets[0][1]
+        self.assertTrue(np.allclose(q, [0.01, 0.02, 0.03]))
+        # The resolution is given as a standard deviation, and stored as a FWHM
+        self.assertTrue(np.allclose(dq, 2.3548 * np.asarray([0.001, 0.002, 0.003]), rtol=1e-4))
+        self.assertEqual(len(data_sets[1][1][0]), 2)
+        fwhm_data = orso_data.replace(b"value_is: sigma", b"value_is: FWHM")
+        _, _, _, dq = view_util.read_data_file('test.ort', fwhm_data)[0][1]
+        self.assertTrue(np.allclose(dq, [0.001, 0.002, 0.003]))
+
+        # Small chunks give the same result
+        fp = io.BytesIO(orso_data)
+        chunked = data_readers.read_orso_text(fp, chunk_size=2)
+        self.assertTrue(np.allclose(chunked[0][1], q))
+
+        fp = tempfile.NamedTemporaryFile(suffix='.ort')
+        fp.write(orso_data)
+        fp.seek(0)
+        response = self.client.post('/fit/files/', {'file': fp})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(UserData.objects.filter(user=self.user).count(), 2)
+
+    @unittest.skipIf(h5py is None, "h5py is not installed")
+    def test_hdf5_file(self):
+        """ Read an HDF5 file with ORSO-like data sets """
+        fd, file_path = tempfile.mkstemp(suffix='.orb')
+        os.close(fd)
+        try:
+            with h5py.File(file_path, 'w') as h5_file:
+                for name in ['up', 'down']:
+                    group = h5_file.create_group(name).create_group('data')
+                    group.create_dataset('Qz', data=np.linspace(0.1, 1, 10)).attrs['units'] = '1/nm'
+                    group.create_dataset('R', data=np.ones(10), compression='gzip')
+                    group.create_dataset('sR', data=0.1 * np.ones(10))
+                h5_file['up/data'].create_dataset('sQz', data=0.001 * np.ones(10)).attrs['units'] = '1/nm'
+            with open(file_path, 'rb') as fp:
+                data_sets = view_util.read_data_file('test.orb', io.BytesIO(fp.read()))
+            self.assertEqual([item[0] for item in data_sets], ['test.orb [down/data]', 'test.orb [up/data]'])
+            q, r, _, dq = data_sets[0][1]
+            self.assertTrue(np.allclose(q, np.linspace(0.01, 0.1, 10)))
+            self.assertTrue(np.allclose(r, 1))
+            self.assertTrue(np.allclose(dq, 0.03 * q))
+            # The standard deviation is stored as a FWHM
+            self.assertTrue(np.allclose(data_sets[1][1][3], 2.3548e-4, rtol=1e-4))
+            # The arrays read are limited in size
+            self.assertRaises(ValueError, data_readers.read_hdf5, file_path, 500)
+        finally:
+            os.remove(file_path)
+
+    @unittest.skipIf(h5py is None, "h5py is not installed")
+    def test_mantid_file(self):
+        """ Read a Mantid processed NeXus file with a histogram workspace """
+        fd, file_path = tempfile.mkstemp(suffix='.nxs')
+        os.close(fd)
+        try:
+            with h5py.File(file_path, 'w') as h5_file:
+                group = h5_file.create_group('mantid_workspace_1').create_group('workspace')
+                group.create_dataset('values', data=np.ones((1, 10)))
+                group.create_dataset('errors', data=0.1 * np.ones((1, 10)))
+                group.create_dataset('axis1', data=np.linspace(0.01, 0.11, 11)).attrs['units'] = b'MomentumTransfer'
+                group.create_dataset('axis2', data=np.zeros(1)).attrs['units'] = b'SpectraNumber'
+                group.create_dataset('xerrors', data=0.002 * np.ones((1, 10)))
+            with open(file_path, 'rb') as fp:
+                data_sets = view_util.read_data_file('test.nxs', io.BytesIO(fp.read()))
+            self.assertEqual(len(data_sets), 1)
+            self.assertEqual(data_sets[0][0], 'test.nxs')
+            q, r, dr, dq = data_sets[0][1]
+            self.assertTrue(np.allclose(q, np.linspace(0.015, 0.105, 10)))
+            self.assertTrue(np.allclose(r, 1))
+            self.assertTrue(np.allclose(dr, 0.1))
+            self.assertTrue(np.allclose(dq, 0.002))
+        finally:
+            os.remove(file_path)
+
     def test_bad_file(self):
         """ Test the upload of a badly formatted file """
         # Create a temporary file
@@ -214,6 +405,52 @@ class SimultaneousViewsTestCase(TestCase):
         data_script = job_handling.assemble_data_setup([['john/1', ['0.01, 1., 0.1']], ['john/2', ['0.01, 1., 0.1']]])
         script = job_handling.assemble_job('# test', data_script, ['exp1', 'exp2'], ['john/1','john/2'], {}, '/tmp', '/tmp')
         self.assertTrue("problem = FitProblem([exp1,exp2])" in script)
+        self.assertTrue("n_models=len([\"john/1\",\"john/2\"])" in script)
+        compile(script, 'job.py', 'exec')
+
+    def test_corefinement_script(self):
+        """ Generate the script for a 10-data-set co-refinement """
+        n_data = 10
+        data_list = [['/tmp/__data%s.txt' % i, '0.01 1.0 0.1 0.001'] for i in range(n_data)]
+        expt_names = ['expt%s' % i for i in range(n_data)]
+        data_ids = ['john/%s' % i for i in range(n_data)]
+
+        data_template = job_handling.get_template('simultaneous_data.py.template')
+        t_0 = time.time()
+        for _ in range(100):
+            data_script = job_handling.assemble_data_setup(data_list)
+            script = job_handling.assemble_job('# test', data_script, expt_names, data_ids, {}, '/tmp', '/tmp')
+        elapsed = (time.time() - t_0) / 100.0
+        logging.info("Co-refinement script for %s data sets: %g ms", n_data, 1000.0 * elapsed)
+
+        self.assertEqual(data_script.count('data_file = "/tmp/__data'), n_data)
+        self.assertTrue("problem = FitProblem([%s])" % ','.join(expt_names) in script)
+        # The compiled template is reused from one call to the next
+        self.assertTrue(job_handling.get_template('simultaneous_data.py.template') is data_template)
+
+    def test_template_reload(self):
+        """ In debug mode, a modified template is reloaded """
+        template_dir = tempfile.mkdtemp()
+        template_path = os.path.join(template_dir, 'test.template')
+        original_dir = job_handling.TEMPLATE_DIR
+        job_handling.TEMPLATE_DIR = template_dir
+        try:
+            with open(template_path, 'w') as fd:
+                fd.write('first ${VALUE}')
+            first = job_handling.get_template('test.template')
+            self.assertEqual(first.substitute(VALUE=1), 'first 1')
+
+            with open(template_path, 'w') as fd:
+                fd.write('second ${VALUE}')
+            os.utime(template_path, (0, 0))
+            with self.settings(DEBUG=False):
+                self.assertTrue(job_handling.get_template('test.template') is first)
+            with self.settings(DEBUG=True):
+                self.assertEqual(job_handling.get_template('test.template').substitute(VALUE=1), 'second 1')
+        finally:
+            job_handling.TEMPLATE_DIR = original_dir
+            job_handling._TEMPLATE_CACHE.pop('test.template', None)
+            shutil.rmtree(template_dir)
 
     def test_asymmetry(self):
         """ Test asymmetry code """
@@ -222,6 +459,52 @@ class SimultaneousViewsTestCase(TestCase):
         result = model_handling.compute_asymmetry(d1, d2)
         self.assertEqual(result[1][0], -2)
 
+    def test_asymmetry_large(self):
+        """ Compare the sorted-merge asymmetry with a direct pairwise comparison """
+        q1 = np.logspace(-2, -0.7, 2000)
+        # Shuffled grid with half of the points shifted beyond the tolerance
+        q2 = q1.copy()
+        q2[::2] += 0.001
+        np.random.seed(42)
+        order = np.random.permutation(len(q2))
+        q2 = q2[order]
+        r1 = np.exp(-q1 * 10)
+        r2 = np.exp(-q2 * 12)
+        d1 = [q1, r1, 0.1 * r1]
+        d2 = [q2, r2, 0.1 * r2]
+
+        t_0 = time.time()
+        result = model_handling.compute_asymmetry(d1, d2)
+        logging.info("Asymmetry for 2 x %s points: %g ms", len(q1), 1000.0 * (time.time() - t_0))
+
+        expected_q = []
+        expected_asym = []
+        for i in range(len(q1)):
+            j = np.argmin(np.fabs(q2 - q1[i]))
+            if np.fabs(q1[i] - q2[j]) < 0.0001:
+                expected_q.append(q1[i])
+                expected_asym.append((r1[i] - r2[j]) / r1[i])
+        self.assertTrue(0 < len(result[0]) < 2000)
+        np.testing.assert_allclose(result[0], expected_q)
+        np.testing.assert_allclose(result[1], expected_asym)
+
+        # With a looser tolerance, every point finds a partner
+        result = model_handling.compute_asymmetry(d1, d2, tolerance=0.01)
+        self.assertEqual(len(result[0]), 2000)
+
+    def test_asymmetry_pairs(self):
+        """ Compute the asymmetry of several pairs of data sets """
+        q = np.asarray([0.1, 0.2, 0.3])
+        data_list = [[q, np.asarray([1.0, 1.0, 0.0])], [q, np.asarray([0.5, 2.0, 1.0])],
+                     [q, np.asarray([2.0, 2.0, 2.0])], [q, np.asarray([1.0, 1.0, 1.0])]]
+        result = model_handling.compute_asymmetries(data_list)
+        self.assertEqual(len(result), 2)
+        # The point with r1 = 0 is skipped and theory curves have no errors
+        self.assertEqual(len(result[0]), 2)
+        np.testing.assert_allclose(result[0][1], [0.5, -1.0])
+        result = model_handling.compute_asymmetries(data_list, pairs=[(2, 0)])
+        np.testing.assert_allclose(result[0][1], [0.5, 0.5, 1.0])
+
     def test_simultaneous_view(self):
         """ Test simultaneous view """
         response = self.client.get('/fit/john/1/simultaneous/')
@@ -234,6 +517,50 @@ class SimultaneousViewsTestCase(TestCase):
         script = items[0].get_constraint(sample_name='sample')
         self.assertEqual(script, "sample1['material'].material.rho = sample2['material'].material.rho")
 
+    def test_simultaneous_plots(self):
+        """ JSON plot payload for a simultaneous fit """
+        response = self.client.get('/fit/john/1/simultaneous/plots/', {'encoding': 'base64'})
+        self.assertEqual(response.status_code, 200)
+        payload = json.loads(response.content)
+        # There are no fit results yet
+        self.assertEqual(payload['plots'], [])
+        self.assertEqual(payload['chi2'], None)
+
+        request = RequestFactory().get('/fit/john/1/simultaneous/')
+        request.session = {}
+        fit_problem = FitProblem.objects.get(user=self.user, data_path='john/1')
+        figures = model_handling.assemble_plots(request, fit_problem, [fit_problem], as_json=True, encoding='float32')
+        # Reflectivity and SLD, with the data and the theory curve
+        self.assertEqual(len(figures), 2)
+        self.assertEqual(len(figures[0]['data']), 2)
+        self.assertEqual(figures[0]['data'][0]['mode'], 'markers')
+        json.dumps(figures)
+        with override_settings(CLIENT_SIDE_PLOTS=True):
+            response = self.client.get('/fit/john/1/simultaneous/?setup=1')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue('/fit/john/1/simultaneous/plots/?setup=1' in response.content)
+
+    def test_constraint_graph(self):
+        """ Test that simultaneous constraints are resolved with a fixed number of queries """
+        fit_1 = FitProblem.objects.get(data_path='john/1')
+        fit_2 = FitProblem.objects.get(data_path='john/2')
+        layer_1 = fit_1.layers.all()[0]
+        layer_2 = fit_2.layers.all()[0]
+        for i in range(10):
+            SimultaneousConstraint.objects.create(user=self.user, fit_problem=fit_1,
+                                                  dependent_id=layer_2.id, dependent_parameter='thickness',
+                                                  variable_id=layer_1.id, variable_parameter='thickness')
+            SimultaneousConstraint.objects.create(user=self.user, fit_problem=fit_1,
+                                                  dependent_id=fit_2.reflectivity_model.id, dependent_parameter='back_sld',
+                                                  variable_id=fit_1.reflectivity_model.id, variable_parameter='front_sld')
+        constraints = list(SimultaneousConstraint.objects.all())
+        with self.assertNumQueries(4):
+            scripts = SimultaneousConstraint.get_constraints(constraints)
+        self.assertEqual(len(scripts), 20)
+        self.assertEqual(scripts[0], "sample%s['material'].thickness = sample%s['material'].thickness" % (fit_2.id, fit_1.id))
+        self.assertEqual(scripts[1], "sample%s['Si'].material.rho = sample%s['air'].material.rho" % (fit_2.id, fit_1.id))
+        self.assertEqual(scripts, [item.get_constraint() for item in constraints])
+
 class FitProblemViewsTestCase(TestCase):
     """ Test functionality related to fits """
     def setUp(self):
@@ -271,10 +598,186 @@ class FitProblemViewsTestCase(TestCase):
         response = self.client.get('/fit/john/1/')
         self.assertEqual(response.status_code, 200)
 
+    def test_plot_payload(self):
+        """ JSON plot payloads, in each encoding """
+        payloads = {}
+        for encoding in view_util.PLOT_ENCODINGS:
+            response = self.client.get('/fit/john/1/plots/', {'encoding': encoding})
+            self.assertEqual(response.status_code, 200)
+            payloads[encoding] = json.loads(response.content)
+        # One reflectivity plot and one SLD plot
+        self.assertEqual(len(payloads['list']['plots']), 2)
+        trace = payloads['list']['plots'][0]['data'][0]
+        self.assertEqual(trace['type'], 'scatter')
+        self.assertEqual(payloads['list']['plots'][0]['layout']['yaxis']['type'], 'log')
+
+        r_values = np.asarray(trace['y'])
+        packed = payloads['base64']['plots'][0]['data'][0]['y']
+        self.assertEqual(packed['dtype'], 'float32')
+        unpacked = np.frombuffer(base64.b64decode(packed['bdata']), dtype='<f4')
+        self.assertTrue(np.allclose(unpacked, r_values, rtol=1e-6))
+        rounded = np.asarray(payloads['float32']['plots'][0]['data'][0]['y'])
+        self.assertTrue(np.allclose(rounded, r_values, rtol=1e-6))
+        self.assertTrue(len(json.dumps(payloads['float32'])) < len(json.dumps(payloads['list'])))
+
+        # R is sent unscaled, for the browser to apply the Q^4 scaling
+        self.assertEqual(payloads['list']['plots'][0]['r_title'], 'Reflectivity')
+        self.assertTrue('rq4_title' in payloads['list']['plots'][0])
+        self.assertFalse('rq4_title' in payloads['list']['plots'][1])
+        response = self.client.get('/fit/john/1/plots/', {'encoding': 'list', 'rq4': '1'})
+        scaled = json.loads(response.content)['plots'][0]
+        self.assertFalse('rq4_title' in scaled)
+        self.assertTrue(np.allclose(scaled['data'][0]['y'], r_values * np.asarray(trace['x'])**4))
+
+        # Non-finite values are not valid JSON
+        self.assertEqual(view_util.encode_array([1.0, np.nan, np.inf], 'list'), [1.0, None, None])
+
+        with override_settings(CLIENT_SIDE_PLOTS=True):
+            response = self.client.get('/fit/john/1/')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue('/fit/john/1/plots/' in response.content)
+
+    def test_downsampling(self):
+        """ Long curves are downsampled for display only """
+        q = np.logspace(-3, 0, 10000)
+        r = np.exp(-q * 10) + 1e-3
+        # A narrow feature that a uniform decimation would miss
+        r[7000] = 0.5
+        dr = 0.01 * r
+        indices = view_util.lttb_indices(q, r, 500)
+        self.assertEqual(len(indices), 500)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], len(q) - 1)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+        self.assertTrue(7000 in indices)
+
+        q_out, r_out, dr_out = view_util.downsample_trace([q, r, dr], 500, x_log=True, y_log=True)
+        self.assertEqual(len(q_out), 500)
+        self.assertTrue(np.allclose(dr_out, 0.01 * r_out))
+
+        figure = view_util.plot1d_figure([[q, r, dr], [q, r]], max_points=200)
+        self.assertEqual(len(figure['data'][0]['x']), 200)
+        self.assertEqual(len(figure['data'][0]['error_y']['array']), 200)
+        # Every point is kept unless downsampling is asked for
+        figure = view_util.plot1d_figure([[q, r]])
+        self.assertEqual(len(figure['data'][0]['x']), len(q))
+
+    def test_request_timing(self):
+        """ Sampled requests report a timing breakdown """
+        cache.clear()
+        with override_settings(REQUEST_TIMING_SAMPLE_RATE=0):
+            response = self.client.get('/fit/john/1/')
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        cache.clear()
+        with override_settings(REQUEST_TIMING_SAMPLE_RATE=1.0):
+            response = self.client.get('/fit/john/1/plots/')
+        self.assertEqual(response.status_code, 200)
+        entries = dict((item.split(';')[0], item) for item in response['Server-Timing'].split(', '))
+        for name in ['total', 'db', 'refl1d', 'plot']:
+            self.assertIn(name, entries)
+        self.assertIn('Plots (2 calls)', entries['plot'])
+        self.assertIsNone(timing.stop())
+
+        # Nested timers with the same name are counted once
+        timing.start()
+        view_util.plot1d([[[1, 2], [1, 2]]])
+        self.assertEqual(timing.stop()['plot'][1], 1)
+
+        # Outside of a timed request, timers record nothing
+        with timing.timer('plot'):
+            pass
+        self.assertIsNone(timing.stop())
+
+    def test_plot_cache(self):
+        """ Plots are cached until the data or the model changes """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        cache.clear()
+        fit_problem = FitProblem.objects.get(user=self.user)
+        request = RequestFactory().get('/fit/john/1/')
+        request.user = self.user
+        first, chi2 = view_util.assemble_plots(request, 'john', '1', fit_problem)
+        key = view_util.assembled_plots_key(['john/1'], [fit_problem], [fit_problem.remote_job_id],
+                                            rq4=False, as_json=False, encoding='list')
+        self.assertEqual(cache.get(key), (first, chi2))
+        # A cache hit returns the same plots, without fetching the data
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(view_util.assemble_plots(request, 'john', '1', fit_problem)[0], first)
+        self.assertFalse([query for query in context.captured_queries if 'datahandler' in query['sql']])
+
+        # Changing the model invalidates the plots, whichever process made the change
+        fit_problem.layers.all().update(thickness=75)
+        new_key = view_util.assembled_plots_key(['john/1'], [fit_problem], [fit_problem.remote_job_id],
+                                                rq4=False, as_json=False, encoding='list')
+        self.assertNotEqual(new_key, key)
+        self.assertNotEqual(view_util.assemble_plots(request, 'john', '1', fit_problem)[0], first)
+
+        # So do new constraints and new uploads
+        constraint = Constraint.objects.create(user=self.user, fit_problem=fit_problem, definition='return 60',
+                                               layer=fit_problem.layers.all()[0], parameter='thickness', variables='')
+        self.assertIsNone(cache.get(view_util.assembled_plots_key(['john/1'], [fit_problem], [fit_problem.remote_job_id],
+                                                                  rq4=False, as_json=False, encoding='list')))
+        constraint.delete()
+        with open('test_data.txt') as fp:
+            self.client.post('/fit/files/', {'name': 'test_data.txt', 'file': fp})
+        self.assertNotEqual(view_util.assembled_plots_key(['john/1'], [fit_problem], [fit_problem.remote_job_id],
+                                                          rq4=False, as_json=False, encoding='list'), new_key)
+
+
     def test_view_fit_list(self):
         response = self.client.get('/fit/list/')
         self.assertEqual(response.status_code, 200)
 
+    def test_bulk_copy(self):
+        """ Copy and apply a 20-layer model with a fixed number of queries """
+        from .models import ReflectivityLayer
+        fit_problem = FitProblem.objects.get(user=self.user)
+        fit_problem.layers.add(*[ReflectivityLayer.objects.create(name='layer%d' % i, layer_number=i+2) for i in range(20)])
+        names = [layer.name for layer in fit_problem.layers.all().order_by('layer_number')]
+
+        with self.assertNumQueries(11):
+            saved = view_util.copy_fit_problem(fit_problem, self.user)
+        saved = FitProblem.objects.get(id=saved.id)
+        self.assertEqual(saved.reflectivity_model.data_path, 'saved')
+        self.assertEqual([layer.name for layer in saved.layers.all().order_by('layer_number')], names)
+        fit_problem = FitProblem.objects.get(data_path='john/1')
+        self.assertFalse(set(saved.layers.values_list('id', flat=True)) & set(fit_problem.layers.values_list('id', flat=True)))
+
+        saved_model = SavedModelInfo.objects.create(user=self.user, fit_problem=saved)
+        with self.assertNumQueries(13):
+            view_util.apply_model(fit_problem, saved_model, 'john', '1')
+        fit_problem = FitProblem.objects.get(data_path='john/1')
+        self.assertEqual([layer.name for layer in fit_problem.layers.all().order_by('layer_number')], names)
+        self.assertEqual(fit_problem.layers.count(), 21)
+
+    def test_fit_list_json(self):
+        """ Paginated fit list """
+        from django.test import RequestFactory
+        from .models import ReflectivityModel, ReflectivityLayer
+        for i in range(30):
+            refl_model = ReflectivityModel.objects.create(data_path='john/%d' % (100 + i))
+            fit_problem = FitProblem.objects.create(user=self.user, reflectivity_model=refl_model)
+            for j in range(3):
+                fit_problem.layers.add(ReflectivityLayer.objects.create(name='layer%d_%d' % (i, j), layer_number=j))
+
+        response = self.client.get('/fit/list/json/', {'page': 2, 'perPage': 10, 'offset': 10, 'sorts[data]': 1})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data['totalRecordCount'], 31)
+        self.assertEqual(data['queryRecordCount'], 31)
+        self.assertEqual(len(data['records']), 10)
+        self.assertTrue('john/109' in data['records'][0]['data'])
+        self.assertEqual(data['records'][0]['layers'], 'air, layer9_0, layer9_1, layer9_2, Si')
+
+        # The number of queries does not depend on the number of fits
+        request = RequestFactory().get('/fit/list/json/', {'perPage': 25, 'queries[search]': 'layer1'})
+        request.user = self.user
+        with self.assertNumQueries(4):
+            data = view_util.get_fit_list(request)
+        self.assertEqual(data['queryRecordCount'], 11)
+        self.assertEqual(len(data['records']), 11)
+
     def test_scripting(self):
         """ Generate a refl1d script """
         fit_problem = FitProblem.objects.get(user=self.user)
@@ -292,6 +795,9 @@ class FitProblemViewsTestCase(TestCase):
                                                 output_dir='/tmp/', fit=True, options={}, constraints=[])
 
         self.assertTrue("sample = (  Si(0, 5.0) | material(50.0, 1.0) | air )" in script)
+        # The job reports the resources it used
+        self.assertTrue('print("JOB_TELEMETRY %s" % json.dumps(telemetry))' in script)
+        compile(script, 'job.py', 'exec')
 
     def test_process_single_fit(self):
         """ Process a fit request """
@@ -336,6 +842,36 @@ class FitProblemViewsTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(Constraint.objects.all()), 0)
 
+    def test_constraint_batch(self):
+        """ Test that constraints are compiled once and written with a single query """
+        from .models import ReflectivityLayer
+        fit_problem = FitProblem.objects.get(user=self.user)
+        layer_a = ReflectivityLayer.objects.create(name='A', thickness=10, layer_number=2)
+        layer_b = ReflectivityLayer.objects.create(name='B', thickness=20, layer_number=3)
+        fit_problem.layers.add(layer_a, layer_b)
+        # Chained constraints: B depends on A, which depends on material
+        c_a = Constraint.objects.create(user=self.user, fit_problem=fit_problem, layer=layer_a, parameter='thickness',
+                                        variables='material_thickness', definition='return material_thickness + 1')
+        c_b = Constraint.objects.create(user=self.user, fit_problem=fit_problem, layer=layer_b, parameter='thickness',
+                                        variables='A_thickness', definition='return 2*A_thickness + sin(0)')
+
+        with self.assertNumQueries(3):
+            Constraint.apply_constraints(fit_problem)
+        self.assertEqual(ReflectivityLayer.objects.get(id=layer_a.id).thickness, 51)
+        self.assertEqual(ReflectivityLayer.objects.get(id=layer_b.id).thickness, 102)
+        # Nothing changed, so nothing is written
+        with self.assertNumQueries(2):
+            Constraint.apply_constraints(fit_problem)
+
+        # The compiled function is reused until the definition changes
+        c_b = Constraint.objects.get(id=c_b.id)
+        self.assertTrue(c_b.compile_constraint() is Constraint.objects.get(id=c_b.id).compile_constraint())
+        c_b.definition = 'return 3*A_thickness'
+        c_b.save()
+        self.assertFalse(c_b.compile_constraint() is c_a.compile_constraint())
+        Constraint.apply_constraints(fit_problem)
+        self.assertEqual(ReflectivityLayer.objects.get(id=layer_b.id).thickness, 153)
+
     def test_append(self):
         """ Append a data set to a view so we can do simultaneous fitting """
         with open('test_data.txt') as fp:
@@ -405,7 +941,50 @@ class FitProblemViewsTestCase(TestCase):
         """ Get model as text """
         response = self.client.get('/fit/john/1/model/')
         self.assertEqual(response.status_code, 200)
-        self.assertTrue(response.content.startswith("# Reflectivity model"))
+        content = b"".join(response.streaming_content)
+        self.assertTrue(content.startswith(b"# Reflectivity model"))
+        # The theory curve follows the model, and comes from the cache once computed
+        self.assertIn(b"           Q            R\n", content)
+        fit_problem = FitProblem.objects.get(user=self.user, data_path='john/1')
+        html_data = dh.get_plot_data_from_server('john', '1')
+        cache_key = view_util.plot_cache_key([html_data], [fit_problem], theory=True)
+        self.assertIsNotNone(cache.get(cache_key))
+        self.assertEqual(view_util.get_model_as_csv(response.wsgi_request, 'john', '1'),
+                         content.decode('utf-8'))
+
+    def test_export_models(self):
+        """ Bulk export of models as a zip file """
+        response = self.client.get('/fit/export/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(sorted(archive.namelist()), ['JOHN_1.txt', 'JOHN_1_model.txt'])
+        self.assertIsNone(archive.testzip())
+        model_file = archive.read('JOHN_1_model.txt')
+        self.assertTrue(model_file.startswith(b"# Reflectivity model"))
+        n_points = len([line for line in archive.read('JOHN_1.txt').splitlines() if not line.startswith(b'#')])
+        self.assertEqual(len(model_file.split(b"           Q            R\n")[1].splitlines()), n_points)
+
+        # Selecting other data gives an empty archive
+        response = self.client.get('/fit/export/', {'path': 'john/2'})
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(archive.namelist(), [])
+        response = self.client.get('/fit/export/', {'proposal': 'IPTS-1234'})
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertEqual(archive.namelist(), [])
+
+        # Fits that can't be exported are listed
+        def _failing_theory(html_data, fit_problem):
+            raise RuntimeError("Could not compute %s" % fit_problem.data_path)
+        original_theory = view_util.model_theory
+        view_util.model_theory = _failing_theory
+        try:
+            response = self.client.get('/fit/export/')
+            archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        finally:
+            view_util.model_theory = original_theory
+        self.assertEqual(sorted(archive.namelist()), ['JOHN_1.txt', 'errors.txt'])
+        self.assertEqual(archive.read('errors.txt'), b"Could not export john/1\n")
 
     def test_delete_fit_problem(self):
         """ Delete a fit problem """
@@ -415,6 +994,14 @@ class FitProblemViewsTestCase(TestCase):
         fit_problem_list = FitProblem.objects.filter(user=self.user)
         self.assertEqual(len(fit_problem_list), 0)
 
+    def test_model_data_path(self):
+        """ The data path of a fit problem follows its reflectivity model """
+        fit_problem = FitProblem.objects.get(user=self.user, data_path='john/1')
+        model = fit_problem.reflectivity_model
+        model.data_path = 'john/3'
+        model.save()
+        self.assertEqual(FitProblem.objects.get(id=fit_problem.id).data_path, 'john/3')
+
     def test_reverse_model(self):
         """ Test layer order reversal """
         fit_problem = FitProblem.objects.get(user=self.user,
@@ -429,6 +1016,26 @@ class FitProblemViewsTestCase(TestCase):
                                              reflectivity_model__data_path='john/1')
         self.assertEqual(fit_problem.reflectivity_model.back_sld, 0)
 
+    def test_reverse_layers(self):
+        """ Test that layer order and roughness are reversed with a single update """
+        from .models import ReflectivityLayer
+        fit_problem = FitProblem.objects.get(user=self.user)
+        fit_problem.layers.add(*[ReflectivityLayer.objects.create(name='layer%d' % i, layer_number=i+2,
+                                                                  roughness=i+2, roughness_min=i)
+                                 for i in range(9)])
+        with self.assertNumQueries(7):
+            view_util.reverse_model(fit_problem)
+
+        fit_problem = FitProblem.objects.get(user=self.user)
+        layers = list(fit_problem.layers.all().order_by('layer_number'))
+        self.assertEqual([layer.layer_number for layer in layers], list(range(1, 11)))
+        self.assertEqual([layer.name for layer in layers], ['layer%d' % i for i in range(8, -1, -1)] + ['material'])
+        # The back roughness moves to the layer in contact with the old back medium
+        self.assertEqual([layer.roughness for layer in layers], [5.0] + [float(i) for i in range(10, 1, -1)])
+        self.assertEqual(layers[1].roughness_min, 8)
+        self.assertEqual(fit_problem.reflectivity_model.back_roughness, 1.0)
+        self.assertEqual(fit_problem.reflectivity_model.back_name, 'air')
+
 class FitterOptionsTestCase(TestCase):
     """ Test fitter options """
     def setUp(self):
@@ -582,6 +1189,23 @@ Done: 2.40629 sec
         data, _ = refl1d_err_model.parse_slabs(self.log)
         self.assertEqual(data[0][0]['chi2'], '108.1844')
 
+    def test_error_index(self):
+        """ Test that the indexed error lookup matches entries by name and value """
+        error_output = [['layer%d thickness' % (i % 50), 10.0 + i, 0.1 * (i + 1)] for i in range(500)]
+        error_index = refl1d.index_error_output(error_output)
+        self.assertEqual(len(error_index), 50)
+        self.assertEqual(len(error_index['layer3 thickness']), 10)
+        for i in [0, 53, 499]:
+            name = 'layer%d' % (i % 50)
+            self.assertEqual(refl1d.find_error(name, 'thickness', 10.0 + i, error_index),
+                             refl1d.find_error(name, 'thickness', 10.0 + i, error_output))
+            _, error = refl1d.find_error(name, 'thickness', 10.0 + i, error_index)
+            self.assertAlmostEqual(error, 0.1 * (i + 1))
+        self.assertEqual(refl1d.find_error('layer3', 'thickness', 1.0, error_index), (1.0, 0))
+        self.assertEqual(refl1d.find_error('other', 'thickness', 13.0, error_index), (13.0, 0))
+        _, error = refl1d_err_model.find_error('layer3', 'thickness', {'layer3 thickness': '63.0'}, error_index)
+        self.assertAlmostEqual(error, 5.4)
+
 class SimultaneousParsingTestCase(TestCase):
     """ Test refl1d result parsers for simultaneous fits"""
     def setUp(self):
@@ -899,6 +1523,319 @@ Done: 0.981189 sec
         r_plot = model_handling.assemble_plots(Req(), None, problem_list)
         self.assertTrue(len(r_plot) > 0)
 
+    def test_single_parse(self):
+        """ Test that display dicts and plotting problems come from the same parsed result """
+        log = self.log.replace("[chisq=72.4369(32), nllf=11408.8]\n",
+                               "[chisq=72.4369(32), nllf=11408.8]\n"
+                               "1 PS thickness 2896(12) 2896.0 2896.0 [ 2880 2910] [ 1800 3000]\n")
+        model_list, chi2, problem_list = refl1d_simultaneous.parse_models_from_log(log)
+        self.assertEqual(chi2, 0)
+        self.assertEqual(len(model_list), 1)
+        refl_dict, layer_dicts = model_list[0]
+        self.assertEqual(refl_dict['data_path'], 'john/1')
+        self.assertEqual(refl_dict['chi2'], '72.4369')
+        self.assertEqual(refl_dict['back_name'], 'Si')
+        self.assertEqual(refl_dict['front_name'], 'air')
+        # Layers are listed from the front
+        self.assertEqual([l['name'] for l in layer_dicts], ['PS', 'SiOx'])
+        self.assertEqual(layer_dicts[0]['thickness'], '2896 &#177; 12')
+        self.assertEqual(layer_dicts[1]['sld'], 3.2)
+
+        # The plotting problem holds plain values, ordered from the back
+        problem = problem_list[0]
+        self.assertEqual(problem.reflectivity_model.back_sld, 2.07)
+        layers = problem.layers.all().order_by('-layer_number')
+        self.assertEqual([l.name for l in layers], ['SiOx', 'PS'])
+        self.assertEqual(layers[1].thickness, 2896.0)
+        self.assertEqual(layers[1].thickness_error, 12.0)
+
+
+class QueryCountTestCase(TestCase):
+    """ Keep track of the number of database queries issued by the main views """
+    # Maximum number of queries for each view
+    QUERY_BUDGET = [('/fit/list/', 2),
+                    ('/fit/list/json/', 5),
+                    ('/fit/files/', 3),
+                    ('/fit/models/', 5),
+                    # Includes the model, constraint and upload lookups of the plot cache key
+                    ('/fit/john/1/', 20)]
+
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user('john', 'john@test.com', 'johnpassword')
+        self.client.login(username='john', password='johnpassword')
+        with open('test_data.txt') as fp:
+            self.client.post('/fit/files/', {'name': 'test_data.txt', 'file': fp})
+        self.add_fits(['john/1'])
+
+    def add_fits(self, data_paths, n_layers=3):
+        """ Create a fit problem for each data path """
+        from .models import ReflectivityModel, ReflectivityLayer
+        for data_path in data_paths:
+            refl_model = ReflectivityModel.objects.create(data_path=data_path)
+            fit_problem = FitProblem.objects.create(user=self.user, reflectivity_model=refl_model)
+            for i in range(n_layers):
+                fit_problem.layers.add(ReflectivityLayer.objects.create(name='layer%d' % i, layer_number=i))
+            SavedModelInfo.objects.create(user=self.user, fit_problem=fit_problem)
+
+    def count_queries(self, url):
+        """ Return the number of queries needed to serve a page, without cached plots """
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context), [q['sql'] for q in context.captured_queries]
+
+    def test_query_budget(self):
+        """ Check that each view stays within its query budget """
+        for url, budget in self.QUERY_BUDGET:
+            n_queries, queries = self.count_queries(url)
+            self.assertTrue(n_queries <= budget, "%s: %s queries\n%s" % (url, n_queries, '\n'.join(queries)))
+
+    def test_query_scaling(self):
+        """ Check that the number of queries doesn't grow with the number of fits """
+        counts = [self.count_queries(url)[0] for url, _ in self.QUERY_BUDGET]
+        self.add_fits(['john/%d' % (100 + i) for i in range(20)])
+        self.assertEqual([self.count_queries(url)[0] for url, _ in self.QUERY_BUDGET], counts)
+
+
+class JobTelemetryTestCase(ChannelTestCase):
+    """ Test the storage of job resource usage. Job updates are sent to an in-memory channel layer. """
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpassword')
+        server = Server.objects.create(title='Remote', hostname='localhost', port=22)
+        interpreter = Interpreter.objects.create(name='python', path='/usr/bin/python', arguments=['-u'])
+        self.jobs = [Job.objects.create(title='fit', program='', remote_directory='/tmp', remote_filename='fit.py',
+                                        owner=self.user, server=server, interpreter=interpreter) for _ in range(3)]
+
+    def _report(self, job, **telemetry):
+        """ Store a log with a telemetry line for a job """
+        content = "MODEL_PARAMS_START\nMODEL_PARAMS_END\nDone: %g sec\nJOB_TELEMETRY %s\n" % (telemetry['wall_time'],
+                                                                                            json.dumps(telemetry))
+        Log.objects.create(job=job, content=content)
+
+    def test_parse(self):
+        """ Parse the telemetry line of a log """
+        self.assertIsNone(refl1d.parse_telemetry("Done: 12 sec\n"))
+        self.assertIsNone(refl1d.parse_telemetry("JOB_TELEMETRY {bad\n"))
+        telemetry = refl1d.parse_telemetry('Done: 12 sec\nJOB_TELEMETRY {"engine": "dream", "wall_time": 12.5}\n')
+        self.assertEqual(telemetry, {'engine': 'dream', 'wall_time': 12.5})
+
+    def test_record(self):
+        """ Telemetry is stored when a job log comes in """
+        Log.objects.create(job=self.jobs[0], content="Starting fit")
+        self.assertEqual(JobTelemetry.objects.count(), 0)
+        self.assertIsNone(JobTelemetry.estimate_runtime('dream', 1000, 1000, 5, 100))
+
+        self._report(self.jobs[0], engine='dream', steps=1000, burn=1000, n_parameters=5, n_points=100,
+                     wall_time=25.0, fit_time=20.0, host='compute1')
+        self._report(self.jobs[1], engine='dream', steps=500, burn=500, n_parameters=5, n_points=100,
+                     wall_time=12.0, fit_time=10.0, host='compute1', n_models=2)
+        self._report(self.jobs[2], engine='amoeba', steps=1, burn=1, n_parameters=0, n_points=100,
+                     wall_time=2.0, fit_time=1.0, host='compute2')
+        # A second log for the same job updates its entry
+        self._report(self.jobs[2], engine='amoeba', steps=1, burn=1, n_parameters=0, n_points=100,
+                     wall_time=3.0, fit_time=1.0, host='compute2')
+        self.assertEqual(JobTelemetry.objects.count(), 3)
+
+        telemetry = self.jobs[0].telemetry
+        self.assertEqual(telemetry.host, 'compute1')
+        self.assertEqual(telemetry.steps_per_second, 100.0)
+        self.assertEqual(self.jobs[1].telemetry.n_models, 2)
+        self.assertEqual(self.jobs[2].telemetry.wall_time, 3.0)
+
+        # Both DREAM fits cost 2e-5 sec per step, parameter and point
+        self.assertAlmostEqual(JobTelemetry.estimate_runtime('dream', 2000, 2000, 10, 200), 160.0)
+
+        summary = JobTelemetry.runtime_summary(JobTelemetry.objects.all())
+        self.assertEqual([item['engine'] for item in summary], ['amoeba', 'dream'])
+        self.assertEqual(summary[1]['count'], 2)
+        self.assertEqual(summary[1]['histogram'][1], ['< 1 min', 2, 100])
+
+        client = Client()
+        client.login(username='admin', password='adminpassword')
+        response = client.get('/database/fitting/jobtelemetry/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b"Run-time distributions" in response.content)
+
+class MetricsTestCase(ChannelTestCase):
+    """ Test the application metrics. Job updates are sent to an in-memory channel layer. """
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpassword')
+        server = Server.objects.create(title='Remote', hostname='localhost', port=22)
+        interpreter = Interpreter.objects.create(name='python', path='/usr/bin/python', arguments=['-u'])
+        self.jobs = [Job.objects.create(title='fit', program='cmd = "refl1d_cli.py --fit=%s --steps=10"' % engine,
+                                        remote_directory='/tmp', remote_filename='fit.py',
+                                        owner=self.user, server=server, interpreter=interpreter)
+                     for engine in ['dream', 'dream', 'lm']]
+
+    def _metrics(self):
+        """ Return the reported metrics as a dictionary """
+        values = {}
+        for line in metrics.report().splitlines():
+            if not line.startswith('#'):
+                series, value = line.rsplit(' ', 1)
+                values[series] = float(value)
+        return values
+
+    def test_jobs(self):
+        """ Job submissions and status transitions """
+        for job in self.jobs:
+            signals.job_queued.send(sender=Job, job=job)
+        for job in Job.objects.all():
+            job.status = Job.STATUS.submitted
+            job.save()
+            # Saving again without a status change is not counted twice
+            job.save()
+        job = Job.objects.get(pk=self.jobs[0].pk)
+        job.status = Job.STATUS.success
+        job.save()
+        job = Job.objects.get(pk=self.jobs[2].pk)
+        job.status = Job.STATUS.failure
+        job.save()
+
+        values = self._metrics()
+        self.assertEqual(values['fitting_jobs_submitted_total{engine="dream"}'], 2)
+        self.assertEqual(values['fitting_jobs_submitted_total{engine="lm"}'], 1)
+        self.assertEqual(values['fitting_jobs_started_total{engine="dream"}'], 2)
+        self.assertEqual(values['fitting_jobs_finished_total{engine="dream",status="success"}'], 1)
+        self.assertEqual(values['fitting_jobs_finished_total{engine="lm",status="failure"}'], 1)
+        self.assertEqual(values['fitting_jobs_running{engine="dream"}'], 1)
+        self.assertEqual(values['fitting_jobs_running{engine="lm"}'], 0)
+        self.assertEqual(values['fitting_jobs{status="submitted"}'], 1)
+        # Jobs start within a second of being queued in this test
+        self.assertEqual(values['fitting_job_start_seconds_bucket{engine="dream",le="1"}'], 2)
+        self.assertEqual(values['fitting_job_start_seconds_bucket{engine="dream",le="+Inf"}'], 2)
+        self.assertEqual(values['fitting_job_finish_seconds_count{engine="lm"}'], 1)
+
+    def test_calls_and_caches(self):
+        """ Call durations and cache hit ratios """
+        with timing.timer('data'):
+            pass
+        metrics.observe('fitting_call_duration_seconds', metrics.CALL_BUCKETS, 0.2, call='catalog')
+        for hit in [True, True, True, False]:
+            signals.cache_lookup.send(sender=None, cache='plots', hit=hit)
+        # Clearing the cache doesn't reset the metrics
+        cache.clear()
+
+        values = self._metrics()
+        self.assertEqual(values['fitting_call_duration_seconds_count{call="data"}'], 1)
+        self.assertEqual(values['fitting_call_duration_seconds_bucket{call="data",le="0.005"}'], 1)
+        self.assertEqual(values['fitting_call_duration_seconds_count{call="catalog"}'], 1)
+        self.assertEqual(values['fitting_call_duration_seconds_bucket{call="catalog",le="0.1"}'], 0)
+        self.assertEqual(values['fitting_call_duration_seconds_bucket{call="catalog",le="0.5"}'], 1)
+        self.assertAlmostEqual(values['fitting_call_duration_seconds_sum{call="catalog"}'], 0.2)
+        self.assertEqual(values['fitting_cache_hit_ratio{cache="plots"}'], 0.75)
+        self.assertNotIn('fitting_cache_hit_ratio{cache="theory"}', values)
+
+    @override_settings(METRICS_FLUSH_INTERVAL=3600)
+    def test_process_counts(self):
+        """ Counts are kept in memory until they are due to be shared """
+        for _ in range(3):
+            metrics.increment('fitting_jobs_submitted_total', engine='lm')
+        self.assertEqual(metrics._counters.pending['fitting_jobs_submitted_total{engine="lm"}'], 3)
+        # Without Redis, each process reports its own counts
+        with override_settings(METRICS_REDIS_URL=None):
+            self.assertEqual(self._metrics()['fitting_jobs_submitted_total{engine="lm"}'], 3)
+
+    def test_shared_counts(self):
+        """ Counts are added to the counters shared in Redis """
+        store = metrics.metrics_store()
+        try:
+            store.ping()
+        except:
+            raise unittest.SkipTest("Redis is not running")
+        metrics.increment('fitting_jobs_submitted_total', engine='lm')
+        metrics._counters.flush()
+        self.assertEqual(len(metrics._counters.pending), 0)
+        key = metrics.METRICS_KEY % settings.DATABASES['default']['NAME']
+        self.assertEqual(int(store.hget(key, 'fitting_jobs_submitted_total{engine="lm"}')), 1)
+        self.assertEqual(self._metrics()['fitting_jobs_submitted_total{engine="lm"}'], 1)
+        metrics.reset()
+        self.assertFalse(store.exists(key))
+
+    def test_endpoint(self):
+        """ Access to the metrics """
+        client = Client()
+        self.assertEqual(client.get('/fit/metrics/').status_code, 403)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(client.get('/fit/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            response = client.get('/fit/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'# TYPE fitting_jobs_submitted_total counter', response.content)
+        client.login(username='admin', password='adminpassword')
+        self.assertEqual(client.get('/fit/metrics/').status_code, 200)
+
+class ProfilingTestCase(TestCase):
+    """ Test the profiling of requests for staff users """
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@test.com', 'adminpassword')
+        User.objects.create_user('user', 'user@test.com', 'userpassword')
+        self.client = Client()
+
+    def test_staff_profile(self):
+        """ A staff user gets the page, and its profile is stored """
+        self.client.login(username='admin', password='adminpassword')
+        response = self.client.get('/fit/files/?profile')
+        self.assertEqual(response.status_code, 200)
+        profile = RequestProfile.objects.get()
+        self.assertEqual(response['X-Profile'], '/database/fitting/requestprofile/%s/change/' % profile.id)
+        self.assertEqual(profile.path, '/fit/files/?profile')
+        self.assertEqual(profile.status, 200)
+        self.assertGreater(profile.python_time, 0)
+        self.assertGreater(profile.n_queries, 0)
+        self.assertIn('views.py', profile.functions)
+        self.assertTrue(any(['fitting_userdata' in item['sql'] for item in profile.sql_summary()]))
+
+        # The admin summarizes the profile, and the statistics can be loaded with pstats
+        response = self.client.get(response['X-Profile'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'fitting_userdata', response.content)
+        response = self.client.get('/database/fitting/requestprofile/%s/download/' % profile.id)
+        self.assertEqual(response.status_code, 200)
+        stats = marshal.loads(response.content)
+        self.assertTrue(any([function == 'get' for _, _, function in stats]))
+
+    def test_streaming_and_errors(self):
+        """ Streamed content is produced under the profiler, and failed views are profiled """
+        self.client.login(username='admin', password='adminpassword')
+        response = self.client.get('/fit/export/?profile')
+        self.assertEqual(response.status_code, 200)
+        zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        self.assertIn('iter_model_archive', RequestProfile.objects.get().functions)
+
+        def _failing_list(request):
+            raise RuntimeError("Could not list fits")
+        original_list = view_util.export_fit_list
+        view_util.export_fit_list = _failing_list
+        try:
+            self.assertRaises(RuntimeError, self.client.get, '/fit/export/?profile')
+        finally:
+            view_util.export_fit_list = original_list
+        self.assertEqual(RequestProfile.objects.latest('id').status, 500)
+
+    def test_other_users(self):
+        """ The flag is ignored for other users """
+        self.client.login(username='user', password='userpassword')
+        response = self.client.get('/fit/files/?profile')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('X-Profile'))
+        self.assertEqual(RequestProfile.objects.count(), 0)
+        self.assertEqual(self.client.get('/database/fitting/requestprofile/1/download/').status_code, 302)
+
+    @override_settings(PROFILE_HISTORY=2)
+    def test_history(self):
+        """ Only the latest profiles are kept """
+        self.client.login(username='admin', password='adminpassword')
+        for i in range(3):
+            self.client.get('/fit/files/?profile=%d' % i)
+        self.assertEqual(sorted(RequestProfile.objects.values_list('path', flat=True)),
+                         ['/fit/files/?profile=1', '/fit/files/?profile=2'])
 
 class CatalogTestCase(TestCase):
     def test_oncat(self):
@@ -911,3 +1848,23 @@ class ICATTestCase(TestCase):
     def test_icat(self):
         from . import icat_server_communication
         self.assertEqual(icat_server_communication.get_run_info('john', 1), {})
+
+
+class ImportTimeTestCase(TestCase):
+    """ Make sure the scientific stack stays out of the start-up path """
+    HEAVY_MODULES = ['refl1d', 'plotly', 'pandas']
+
+    def test_lazy_imports(self):
+        """ Importing the views and URLs should not load refl1d, plotly or pandas """
+        code = """
+import sys, json
+import django
+django.setup()
+import web_reflectivity.urls
+import fitting.views
+print(json.dumps([m for m in %s if m in sys.modules]))
+""" % self.HEAVY_MODULES
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='web_reflectivity.settings')
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=settings.BASE_DIR, env=env)
+        loaded = json.loads(output.strip().splitlines()[-1])
+        self.assertEqual(loaded, [])
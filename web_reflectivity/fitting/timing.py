@@ -0,0 +1,170 @@
+#pylint: disable=invalid-name, too-few-public-methods
+"""
+    Per-request timing breakdown.
+
+    A sample of the requests is timed, so that the middleware can stay on in production.
+    For those requests, the time spent in the database and in each instrumented
+    call site is reported in a Server-Timing header and in a log line.
+    Call sites are instrumented with the timed() decorator or the timer() context manager.
+    Every call is timed and reported with the call_timed signal, but only the calls made
+    while handling a timed request are added to its breakdown.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import time
+import json
+import random
+import logging
+import functools
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.utils.deprecation import MiddlewareMixin
+
+from . import signals
+
+## Instrumented call sites, with their description
+TIMERS = [('data', 'Data server'),
+          ('catalog', 'Catalog'),
+          ('refl1d', 'Theory curves'),
+          ('plot', 'Plots')]
+
+_local = threading.local()
+
+def start():
+    """
+        Start collecting timings for the current thread
+    """
+    _local.timings = {}
+    _local.active = set()
+
+def stop():
+    """
+        Stop collecting timings for the current thread and return them,
+        as a dictionary of {name: (seconds, number of calls)}
+    """
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    _local.active = set()
+    return timings
+
+def record_queries():
+    """
+        Start recording the SQL queries of the current connection, with their duration.
+        Returns the state to pass to recorded_queries().
+    """
+    # Query times are only recorded by the debug cursor
+    state = (len(connection.queries_log), connection.force_debug_cursor)
+    connection.force_debug_cursor = True
+    return state
+
+def recorded_queries(state):
+    """
+        Stop recording SQL queries and return the queries made since record_queries()
+        :param tuple state: state returned by record_queries()
+    """
+    n_queries, force_debug_cursor = state
+    connection.force_debug_cursor = force_debug_cursor
+    return list(connection.queries_log)[n_queries:]
+
+class timer(object):
+    """
+        Context manager timing a block, which is reported with the call_timed
+        signal and added to the breakdown of the current request.
+        Nested blocks with the same name are only counted once.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.t_0 = None
+
+    def __enter__(self):
+        if not hasattr(_local, 'active'):
+            _local.active = set()
+        if self.name not in _local.active:
+            _local.active.add(self.name)
+            self.t_0 = time.time()
+        return self
+
+    def __exit__(self, *args):
+        if self.t_0 is not None:
+            duration = time.time() - self.t_0
+            self.t_0 = None
+            _local.active.discard(self.name)
+            timings = getattr(_local, 'timings', None)
+            if timings is not None:
+                total, count = timings.get(self.name, (0.0, 0))
+                timings[self.name] = (total + duration, count + 1)
+            signals.call_timed.send_robust(sender=timer, name=self.name, duration=duration)
+
+def timed(name):
+    """
+        Decorator adding the time spent in a function to the breakdown
+        of the current request
+        :param str name: name of the call site, as listed in TIMERS
+    """
+    def decorator(function):
+        """ Wrap the function in a timer """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            """ Timed function """
+            with timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def server_timing(breakdown):
+    """
+        Format a timing breakdown as a Server-Timing header value
+        :param dict breakdown: breakdown returned by TimingMiddleware.get_breakdown()
+    """
+    entries = ['total;dur=%.1f' % breakdown['total']]
+    if 'db' in breakdown:
+        entries.append('db;dur=%.1f;desc="Database (%s queries)"' % (breakdown['db'], breakdown['db_queries']))
+    for name, description in TIMERS:
+        if name in breakdown:
+            entries.append('%s;dur=%.1f;desc="%s (%s calls)"' % (name, breakdown[name], description,
+                                                                 breakdown['%s_calls' % name]))
+    return ', '.join(entries)
+
+class TimingMiddleware(MiddlewareMixin):
+    """
+        Time a sample of the requests. The fraction of requests timed is
+        set by REQUEST_TIMING_SAMPLE_RATE.
+    """
+    def process_request(self, request):
+        """ Decide whether to time this request, and start the timers """
+        request.timing_start = None
+        sample_rate = getattr(settings, 'REQUEST_TIMING_SAMPLE_RATE', 0.01)
+        if sample_rate > 0 and random.random() < sample_rate:
+            start()
+            request.timing_start = (time.time(), record_queries())
+        else:
+            stop()
+
+    def get_breakdown(self, request):
+        """
+            Stop the timers and return the time spent in each part of the request, in ms
+            :param Request request: request being timed
+        """
+        t_0, query_state = request.timing_start
+        timings = stop() or {}
+        queries = recorded_queries(query_state)
+
+        breakdown = dict(total=1000.0 * (time.time() - t_0),
+                         db=1000.0 * sum([float(query['time']) for query in queries]),
+                         db_queries=len(queries))
+        for name, (total, count) in timings.items():
+            breakdown[name] = 1000.0 * total
+            breakdown['%s_calls' % name] = count
+        return breakdown
+
+    def process_response(self, request, response):
+        """ Report the timing breakdown of a sampled request """
+        if getattr(request, 'timing_start', None) is None:
+            return response
+        breakdown = self.get_breakdown(request)
+        response['Server-Timing'] = server_timing(breakdown)
+        log_entry = dict(method=request.method, path=request.path, status=response.status_code)
+        log_entry.update(dict((key, round(value, 1)) for key, value in breakdown.items()))
+        logging.info("Request timing: %s", json.dumps(log_entry, sort_keys=True))
+        return response
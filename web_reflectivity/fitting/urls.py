@@ -17,6 +17,9 @@ urlpatterns = [
     url(r'^simultaneous/(?P<pk>[\w-]+)/delete/$',                 views.remove_simultaneous_model, name='remove_simultaneous_model'),
     url(r'^model/(?P<pk>[\w-]+)/$',                               views.SaveModelUpdate.as_view(success_url='/fit/models'), name='update_model'),
     url(r'^list/$',                                               views.FitListView.as_view(),    name='show_fits'),
+    url(r'^list/json/$',                                          views.fit_list_json,            name='fit_list_json'),
+    url(r'^export/$',                                             views.export_models,            name='export_models'),
+    url(r'^metrics/$',                                            views.metrics_report,           name='metrics'),
     url(r'^options/$',                                            views.FitterOptionsUpdate.as_view(success_url='/fit/options'), name='options'),
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/info/$',        views.UpdateUserDataView.as_view(), name='data_info'),
     url(r'^files/(?P<pk>[\w-]+)/delete/$',                        views.UserDataDelete.as_view(success_url='/fit/files'), name='data_delete'),
@@ -26,9 +29,11 @@ urlpatterns = [
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/apply/(?P<pk>[\w-]+)/$', views.apply_model,     name='apply_model'),
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/save/$',        views.save_model,               name='save_model'),
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/download/$',    views.download_reduced_data,    name='download_data'),
+    url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/plots/$',       views.plot_data,                name='plot_data'),
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/reverse/$',     views.reverse_model,            name='reverse_model'),
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/constraints/$', views.ConstraintView.as_view(), name='constraints'),
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/simultaneous/$', views.SimultaneousView.as_view(), name='simultaneous'),
+    url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/simultaneous/plots/$', views.simultaneous_plot_data, name='simultaneous_plot_data'),
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/simultaneous/update/$', views.update_simultaneous_params, name='simultaneous_update'),
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/constraints/(?P<const_id>\d+)/$', views.ConstraintView.as_view(), name='constraints_edit'),
     url(r'^(?P<instrument>[\w]+)/(?P<data_id>\d+)/constraints/(?P<const_id>\d+)/remove/$', views.remove_constraint, name='constraints_remove'),
@@ -7,17 +7,20 @@ import sys
 import os
 import re
 import io
+import base64
+import zipfile
+import tarfile
 import traceback
 import json
 import logging
 import hashlib
-import pandas
 
 import numpy as np
-import plotly.offline as py
-import plotly.graph_objs as go
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q, Case, When, Value, Max
 from django.utils import dateformat, timezone
 from django_remote_submission.models import Server, Job, Log, Interpreter
 from django_remote_submission.tasks import submit_job_to_server, LogPolicy
@@ -28,14 +31,17 @@ import users.view_util
 
 from . import parsing
 from . import job_handling
+from . import timing
+from . import signals
 from .data_server import data_handler
 
 # Import catalog
 from . import catalog
+from . import data_readers
 if not catalog.HAVE_ONCAT:
     from . import icat_server_communication as catalog
 
-from .models import FitProblem, FitterOptions, Constraint, ReflectivityLayer, UserData, SimultaneousModel, SimultaneousConstraint, SimultaneousFit
+from .models import FitProblem, FitterOptions, Constraint, ReflectivityLayer, UserData, SimultaneousModel, SimultaneousConstraint, SimultaneousFit, CatalogCache
 from .forms import ReflectivityFittingForm, LayerForm
 
 def extract_ascii_from_div(html_data):
@@ -57,7 +63,6 @@ def extract_ascii_from_div(html_data):
     try:
         jsondata_str = "[%s]" % result.group(1)
         data_list = json.loads(jsondata_str)
-        ascii_data = ""
         for d in data_list:
             if isinstance(d, list):
                 for trace in d:
@@ -71,9 +76,9 @@ def extract_ascii_from_div(html_data):
                         if 'error_y' in trace and 'array' in trace['error_y']:
                             dy = trace['error_y']['array']
                         break
-                for i in range(len(x)):
-                    ascii_data += u"%g %g %g %g\n" % (x[i], y[i], dy[i], dx[i])
-                return ascii_data
+                # Join the lines at the end, since appending to a string would be quadratic
+                lines = [u"%g %g %g %g\n" % point for point in zip(x, y, dy, dx)]
+                return u"".join(lines)
     except:
         # Unable to extract data from <div>
         logging.debug("Unable to extract data from <div>: %s", sys.exc_value)
@@ -116,7 +121,7 @@ def get_fit_problem(request, instrument, data_id):
     """
     data_path = "%s/%s" % (instrument, data_id)
     fit_problem_list = FitProblem.objects.filter(user=request.user,
-                                                 reflectivity_model__data_path=data_path)
+                                                 data_path=data_path)
     if len(fit_problem_list) > 0:
         fit_problem = fit_problem_list.latest('timestamp')
         if len(fit_problem_list) > 1:
@@ -128,6 +133,82 @@ def get_fit_problem(request, instrument, data_id):
         return data_path, fit_problem
     return data_path, None
 
+def model_header_lines(fit_problem):
+    """
+        Return the header lines describing a model, as written at the
+        top of an exported model file.
+
+        :param FitProblem fit_problem: FitProblem object
+    """
+    model_dict, layer_dicts = fit_problem.model_to_dicts()
+    lines = ["# Reflectivity model\n",
+             "# Created on %s\n" % fit_problem.timestamp,
+             "# Created by the ORNL Reflectivity Fitting Interface [DOI: 10.1016/j.softx.2018.09.001]\n",
+             "# Data File: %s\n\n" % fit_problem.reflectivity_model.data_path,
+             "# scale = %g\n" % model_dict['scale'],
+             "# background = %g\n\n" % model_dict['background'],
+             "# %8s %24s %12s %12s %12s %12s\n" % ('LAYER', 'NAME', 'THICK', 'SLD', 'iSLD', 'ROUGH'),
+             "# %8s %24s %12s %12s %12s\n" % ('FRONT', model_dict['front_name'],
+                                               0, model_dict['front_sld'], 0)]
+    for layer in layer_dicts:
+        lines.append("# %8s %24s %12s %12s %12s %12s\n" % (layer['layer_number'], layer['name'],
+                                                            layer['thickness'], layer['sld'],
+                                                            layer['i_sld'], layer['roughness']))
+    lines.append("# %8s %24s %12s %12s %12s\n" % ('BACK', model_dict['back_name'],
+                                                   0, model_dict['back_sld'],
+                                                   model_dict['back_roughness']))
+    return lines
+
+def iter_model_csv(header_lines, theory, chunk_size=1000):
+    """
+        Generate the content of a model file: the model header followed
+        by the theory curve. The theory rows are formatted a chunk at a time.
+
+        :param list header_lines: model header, as returned by model_header_lines()
+        :param tuple theory: (Q, R) arrays of the theory curve, or None
+        :param int chunk_size: number of theory rows formatted at once
+    """
+    for line in header_lines:
+        yield line
+    if theory is None:
+        return
+    _q, r_model = theory
+    yield "%12s %12s\n" % ("Q", "R")
+    for i in range(0, len(r_model), chunk_size):
+        yield "".join(["%12.6f %12.6f\n" % point for point in zip(_q[i:i+chunk_size],
+                                                                   r_model[i:i+chunk_size])])
+
+def model_theory(html_data, fit_problem):
+    """
+        Return the (Q, R) arrays of the theory curve of a fit problem,
+        computed for the Q values of the data, or None if there is no data.
+
+        :param str html_data: stored json for plotted data, or None
+        :param FitProblem fit_problem: FitProblem object
+    """
+    if html_data is None:
+        return None
+    _q, r_model, _, _, _ = get_theory(html_data, fit_problem)
+    return _q, r_model
+
+def stream_model_csv(request, instrument, data_id):
+    """
+        Return a generator for the model file of a data set, or None
+        if there is no model for it. The model and its theory curve are
+        computed right away, so that errors are raised before the response
+        starts, and the rows are formatted as the output is consumed.
+
+        :param str data_id: run identifier (usually a number)
+        :param str instrument: instrument name, or user name
+    """
+    _, fit_problem = get_fit_problem(request, instrument, data_id)
+    if fit_problem is None:
+        return None
+    header_lines = model_header_lines(fit_problem)
+    # If we have the data, compute the theory curve and return it
+    html_data = data_handler.get_plot_data_from_server(instrument, data_id)
+    return iter_model_csv(header_lines, model_theory(html_data, fit_problem))
+
 def get_model_as_csv(request, instrument, data_id):
     """
         Return an ASCII block with model information to be loaded
@@ -136,42 +217,98 @@ def get_model_as_csv(request, instrument, data_id):
         :param str data_id: run identifier (usually a number)
         :param str instrument: instrument name, or user name
     """
-    ascii_data = None
-    _, fit_problem = get_fit_problem(request, instrument, data_id)
-    if fit_problem is not None:
-        model_dict, layer_dicts = fit_problem.model_to_dicts()
-        ascii_data = "# Reflectivity model\n"
-        ascii_data += "# Created on %s\n" % fit_problem.timestamp
-        ascii_data += "# Created by the ORNL Reflectivity Fitting Interface [DOI: 10.1016/j.softx.2018.09.001]\n"
-        ascii_data += "# Data File: %s\n\n" % fit_problem.reflectivity_model.data_path
-        ascii_data += "# scale = %g\n" % model_dict['scale']
-        ascii_data += "# background = %g\n\n" % model_dict['background']
-        ascii_data += "# %8s %24s %12s %12s %12s %12s\n" % ('LAYER', 'NAME', 'THICK', 'SLD', 'iSLD', 'ROUGH')
-        ascii_data += "# %8s %24s %12s %12s %12s\n" % ('FRONT', model_dict['front_name'],
-                                                       0, model_dict['front_sld'], 0)
-        for layer in layer_dicts:
-            ascii_data += "# %8s %24s %12s %12s %12s %12s\n" % (layer['layer_number'], layer['name'],
-                                                                layer['thickness'], layer['sld'],
-                                                                layer['i_sld'], layer['roughness'])
-
-        ascii_data += "# %8s %24s %12s %12s %12s\n" % ('BACK', model_dict['back_name'],
-                                                       0, model_dict['back_sld'],
-                                                       model_dict['back_roughness'])
+    model_csv = stream_model_csv(request, instrument, data_id)
+    if model_csv is None:
+        return None
+    return "".join(model_csv)
 
-    # If we have the data, compute the theory curve and return it
-    html_data = data_handler.get_plot_data_from_server(instrument, data_id)
-    if html_data is not None:
-        current_str = io.StringIO(extract_ascii_from_div(html_data))
-        current_data = pandas.read_csv(current_str, delim_whitespace=True, comment='#', names=['q','r','dr','dq'])
-        _q, r_model, _, _, _ = job_handling.compute_reflectivity(current_data['q'],
-                                                                current_data['r'],
-                                                                current_data['dr'],
-                                                                current_data['dq'], fit_problem)
-        ascii_data += "%12s %12s\n" % ("Q", "R")
-        for i, r_value in enumerate(r_model):
-            ascii_data += "%12.6f %12.6f\n" % (_q[i], r_value)
-
-    return ascii_data
+class _ZipStream(object):
+    """
+        Write-only file object that keeps what was written until it is
+        collected, so that a zip file can be sent while it is being written.
+    """
+    def __init__(self):
+        self.position = 0
+        self.buffer = []
+
+    def write(self, data):
+        """ Keep the data until it is collected """
+        self.buffer.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        """ Return the number of bytes written so far """
+        return self.position
+
+    def flush(self):
+        """ Nothing to flush, the data is kept until it is collected """
+        pass
+
+    def collect(self):
+        """ Return the data written since the last call """
+        data = b"".join(self.buffer)
+        self.buffer = []
+        return data
+
+def export_fit_list(request):
+    """
+        Return the fits of a user to be exported together.
+        Fits can be selected by data path, with any number of path=<instrument>/<data_id>
+        parameters, or by experiment, with a proposal=<proposal> parameter.
+        All the user's fits are returned if there are no such parameters.
+
+        :param Request request: http request object
+    """
+    fit_list = FitProblem.objects.filter(user=request.user).exclude(data_path__in=['', 'saved'])
+    data_paths = request.GET.getlist('path')
+    if len(data_paths) > 0:
+        fit_list = fit_list.filter(data_path__in=data_paths)
+    proposal = request.GET.get('proposal', '').strip()
+    if len(proposal) > 0:
+        proposal_paths = CatalogCache.objects.filter(proposal=proposal).values_list('data_path', flat=True)
+        fit_list = fit_list.filter(data_path__in=list(proposal_paths))
+    return fit_list.select_related('reflectivity_model').order_by('data_path', '-timestamp')
+
+def iter_model_archive(fit_list):
+    """
+        Generate a zip archive with the model, the data and the theory curve
+        of each fit in a list. Each file is compressed and sent as soon as
+        it is produced, so that only one data set is in memory at once.
+        The fits that could not be exported are listed in errors.txt.
+
+        :param list fit_list: list of FitProblem objects
+    """
+    stream = _ZipStream()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    exported = set()
+    errors = []
+    for fit_problem in fit_list:
+        # Only export the latest fit for each data set
+        if fit_problem.data_path in exported:
+            continue
+        exported.add(fit_problem.data_path)
+        instrument, data_id = parse_data_path(fit_problem.data_path)
+        if instrument is None or data_id is None:
+            continue
+        base_name = "%s_%s" % (instrument.upper(), data_id)
+        try:
+            header_lines = model_header_lines(fit_problem)
+            html_data = data_handler.get_plot_data_from_server(instrument, data_id)
+            ascii_data = extract_ascii_from_div(html_data) if html_data is not None else None
+            if ascii_data is not None:
+                ascii_data = "# %s Run %s\n# X Y dY dX\n%s" % (instrument.upper(), data_id, ascii_data)
+                archive.writestr("%s.txt" % base_name, ascii_data.encode('utf-8'))
+                yield stream.collect()
+            model_csv = "".join(iter_model_csv(header_lines, model_theory(html_data, fit_problem)))
+            archive.writestr("%s_model.txt" % base_name, model_csv.encode('utf-8'))
+            yield stream.collect()
+        except:
+            logging.error("Could not export %s: %s", fit_problem.data_path, sys.exc_value)
+            errors.append("Could not export %s\n" % fit_problem.data_path)
+    if len(errors) > 0:
+        archive.writestr("errors.txt", "".join(errors).encode('utf-8'))
+    archive.close()
+    yield stream.collect()
 
 def get_results(request, fit_problem):
     """
@@ -211,30 +348,60 @@ def get_results(request, fit_problem):
         # Regardless of whether we have a fit result, we can still show the model.
         # We apply the constraints in case one of the models tied to this data
         # set has changed
-        for item in Constraint.objects.filter(fit_problem=fit_problem):
-            item.apply_constraint(fit_problem)
+        Constraint.apply_constraints(fit_problem)
     else:
         errors.append("No model found for this data set")
 
     return chi2, latest, errors, can_update
 
-def get_plot_from_html(html_data, rq4=False, fit_problem=None):
+def _read_plot_data(html_data):
+    """
+        Read the data stored in a plot <div> into a data frame
+        :param str html_data: stored json for plotted data
+    """
+    import pandas
+    current_str = io.StringIO(extract_ascii_from_div(html_data))
+    return pandas.read_csv(current_str, delim_whitespace=True, comment='#', names=ASCII_COLUMNS)
+
+def get_theory(html_data, fit_problem, current_data=None, fingerprint=None):
+    """
+        Compute the theory curve of a model for a data set. The Q, R, Z and SLD
+        arrays are cached until the data or the model change, so that plotting
+        and exporting a model only compute it once.
+        Returns the same (q, r, z, sld, chi2) tuple as compute_reflectivity().
+
+        :param str html_data: stored json for plotted data
+        :param FitProblem fit_problem: FitProblem object
+        :param DataFrame current_data: data, if it was already read
+        :param str fingerprint: fingerprint of the model, if it was already computed
+    """
+    cache_key = plot_cache_key([html_data], [fingerprint or fit_problem], theory=True)
+    theory = cache.get(cache_key)
+    signals.cache_lookup.send_robust(sender=FitProblem, cache='theory', hit=theory is not None)
+    if theory is None:
+        if current_data is None:
+            current_data = _read_plot_data(html_data)
+        theory = job_handling.compute_reflectivity(current_data['q'],
+                                                   current_data['r'],
+                                                   current_data['dr'],
+                                                   current_data['dq'], fit_problem)
+        cache.set(cache_key, theory, getattr(settings, 'PLOT_CACHE_TIMEOUT', 86400))
+    return theory
+
+def get_plot_from_html(html_data, rq4=False, fit_problem=None, fingerprint=None):
     """
         Process html data and return plot data
 
         :param str html_data: stored json for plotted data
         :param bool rq4: if True, the plot will be in R*Q^4
         :param FitProblem fit_problem: if supplied, a theory curve will be added
+        :param str fingerprint: fingerprint of the model, if it was already computed
     """
-    current_str = io.StringIO(extract_ascii_from_div(html_data))
-    current_data = pandas.read_csv(current_str, delim_whitespace=True, comment='#', names=['q','r','dr','dq'])
+    current_data = _read_plot_data(html_data)
     chi2 = None
     sld_plot = None
     if fit_problem:
-        _q, r_model, z, sld, chi2 = job_handling.compute_reflectivity(current_data['q'],
-                                                                     current_data['r'],
-                                                                     current_data['dr'],
-                                                                     current_data['dq'], fit_problem)
+        _q, r_model, z, sld, chi2 = get_theory(html_data, fit_problem, current_data, fingerprint)
         sld_plot = [z, sld]
 
     if rq4 is True:
@@ -254,20 +421,125 @@ def get_plot_from_html(html_data, rq4=False, fit_problem=None):
 
     return plots, labels, sld_plot, chi2
 
-def assemble_plots(request, instrument, data_id, fit_problem, rq4=False):
+def model_fingerprint(problem):
+    """
+        Return a hash of the parameters of a model, along with its constraints.
+        Returns None if there is no model.
+
+        :param problem: FitProblem object, or FitProblem-like object parsed from a log
+    """
+    if problem is None:
+        return None
+    if isinstance(problem, FitProblem):
+        constraints = Constraint.objects.filter(fit_problem=problem).order_by('id')
+        content = [problem.id, problem.model_to_dicts(),
+                   list(constraints.values_list('layer_id', 'parameter', 'variables', 'definition'))]
+    else:
+        content = problem.model_to_dicts(pretty_print=False)
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def plot_cache_key(data_list, problem_list, **options):
+    """
+        Return the cache key for a set of plots.
+
+        :param list data_list: list of plot data, as stored on the data server
+        :param list problem_list: list of models plotted with the data, or their fingerprints
+        :param options: any other option that changes the plots
+    """
+    h = hashlib.sha1()
+    for html_data in data_list:
+        if not isinstance(html_data, bytes):
+            html_data = html_data.encode('utf-8')
+        h.update(hashlib.sha1(html_data).hexdigest())
+    for problem in problem_list:
+        if not isinstance(problem, basestring):
+            problem = model_fingerprint(problem)
+        h.update(str(problem))
+    options['max_points'] = getattr(settings, 'PLOT_MAX_POINTS', 1000)
+    h.update(json.dumps(options, sort_keys=True))
+    return 'fitting-plots:%s' % h.hexdigest()
+
+def assembled_plots_key(data_paths, problem_list, job_list, **options):
+    """
+        Return the cache key for the plots of a set of data sets and their models.
+        It only uses what is in the database, which all processes share, rather than
+        the data or the fit results: the data paths, the timestamp of the uploaded data,
+        the parameters of the models and the time of the latest log of their fitting jobs.
+
+        :param list data_paths: data paths, of the form <instrument>/<data>
+        :param list problem_list: FitProblem objects plotted with the data, or None
+        :param list job_list: IDs of the remote jobs whose results are plotted
+        :param options: any other option that changes the plots
+    """
+    h = hashlib.sha1()
+    h.update(json.dumps(data_paths).encode('utf-8'))
+    # Uploaded data is stored under the user name, and gets a new timestamp when uploaded again
+    uploads = Q(pk=None)
+    for data_path in data_paths:
+        instrument, data_id = parse_data_path(data_path)
+        if instrument is not None and data_id is not None:
+            uploads |= Q(user__username=instrument, file_id=data_id)
+    timestamps = UserData.objects.filter(uploads).values_list('user__username', 'file_id', 'timestamp')
+    h.update(str(sorted(timestamps)))
+    for problem in problem_list:
+        h.update(str(model_fingerprint(problem)))
+    job_list = [job_id for job_id in job_list if job_id is not None]
+    if len(job_list) > 0:
+        log_times = Log.objects.filter(job_id__in=job_list).values_list('job_id').annotate(Max('time'))
+        h.update(str(sorted(log_times)))
+    options['max_points'] = getattr(settings, 'PLOT_MAX_POINTS', 1000)
+    h.update(json.dumps(options, sort_keys=True))
+    return 'fitting-plots:%s' % h.hexdigest()
+
+def plot_cache_timeout(request, data_paths):
+    """
+        Return the time the plots of a set of data sets are cached, in seconds.
+        Uploaded data is versioned, but an instrument run may be reduced again
+        on the live data server, so its plots expire after LIVE_PLOT_CACHE_TIMEOUT.
+
+        :param Request request: http request object
+        :param list data_paths: data paths, of the form <instrument>/<data>
+    """
+    timeout = getattr(settings, 'PLOT_CACHE_TIMEOUT', 86400)
+    user_name = str(getattr(request, 'user', '')).lower()
+    for data_path in data_paths:
+        instrument, _ = parse_data_path(data_path)
+        if instrument is None or not instrument.lower() == user_name:
+            return min(timeout, getattr(settings, 'LIVE_PLOT_CACHE_TIMEOUT', 300))
+    return timeout
+
+def assemble_plots(request, instrument, data_id, fit_problem, rq4=False, as_json=False, encoding='list', refresh=True):
     """
         Find all that needs to be plotted for this fit problem.
+        The plots are cached until the data or one of the models change. The cache
+        is checked before the data and the fit results are retrieved.
 
         :param str instrument: instrument name, or user name
         :param str data_id: run identifier (usually a number)
         :param FitProblem fit_problem: FitProblem object
         :param bool rq4: if True, the plot will be in R*Q^4
+        :param bool as_json: if True, return a list of figure dictionaries instead of html
+        :param str encoding: encoding of the numerical arrays when returning figures
+        :param bool refresh: if False, the fit results were just retrieved and don't need to be refreshed
     """
     data_list = []
     data_names = []
     sld_list = []
     sld_names = []
-    r_plot = ""
+    # Find the extra data, and whether we have a fit result for it
+    extra_paths = find_overlay_paths(fit_problem)
+    extra_fits = [get_fit_problem(request, *parse_data_path(extra_name))[1] for extra_name in extra_paths]
+
+    data_paths = ['%s/%s' % (instrument, data_id)] + extra_paths
+    problems = [fit_problem] + extra_fits
+    cache_key = assembled_plots_key(data_paths, problems,
+                                    [problem.remote_job_id for problem in problems if problem is not None],
+                                    rq4=rq4, as_json=as_json, encoding=encoding)
+    cached = cache.get(cache_key)
+    signals.cache_lookup.send_robust(sender=FitProblem, cache='plots', hit=cached is not None)
+    if cached is not None:
+        return cached
+
     # Find the data
     html_data = data_handler.get_plot_data_from_server(instrument, data_id)
     # If we can't retrieve data from the plot server, then the data doesn't exist and
@@ -276,46 +548,105 @@ def assemble_plots(request, instrument, data_id, fit_problem, rq4=False):
         raise Http404
 
     # Refresh the parameters first, because a job might have completed
-    get_results(request, fit_problem)
+    if refresh:
+        get_results(request, fit_problem)
+
+    extra_data = []
+    for extra_name, extra_fit in zip(extra_paths, extra_fits):
+        extra_html = data_handler.get_plot_data_from_server(*parse_data_path(extra_name))
+        if extra_html is None:
+            continue
+        # Update the model according to the latest log, as necessary
+        if extra_fit is not None:
+            get_results(request, extra_fit)
+        extra_data.append((extra_name, extra_html, extra_fit))
 
-    plots, labels, sld_plot, chi2 = get_plot_from_html(html_data, rq4, fit_problem)
+    fingerprints = [model_fingerprint(problem) for problem in [fit_problem] + [item[2] for item in extra_data]]
+    plots, labels, sld_plot, chi2 = get_plot_from_html(html_data, rq4, fit_problem, fingerprints[0])
     data_list.extend(plots)
     data_names.extend(labels)
     if sld_plot:
         sld_list.append(sld_plot)
         sld_names.append("SLD")
 
-    # Extra data
-    extra_data = find_overlay_data(fit_problem)
-    for extra_name, extra_html in extra_data:
-        # First check whether we have a fit result for this data
-        instrument_, data_id_ = parse_data_path(extra_name)
-        _, extra_fit = get_fit_problem(request, instrument_, data_id_)
-        # Update the model according to the latest log, as necessary
-        if extra_fit is not None:
-            get_results(request, extra_fit)
+    for i, (extra_name, extra_html, extra_fit) in enumerate(extra_data):
         # Add the data itself
-        plots, _, sld_plot, _ = get_plot_from_html(extra_html, rq4, extra_fit)
+        plots, _, sld_plot, _ = get_plot_from_html(extra_html, rq4, extra_fit, fingerprints[i+1])
         data_list.extend(plots)
         data_names.extend(len(plots)*[extra_name])
         if sld_plot:
             sld_list.append(sld_plot)
             sld_names.append(extra_name)
 
+    # Plots are only downsampled for display
+    max_points = getattr(settings, 'PLOT_MAX_POINTS', 1000)
     y_title=u"Reflectivity"
     if rq4 is True:
         y_title += u" x Q<sup>4</sup> (1/A<sup>4</sup>)"
 
+    figures = []
     if len(data_list) > 0:
-        r_plot = plot1d(data_list, data_names=data_names, x_title=u"Q (1/A)", y_title=y_title)
+        figures.append(plot1d_figure(data_list, data_names=data_names, x_title=u"Q (1/A)",
+                                     y_title=y_title, encoding=None if not as_json else encoding,
+                                     max_points=max_points))
+        if as_json and not rq4:
+            add_rq4_titles(figures[0])
 
     if len(sld_list) > 0:
-        sld_plot = plot1d(sld_list, x_log=False, y_log=False,
-                          data_names=sld_names, x_title=u"Z (A)",
-                          y_title='SLD (10<sup>-6</sup>/A<sup>2</sup>)')
-        r_plot = "<div>%s</div><div>%s</div>" % (r_plot, sld_plot)
+        figures.append(plot1d_figure(sld_list, x_log=False, y_log=False,
+                                     data_names=sld_names, x_title=u"Z (A)",
+                                     y_title='SLD (10<sup>-6</sup>/A<sup>2</sup>)',
+                                     encoding=None if not as_json else encoding, max_points=max_points))
+
+    output = (figures, chi2) if as_json else (render_figures(figures), chi2)
+    cache.set(cache_key, output, plot_cache_timeout(request, data_paths))
+    return output
+
+def add_rq4_titles(figure):
+    """
+        Flag a reflectivity figure holding R values as one that the browser can
+        switch to R*Q^4, and give it the y-axis title for each representation.
+
+        :param dict figure: figure dictionary from plot1d_figure
+    """
+    figure['r_title'] = figure['layout']['yaxis']['title']
+    figure['rq4_title'] = u"Reflectivity x Q<sup>4</sup> (1/A<sup>4</sup>)"
+    return figure
+
+@timing.timed('plot')
+def render_figures(figures):
+    """
+        Render a list of figures as html divs, nested the way the templates expect.
+
+        :param list figures: list of figure dictionaries from plot1d_figure
+    """
+    import plotly.offline as py
+    r_plot = ""
+    for i, fig in enumerate(figures):
+        plot_div = py.plot(fig, output_type='div', include_plotlyjs=False, show_link=False)
+        r_plot = plot_div if i == 0 else "<div>%s</div><div>%s</div>" % (r_plot, plot_div)
+    return r_plot
+
+def plot_payload_encoding(request):
+    """
+        Return the encoding requested for a JSON plot payload, falling
+        back on the PLOT_ENCODING setting.
+
+        :param Request request: http request object
+    """
+    default = getattr(settings, 'PLOT_ENCODING', 'float32')
+    encoding = request.GET.get('encoding', default)
+    if encoding not in PLOT_ENCODINGS:
+        encoding = default
+    return encoding
 
-    return r_plot, chi2
+def find_overlay_paths(fit_problem):
+    """
+        Find the data paths of the extra data to be over-plotted for a given fit problem.
+
+        :param FitProblem fit_problem: FitProblem object
+    """
+    return list(SimultaneousModel.objects.filter(fit_problem=fit_problem).values_list('dependent_data', flat=True))
 
 def find_overlay_data(fit_problem):
     """
@@ -324,11 +655,11 @@ def find_overlay_data(fit_problem):
         :param FitProblem fit_problem: FitProblem object
     """
     simult_data = []
-    for item in SimultaneousModel.objects.filter(fit_problem=fit_problem):
-        instrument_, data_id_ = parse_data_path(item.dependent_data)
+    for dependent_data in find_overlay_paths(fit_problem):
+        instrument_, data_id_ = parse_data_path(dependent_data)
         html_data = data_handler.get_plot_data_from_server(instrument_, data_id_)
         if html_data is not None:
-            simult_data.append([item.dependent_data, html_data])
+            simult_data.append([dependent_data, html_data])
     return simult_data
 
 def is_fittable(data_form, layers_form):
@@ -399,6 +730,7 @@ def _evaluate_model(data_form, layers_form, html_data, fit=True, user=None, run_
                                     owner=user,
                                     interpreter=python2_interpreter,
                                     server=server)[0]
+    signals.job_queued.send_robust(sender=Job, job=job)
     submit_job_to_server.delay(
         job_pk=job.pk,
         password='',
@@ -446,9 +778,16 @@ def _process_fit_problem(fit_problem, instrument, data_id, options, work_dir, ou
         errors.append("Reflectivity fitting object was invalid")
     return script, [data_file, ascii_data], expt_name, errors
 
-def evaluate_simultaneous_fit(request, instrument, data_id, run_info):
+def assemble_simultaneous_job(request, instrument, data_id, run_info):
     """
-        Assemble all the information for co-refinement
+        Write the job script for the co-refinement of a data set and the
+        data sets appended to it. Returns the data path, the fit problem,
+        the work directory, the job script and a list of errors.
+
+        :param Request request: request object
+        :param str instrument: instrument name
+        :param str data_id: data set identifier
+        :param dict run_info: run information from the catalog, or None
     """
     error_list = []
     data_path, fit_problem = get_fit_problem(request, instrument, data_id)
@@ -495,11 +834,20 @@ def evaluate_simultaneous_fit(request, instrument, data_id, run_info):
 
     # Now the constraints
     script_models += "\n# Constraints ##################################################################\n"
-    for item in SimultaneousConstraint.objects.filter(fit_problem=fit_problem, user=request.user):
-        script_models += item.get_constraint(sample_name='sample') + '\n'
+    constraints = SimultaneousConstraint.objects.filter(fit_problem=fit_problem, user=request.user)
+    for constraint in SimultaneousConstraint.get_constraints(constraints, sample_name='sample'):
+        script_models += constraint + '\n'
 
     data_script = job_handling.assemble_data_setup(data_files)
     job_script = job_handling.assemble_job(script_models, data_script, expt_names, data_ids, options, work_dir, output_dir)
+    return data_path, fit_problem, work_dir, job_script, error_list
+
+def evaluate_simultaneous_fit(request, instrument, data_id, run_info):
+    """
+        Assemble all the information for co-refinement
+    """
+    data_path, fit_problem, work_dir, job_script, error_list = assemble_simultaneous_job(request, instrument,
+                                                                                         data_id, run_info)
 
     # Submit job
     server = Server.objects.get_or_create(title='Analysis', hostname=settings.JOB_HANDLING_HOST, port=settings.JOB_HANDLING_PORT)[0]
@@ -517,6 +865,7 @@ def evaluate_simultaneous_fit(request, instrument, data_id, run_info):
                                     owner=request.user,
                                     interpreter=python2_interpreter,
                                     server=server)[0]
+    signals.job_queued.send_robust(sender=Job, job=job)
     submit_job_to_server.delay(
         job_pk=job.pk,
         password='',
@@ -533,61 +882,124 @@ def evaluate_simultaneous_fit(request, instrument, data_id, run_info):
 
     return dict(job_id=job.pk, error_list=error_list)
 
+def _bulk_create_layers(layers):
+    """
+        Insert new layers with a single query and return them with their primary key set.
+
+        :param list layers: list of unsaved ReflectivityLayer objects
+    """
+    if len(layers) == 0:
+        return layers
+    if connection.features.can_return_ids_from_bulk_insert:
+        return ReflectivityLayer.objects.bulk_create(layers)
+    if connection.vendor == 'sqlite':
+        # The first insert gives us its id and takes the SQLite write lock,
+        # which is held until the end of the transaction. No other connection
+        # can insert rows until then, so the other layers follow that id.
+        with transaction.atomic(savepoint=False):
+            layers[0].save()
+            if len(layers) > 1:
+                ReflectivityLayer.objects.bulk_create(layers[1:])
+                pk_list = ReflectivityLayer.objects.filter(pk__gt=layers[0].pk).order_by('id').values_list('id', flat=True)
+                for layer, pk in zip(layers[1:], pk_list[:len(layers)-1]):
+                    layer.pk = pk
+        return layers
+    for layer in layers:
+        layer.save()
+    return layers
+
+def _replace_layers(fit_problem, layers):
+    """
+        Replace the layers of a fit problem using a single insert in the M2M table.
+
+        :param FitProblem fit_problem: fit problem to update
+        :param list layers: list of saved ReflectivityLayer objects
+    """
+    fit_problem.layers.clear()
+    through = FitProblem.layers.through
+    through.objects.bulk_create([through(fitproblem_id=fit_problem.id, reflectivitylayer_id=layer.pk)
+                                 for layer in layers])
+
+def _copy_layers(fit_problem):
+    """
+        Return copies of the layers of a fit problem, ordered by layer number.
+
+        :param FitProblem fit_problem: fit problem to copy the layers of
+    """
+    layers = list(fit_problem.layers.all().order_by('layer_number'))
+    for layer in layers:
+        layer.pk = None
+    return _bulk_create_layers(layers)
+
 def save_fit_problem(data_form, layers_form, job_object, user):
     """
         Save the state of the model forms
     """
-    # Save the ReflectivityModel object
-    ref_model = data_form.save()
-    fit_problem_list = FitProblem.objects.filter(user=user,
-                                                 reflectivity_model__data_path=data_form.cleaned_data['data_path'])
-    fit_created = False
-    if len(fit_problem_list) > 0:
-        fit_problem = fit_problem_list.latest('timestamp')
-        # Replace foreign keys
-        old_job = fit_problem.remote_job
-        fit_problem.remote_job = job_object
-        fit_problem.reflectivity_model = ref_model
-        # Clean up previous data that is now obsolete
-        if old_job is not None:
-            old_job.delete()
-    else:
-        fit_problem = FitProblem(user=user, reflectivity_model=ref_model,
-                                 remote_job=job_object)
-        fit_created = True
-    fit_problem.save()
-    fit_problem.layers.clear()
+    with transaction.atomic():
+        # Save the ReflectivityModel object
+        ref_model = data_form.save()
+        fit_problem_list = FitProblem.objects.filter(user=user,
+                                                     data_path=data_form.cleaned_data['data_path'])
+        fit_created = False
+        if len(fit_problem_list) > 0:
+            fit_problem = fit_problem_list.latest('timestamp')
+            # Replace foreign keys
+            old_job = fit_problem.remote_job
+            fit_problem.remote_job = job_object
+            fit_problem.reflectivity_model = ref_model
+            # Clean up previous data that is now obsolete
+            if old_job is not None:
+                old_job.delete()
+        else:
+            fit_problem = FitProblem(user=user, reflectivity_model=ref_model,
+                                     remote_job=job_object)
+            fit_created = True
+        fit_problem.save()
 
-    # Save the layer parameters
-    for layer in layers_form:
-        if 'remove' in layer.cleaned_data and layer.cleaned_data['remove'] is False:
+        # Keep the layers that were not removed, ordered and numbered starting at 1
+        kept_layers = [layer for layer in layers_form
+                       if 'remove' in layer.cleaned_data and layer.cleaned_data['remove'] is False]
+        kept_layers.sort(key=lambda layer: layer.cleaned_data['layer_number'])
+
+        if fit_created:
             # The object ID is part of the form, so if we changed the dataset
             # while submitting (if we had to create a new FitProblem), then
             # we need to copy the layers, not update them.
             # We also need to copy over any existing constraint.
-            if fit_created:
-                c_list = Constraint.objects.filter(layer=layer.cleaned_data['id'])
-                layer.cleaned_data['id'] = None
-                l_object = ReflectivityLayer.objects.create(**(layer.cleaned_data))
-                if len(c_list) > 0:
-                    Constraint.objects.create(user=c_list[0].user,
-                                              fit_problem=fit_problem,
-                                              definition=c_list[0].definition,
-                                              layer=l_object,
-                                              parameter=c_list[0].parameter,
-                                              variables=c_list[0].variables)
-            else:
-                l_object = layer.save()
-            fit_problem.layers.add(l_object)
-
-    # Reorder the layers
-    i = 0
-    for layer in fit_problem.layers.all().order_by('layer_number'):
-        i += 1
-        layer.layer_number = i
-        layer.save()
-
-    fit_problem.save()
+            old_layers = []
+            l_objects = []
+            for i, layer in enumerate(kept_layers):
+                old_layers.append(layer.cleaned_data['id'])
+                layer_data = dict(layer.cleaned_data, id=None, layer_number=i+1)
+                l_objects.append(ReflectivityLayer(**layer_data))
+            l_objects = _bulk_create_layers(l_objects)
+
+            old_ids = [old_layer.pk for old_layer in old_layers if old_layer is not None]
+            constraints = {}
+            for constraint in Constraint.objects.filter(layer__in=old_ids).order_by('-id'):
+                constraints[constraint.layer_id] = constraint
+            new_constraints = []
+            for old_layer, l_object in zip(old_layers, l_objects):
+                if old_layer is not None and old_layer.pk in constraints:
+                    c_obj = constraints[old_layer.pk]
+                    new_constraints.append(Constraint(user_id=c_obj.user_id,
+                                                      fit_problem=fit_problem,
+                                                      definition=c_obj.definition,
+                                                      layer=l_object,
+                                                      parameter=c_obj.parameter,
+                                                      variables=c_obj.variables))
+            Constraint.objects.bulk_create(new_constraints)
+        else:
+            l_objects = []
+            for i, layer in enumerate(kept_layers):
+                l_object = layer.save(commit=False)
+                # Only write the layers that changed
+                if l_object.pk is None or layer.has_changed() or not l_object.layer_number == i+1:
+                    l_object.layer_number = i+1
+                    l_object.save()
+                l_objects.append(l_object)
+
+        _replace_layers(fit_problem, l_objects)
     return fit_problem
 
 def apply_model(fit_problem, saved_model, instrument, data_id):
@@ -598,31 +1010,25 @@ def apply_model(fit_problem, saved_model, instrument, data_id):
     if fit_problem is not None:
         data_path = fit_problem.reflectivity_model.data_path
 
-    # Make a copy of the ReflectivityModel object
-    ref_model = saved_model.fit_problem.reflectivity_model
-    ref_model.pk = None
-    ref_model.data_path = data_path
-    ref_model.save()
-
-    if fit_problem is not None:
-        old_model = fit_problem.reflectivity_model
-        fit_problem.reflectivity_model = ref_model
-        fit_problem.remote_job = None
-        fit_problem.save()
-        old_model.delete()
-    else:
-        fit_problem = FitProblem(user=saved_model.user, reflectivity_model=ref_model)
-        fit_problem.save()
-
-    # Copy over the layers
-    fit_problem.layers.clear()
-    for layer in saved_model.fit_problem.layers.all().order_by('layer_number'):
-        layer.id = None
-        layer.pk = None
-        layer.save()
-        fit_problem.layers.add(layer)
+    with transaction.atomic():
+        # Make a copy of the ReflectivityModel object
+        ref_model = saved_model.fit_problem.reflectivity_model
+        ref_model.pk = None
+        ref_model.data_path = data_path
+        ref_model.save()
+
+        if fit_problem is not None:
+            old_model = fit_problem.reflectivity_model
+            fit_problem.reflectivity_model = ref_model
+            fit_problem.remote_job = None
+            fit_problem.save()
+            old_model.delete()
+        else:
+            fit_problem = FitProblem(user=saved_model.user, reflectivity_model=ref_model)
+            fit_problem.save()
 
-    fit_problem.save()
+        # Copy over the layers
+        _replace_layers(fit_problem, _copy_layers(saved_model.fit_problem))
     return fit_problem
 
 def model_hash(fit_problem):
@@ -637,32 +1043,141 @@ def copy_fit_problem(fit_problem, user):
     """
         Make a duplicate copy of a FitProblem object
     """
-    # Make a copy of the ReflectivityModel object
-    ref_model = fit_problem.reflectivity_model
-    ref_model.pk = None
-    ref_model.data_path = "saved"
-    ref_model.save()
+    with transaction.atomic():
+        # Make a copy of the ReflectivityModel object
+        ref_model = fit_problem.reflectivity_model
+        ref_model.pk = None
+        ref_model.data_path = "saved"
+        ref_model.save()
+
+        # Create a new FitProblem object
+        fit_problem_copy = FitProblem(user=user, reflectivity_model=ref_model)
+        fit_problem_copy.save()
+
+        # Copy over the layers
+        _replace_layers(fit_problem_copy, _copy_layers(fit_problem))
+    return fit_problem_copy
 
-    # Create a new FitProblem object
-    fit_problem_copy = FitProblem(user=user, reflectivity_model=ref_model)
-    fit_problem_copy.save()
+# Encodings available for the numerical arrays of a JSON plot payload
+PLOT_ENCODINGS = ['list', 'float32', 'base64']
 
-    # Copy over the layers
-    for layer in fit_problem.layers.all().order_by('layer_number'):
-        layer.id = None
-        layer.pk = None
-        layer.save()
-        fit_problem_copy.layers.add(layer)
+def encode_array(values, encoding=None):
+    """
+        Encode an array of values for a plot payload.
 
-    fit_problem_copy.save()
-    return fit_problem_copy
+        With no encoding, the values are returned as-is for plotly to serialize.
+        The 'list' encoding returns a list of floats, 'float32' returns a list of
+        floats rounded to single precision, and 'base64' returns the little-endian
+        float32 bytes packed as a base64 string, to be decoded by the browser.
+        Non-finite values are sent as null, except in the base64 encoding where
+        they stay NaN.
 
-def plot1d(data_list, data_names=None, x_title='', y_title='',
-           x_log=True, y_log=True, show_dx=False):
+        :param array values: values to encode
+        :param str encoding: one of None, 'list', 'float32', or 'base64'
     """
-        Produce a 1D plot
+    if encoding is None:
+        return values
+    if encoding not in PLOT_ENCODINGS:
+        raise ValueError("Unknown plot encoding: %s" % encoding)
+
+    array = np.asarray(values, dtype=np.float64)
+    if encoding == 'base64':
+        return {'dtype': 'float32', 'bdata': base64.b64encode(array.astype('<f4').tobytes()).decode('ascii')}
+
+    finite = np.isfinite(array)
+    if encoding == 'float32':
+        # Round to the seven significant digits a float32 can hold, so that the values
+        # are written with at most seven digits. Dividing by an exact power of ten
+        # gives the float closest to the rounded decimal value.
+        array = np.where(finite, array, 0)
+        nonzero = array != 0
+        exponent = np.zeros(array.shape)
+        exponent[nonzero] = 6 - np.floor(np.log10(np.abs(array[nonzero])))
+        scale = 10.0 ** np.abs(exponent)
+        array = np.where(exponent >= 0, np.round(array * scale) / scale, np.round(array / scale) * scale)
+    output = array.tolist()
+    if not finite.all():
+        for i in np.flatnonzero(~finite):
+            output[i] = None
+    return output
+
+def _log_scale(values):
+    """
+        Return log10 of the values, replacing non-positive values by the
+        smallest positive one so that they don't dominate the point selection.
+        :param array values: array of values
+    """
+    positive = values[values > 0]
+    floor = positive.min() if len(positive) > 0 else 1.0
+    return np.log10(np.clip(values, floor, None))
+
+def lttb_indices(x, y, n_out):
+    """
+        Select the points to keep to represent a curve with n_out points,
+        using the Largest-Triangle-Three-Buckets algorithm. The first and last
+        points are always kept, and one point is kept in each bucket in-between:
+        the one that forms the largest triangle with the previously kept point
+        and the average of the next bucket.
+
+        :param array x: x values, in increasing order
+        :param array y: y values
+        :param int n_out: number of points to keep
+    """
+    n_points = len(x)
+    if n_out >= n_points or n_out < 3:
+        return np.arange(n_points)
+
+    edges = np.linspace(1, n_points - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0] = 0
+    indices[-1] = n_points - 1
+    selected = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = n_points - 1, n_points
+        avg_x = np.mean(x[next_start:next_end])
+        avg_y = np.mean(y[next_start:next_end])
+        area = np.abs((x[selected] - avg_x) * (y[start:end] - y[selected])
+                      - (x[selected] - x[start:end]) * (avg_y - y[selected]))
+        area = np.where(np.isfinite(area), area, -1)
+        selected = start + int(np.argmax(area))
+        indices[i + 1] = selected
+    return indices
+
+def downsample_trace(trace, max_points, x_log=False, y_log=False):
+    """
+        Reduce a trace to at most max_points points for display.
+        The points are selected in the space the trace is plotted in,
+        and the same points are kept for the error bars.
+
+        :param list trace: list of arrays [x, y, dy, dx], where dy and dx are optional
+        :param int max_points: maximum number of points, or 0 to keep them all
+        :param bool x_log: if True, the x axis is logarithmic
+        :param bool y_log: if True, the y axis is logarithmic
+    """
+    if not max_points or len(trace[0]) <= max_points:
+        return trace
+    x = np.asarray(trace[0], dtype=np.float64)
+    y = np.asarray(trace[1], dtype=np.float64)
+    indices = lttb_indices(_log_scale(x) if x_log else x,
+                           _log_scale(y) if y_log else y, max_points)
+    return [np.asarray(item)[indices] for item in trace]
+
+@timing.timed('plot')
+def plot1d_figure(data_list, data_names=None, x_title='', y_title='',
+                  x_log=True, y_log=True, show_dx=False, encoding='list', max_points=0):
+    """
+        Produce the figure for a 1D plot, as a JSON-serializable dictionary
+        with a list of traces and a layout, which plotly.js can render.
+        Traces with more than max_points points are downsampled for display.
+
         :param data_list: list of traces [ [x1, y1], [x2, y2], ...]
         :param data_names: name for each trace, for the legend
+        :param str encoding: encoding of the numerical arrays (see encode_array)
+        :param int max_points: maximum number of points per trace, or 0 to keep them all
     """
     # Skipping this nice blue pair for the nicer blue/gray 'rgb(166,206,227)', 'rgb(31,120,180)'
     colors = ['#1f77b4', 'rgb(102,102,102)', 'rgb(178,223,138)', 'rgb(51,160,44)', 'rgb(251,154,153)', 'rgb(227,26,28)', 'rgb(253,191,111)', 'rgb(255,127,0)', 'rgb(202,178,214)', 'rgb(106,61,154)', 'rgb(255,255,153)', 'rgb(177,89,40)']
@@ -680,34 +1195,39 @@ def plot1d(data_list, data_names=None, x_title='', y_title='',
         if isinstance(data_names, list) and len(data_names) == 1:
             label = data_names[0]
             show_legend = True
-        data = [go.Scatter(name=label, x=data_list[0], y=data_list[1])]
+        x_data, y_data = downsample_trace(data_list, max_points, x_log, y_log)
+        data = [dict(type='scatter', name=label,
+                     x=encode_array(x_data, encoding),
+                     y=encode_array(y_data, encoding))]
     else:
         for i in range(len(data_list)):
             label = ''
             if isinstance(data_names, list) and len(data_names) == len(data_list):
                 label = data_names[i]
                 show_legend = True
+            trace_data = downsample_trace(data_list[i], max_points, x_log, y_log)
             err_x = {}
             err_y = {}
-            if len(data_list[i]) >= 3:
+            if len(trace_data) >= 3:
                 n_data += 2
-                err_y = dict(type='data', array=data_list[i][2], visible=True, color=colors[n_data%12])
+                err_y = dict(type='data', array=encode_array(trace_data[2], encoding), visible=True, color=colors[n_data%12])
             else:
                 n_fit += 2
-            if len(data_list[i]) >= 4:
-                err_x = dict(type='data', array=data_list[i][3], visible=True, color=colors[n_data%12])
+            if len(trace_data) >= 4:
+                err_x = dict(type='data', array=encode_array(trace_data[3], encoding), visible=True, color=colors[n_data%12])
                 if show_dx is False:
                     err_x['thickness'] = 0
 
+            trace = dict(type='scatter', name=label,
+                         x=encode_array(trace_data[0], encoding),
+                         y=encode_array(trace_data[1], encoding),
+                         error_x=err_x, error_y=err_y)
             if len(err_y) == 0:
-                data.append(go.Scatter(name=label, x=data_list[i][0], y=data_list[i][1],
-                                       error_x=err_x, error_y=err_y,
-                                       line=dict(color=colors[n_fit%12],width=2)))
+                trace['line'] = dict(color=colors[n_fit%12], width=2)
             else:
-                data.append(go.Scatter(name=label, x=data_list[i][0], y=data_list[i][1],
-                                       mode='markers', marker=dict(color=colors[n_data%12]),
-                                       error_x=err_x, error_y=err_y))
-
+                trace['mode'] = 'markers'
+                trace['marker'] = dict(color=colors[n_data%12])
+            data.append(trace)
 
     x_layout = dict(title=x_title, zeroline=False, exponentformat="power",
                     showexponent="all", showgrid=True,
@@ -720,7 +1240,7 @@ def plot1d(data_list, data_names=None, x_title='', y_title='',
     if y_log:
         y_layout['type'] = 'log'
 
-    layout = go.Layout(
+    layout = dict(
         showlegend=show_legend,
         autosize=True,
         width=850,
@@ -732,35 +1252,250 @@ def plot1d(data_list, data_names=None, x_title='', y_title='',
         yaxis=y_layout
     )
 
-    fig = go.Figure(data=data, layout=layout)
+    return dict(data=data, layout=layout)
+
+@timing.timed('plot')
+def plot1d(data_list, data_names=None, x_title='', y_title='',
+           x_log=True, y_log=True, show_dx=False, max_points=0):
+    """
+        Produce a 1D plot
+        :param data_list: list of traces [ [x1, y1], [x2, y2], ...]
+        :param data_names: name for each trace, for the legend
+        :param int max_points: maximum number of points per trace, or 0 to keep them all
+    """
+    import plotly.offline as py
+    fig = plot1d_figure(data_list, data_names=data_names, x_title=x_title, y_title=y_title,
+                        x_log=x_log, y_log=y_log, show_dx=show_dx, encoding=None, max_points=max_points)
     plot_div = py.plot(fig, output_type='div', include_plotlyjs=False, show_link=False)
     return plot_div
 
-def parse_ascii_file(request, file_name, raw_content):
+## Columns of an uploaded data file
+ASCII_COLUMNS = ['q', 'r', 'dr', 'dq']
+
+def read_ascii_data(data_file, chunk_size=100000):
+    """
+        Read Q, R, dR and dQ arrays from a whitespace-separated text file.
+        The file is parsed in chunks, so that only the numerical arrays are kept in memory.
+        When dQ is missing, a 3% Q resolution is used.
+
+        :param file data_file: file object to read from
+        :param int chunk_size: number of lines to parse at once
+    """
+    import pandas
+    chunks = dict((name, []) for name in ASCII_COLUMNS)
+    reader = pandas.read_csv(data_file, delim_whitespace=True, comment='#', names=ASCII_COLUMNS,
+                             dtype=np.float64, chunksize=chunk_size)
+    for chunk in reader:
+        for name in ASCII_COLUMNS:
+            chunks[name].append(chunk[name].values)
+    if len(chunks['q']) == 0:
+        raise ValueError("No data found")
+    q, r, dr, dq = [np.concatenate(chunks[name]) for name in ASCII_COLUMNS]
+
+    # If we don't have a fourth column, add 3% Q resolution
+    missing = np.isnan(dq)
+    dq[missing] = q[missing] * 0.03
+    return q, r, dr, dq
+
+def _local_file_path(file_name, data_file):
+    """
+        Return the path of a file on disk for an uploaded file, and whether it is
+        a temporary copy that the caller should remove.
+        :param str file_name: name of the uploaded file
+        :param file data_file: uploaded file
+    """
+    import tempfile
+    import shutil
+    if hasattr(data_file, 'temporary_file_path'):
+        return data_file.temporary_file_path(), False
+    data_file.seek(0)
+    _, extension = os.path.splitext(file_name)
+    with tempfile.NamedTemporaryFile(suffix=extension, delete=False) as local_file:
+        shutil.copyfileobj(data_file, local_file)
+    return local_file.name, True
+
+def read_data_file(file_name, data_file):
+    """
+        Read the data sets of an uploaded file. ORSO text files (.ort) and HDF5 files
+        can hold several data sets, each of which is stored separately.
+        Other files are read as whitespace-separated text.
+        Returns a list of (name, [q, r, dr, dq]) pairs.
+
+        :param str file_name: name of the uploaded file
+        :param file data_file: uploaded file, or content of the file
+    """
+    if isinstance(data_file, unicode):
+        data_file = data_file.encode('utf-8')
+    if isinstance(data_file, bytes):
+        data_file = io.BytesIO(data_file)
+
+    lower_name = file_name.lower()
+    if lower_name.endswith(data_readers.ORSO_EXTENSIONS):
+        data_sets = data_readers.read_orso_text(data_file)
+    elif lower_name.endswith(data_readers.HDF5_EXTENSIONS):
+        file_path, is_copy = _local_file_path(file_name, data_file)
+        try:
+            data_sets = data_readers.read_hdf5(file_path, getattr(settings, 'MAX_UPLOAD_SIZE', 64 * 1024 * 1024))
+        finally:
+            if is_copy:
+                os.remove(file_path)
+    else:
+        return [(file_name, list(read_ascii_data(data_file)))]
+
+    if len(data_sets) == 1:
+        return [(file_name, list(data_sets[0][1:]))]
+    output = []
+    for i, data_set in enumerate(data_sets):
+        name = data_set[0] if data_set[0] else str(i)
+        output.append(("%s [%s]" % (file_name, name), list(data_set[1:])))
+    return output
+
+def render_data_file(file_name, data_file):
+    """
+        Read an uploaded data file and package each of its data sets in a plot,
+        which is what we store. Returns a list of (name, plot) pairs.
+        This doesn't touch the database, so it can be called from a worker thread.
+        :param str file_name: name of the uploaded file
+        :param file data_file: uploaded file, or content of the file
+    """
+    plots = []
+    for name, data_set in read_data_file(file_name, data_file):
+        # This is what we store, so we keep every point.
+        plots.append((name, plot1d([data_set], data_names=name, x_title=u"Q (1/A)",
+                                   y_title="Reflectivity", max_points=0)))
+    return plots
+
+def parse_ascii_file(request, file_name, data_file):
     """
         Process an uploaded data file
         :param Request request: http request object
         :param str file_name: name of the uploaded file
-        :param str raw_content: content of the file
+        :param file data_file: uploaded file, or content of the file
     """
     try:
-        # If we don't have a fourth column, add 3% Q resolution
-        current_str = io.StringIO(unicode(raw_content))
-        current_data = pandas.read_csv(current_str, delim_whitespace=True, comment='#', names=['q','r','dr','dq'])
-        data_set = [current_data['q'], current_data['r'], current_data['dr'], current_data['dq']]
-        for i in range(len(current_data['dq'])):
-            if np.isnan(current_data['dq'][i]):
-                current_data['dq'][i] = current_data['q'][i] * 0.03
-
-        # Package the data in a plot
-        plot = plot1d([data_set], data_names=file_name, x_title=u"Q (1/A)", y_title="Reflectivity")
-
-        # Upload plot to live data server
-        return data_handler.store_user_data(request, file_name, plot)
+        for name, plot in render_data_file(file_name, data_file):
+            # Upload plot to live data server
+            success, error = data_handler.store_user_data(request, name, plot)
+            if not success:
+                return success, error
+        return True, ""
     except:
         logging.error("Could not parse file %s: %s", file_name, sys.exc_value)
         return False, "Could not parse data file %s" % file_name
 
+# Extensions of the archives we extract data files from
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2')
+## Size of the chunks read from the members of an uploaded archive
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+def _archive_members(archive_name, archive_file, max_size):
+    """
+        Return the (file name, file object) pairs for the data files in an archive.
+        Directories and hidden files are skipped. The sizes recorded in an archive
+        can't be trusted, so the extracted bytes are counted as they are read.
+        :param str archive_name: name of the uploaded archive
+        :param file archive_file: uploaded archive
+        :param int max_size: maximum total size of the extracted files
+    """
+    members = []
+    total_size = 0
+    if archive_name.lower().endswith('.zip'):
+        archive = zipfile.ZipFile(archive_file)
+        entries = [(info.filename, info) for info in archive.infolist() if not info.filename.endswith('/')]
+        open_member = archive.open
+    else:
+        archive = tarfile.open(fileobj=archive_file, mode='r:*')
+        entries = [(info.name, info) for info in archive.getmembers() if info.isfile()]
+        open_member = archive.extractfile
+    try:
+        for name, info in entries:
+            file_name = os.path.basename(name)
+            if file_name.startswith('.') or '__MACOSX' in name:
+                continue
+            member = open_member(info)
+            content = io.BytesIO()
+            while True:
+                chunk = member.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                total_size += len(chunk)
+                if total_size > max_size:
+                    raise ValueError("The content of %s is too big" % archive_name)
+                content.write(chunk)
+            member.close()
+            content.seek(0)
+            members.append((file_name, content))
+    finally:
+        archive.close()
+    return members
+
+def expand_uploads(uploaded_files):
+    """
+        List the data files in a set of uploaded files, extracting the content of
+        zip and tar archives. Returns a list of (file name, file object) pairs,
+        and a list of error messages.
+        :param list uploaded_files: list of uploaded files
+    """
+    max_size = getattr(settings, 'MAX_UPLOAD_SIZE', 64 * 1024 * 1024)
+    max_files = getattr(settings, 'MAX_UPLOAD_FILES', 100)
+    data_files = []
+    errors = []
+    for uploaded in uploaded_files:
+        if uploaded.size > max_size:
+            errors.append("The uploaded file %s is too big." % uploaded.name)
+        elif uploaded.name.lower().endswith(('.zip',) + TAR_EXTENSIONS):
+            try:
+                data_files.extend(_archive_members(uploaded.name, uploaded, max_size))
+            except:
+                logging.error("Could not read archive %s: %s", uploaded.name, sys.exc_value)
+                errors.append("Could not read archive %s" % uploaded.name)
+        else:
+            data_files.append((uploaded.name, uploaded))
+    if len(data_files) > max_files:
+        errors.append("Only the first %s files were loaded." % max_files)
+        data_files = data_files[:max_files]
+    return data_files, errors
+
+def _render_upload(upload):
+    """
+        Helper for ingest_files(): package the data sets of an uploaded file in plots.
+        Returns a list of (name, plot, error message) tuples.
+        :param tuple upload: (file name, file object) pair
+    """
+    file_name, data_file = upload
+    try:
+        return [(name, plot, "") for name, plot in render_data_file(file_name, data_file)]
+    except:
+        logging.error("Could not parse file %s: %s", file_name, sys.exc_value)
+        return [(file_name, None, "Could not parse data file %s" % file_name)]
+
+def ingest_files(request, data_files):
+    """
+        Parse and store a set of data files, and create their UserData entries
+        in one bulk insert. Returns a (name, success, error message) tuple for
+        each data set, or for each file that could not be parsed.
+
+        :param Request request: http request object
+        :param list data_files: list of (file name, file object) pairs
+    """
+    if len(data_files) == 0:
+        return []
+    rendered = [item for data_file in data_files for item in _render_upload(data_file)]
+    to_push = [(i, file_name, plot) for i, (file_name, plot, _) in enumerate(rendered) if plot is not None]
+    pushed = [data_handler.push_user_data(request, file_name, plot) for _, file_name, plot in to_push]
+
+    data_handler.register_user_data(request, [entry for success, _, entry in pushed if success])
+
+    push_results = dict((item[0], result) for item, result in zip(to_push, pushed))
+    results = []
+    for i, (file_name, plot, error) in enumerate(rendered):
+        if plot is None:
+            results.append((file_name, False, error))
+        else:
+            success, error, _ = push_results[i]
+            results.append((file_name, success, error))
+    return results
+
 def get_user_files(request):
     """
         Get list of uploaded files
@@ -793,6 +1528,68 @@ def get_user_files(request):
 
     return json.dumps(data_list)
 
+# Columns of the fit list that can be sorted, and the corresponding query fields
+FIT_LIST_SORTS = {'timestamp': 'timestamp',
+                  'created_on': 'timestamp',
+                  'data': 'data_path'}
+
+def get_fit_list(request, max_per_page=100):
+    """
+        Get a page of the user's fits, following the dynatable ajax protocol:
+        the request may contain page/perPage/offset, sorts[<column>]=1|-1 and
+        queries[search]=<text> parameters.
+
+        Only the requested page is loaded. Reflectivity models are joined and
+        layers are prefetched, so the number of queries does not depend on the
+        number of stored fits.
+
+        :param Request request: http request object
+        :param int max_per_page: maximum number of records returned at once
+    """
+    fit_list = FitProblem.objects.filter(user=request.user).exclude(data_path__in=['', 'saved'])
+    total_count = fit_list.count()
+    query_count = total_count
+
+    search = request.GET.get('queries[search]', '').strip()
+    if len(search) > 0:
+        fit_list = fit_list.filter(Q(data_path__icontains=search)
+                                   | Q(reflectivity_model__front_name__icontains=search)
+                                   | Q(reflectivity_model__back_name__icontains=search)
+                                   | Q(layers__name__icontains=search)).distinct()
+        query_count = fit_list.count()
+
+    ordering = []
+    for key, value in request.GET.items():
+        if key.startswith('sorts[') and key.endswith(']') and key[6:-1] in FIT_LIST_SORTS:
+            field = FIT_LIST_SORTS[key[6:-1]]
+            ordering.append(field if value == '1' else '-%s' % field)
+    if len(ordering) == 0:
+        ordering = ['-timestamp']
+    fit_list = fit_list.order_by(*(ordering + ['-id']))
+
+    try:
+        per_page = min(max(int(request.GET.get('perPage', 25)), 1), max_per_page)
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        per_page = 25
+        offset = 0
+    fit_list = fit_list.select_related('reflectivity_model').prefetch_related('layers')[offset:offset+per_page]
+
+    records = []
+    for item in fit_list:
+        data_path = item.reflectivity_model.data_path
+        localtime = timezone.localtime(item.timestamp)
+        df = dateformat.DateFormat(localtime)
+        actions = "<a href='%s%s' target='_blank'>click to fit</a> " % (reverse('fitting:modeling'), data_path)
+        actions += " | <a href='%s'><span style='display:inline-block' class='ui-icon ui-icon-trash'></span></a>" % reverse('fitting:delete_problem', args=(item.id,))
+        records.append({'id': item.id, 'layers': item.show_layers(),
+                        'data': "<span draggable='true' ondragstart='drag(event)'>%s</span>" % data_path,
+                        'url': actions,
+                        'timestamp': item.timestamp.isoformat(),
+                        'created_on': df.format(settings.DATETIME_FORMAT)})
+
+    return dict(records=records, queryRecordCount=query_count, totalRecordCount=total_count)
+
 def parse_data_path(data_path):
     """
         Parse a data path of the form <instrument>/<data>
@@ -807,67 +1604,55 @@ def parse_data_path(data_path):
         data_id = toks[1]
     return instrument, data_id
 
-def reverse_model(fit_problem):
+def _bulk_update_layers(layers, fields):
     """
-        Reverse a layer model
-    """
-    front_name = fit_problem.reflectivity_model.front_name
-    front_sld = fit_problem.reflectivity_model.front_sld
-    front_sld_is_fixed = fit_problem.reflectivity_model.front_sld_is_fixed
-    front_sld_min = fit_problem.reflectivity_model.front_sld_min
-    front_sld_max = fit_problem.reflectivity_model.front_sld_max
-    front_sld_error = fit_problem.reflectivity_model.front_sld_error
-
-    fit_problem.reflectivity_model.front_name = fit_problem.reflectivity_model.back_name
-    fit_problem.reflectivity_model.front_sld = fit_problem.reflectivity_model.back_sld
-    fit_problem.reflectivity_model.front_sld_is_fixed = fit_problem.reflectivity_model.back_sld_is_fixed
-    fit_problem.reflectivity_model.front_sld_min = fit_problem.reflectivity_model.back_sld_min
-    fit_problem.reflectivity_model.front_sld_max = fit_problem.reflectivity_model.back_sld_max
-    fit_problem.reflectivity_model.front_sld_error = fit_problem.reflectivity_model.back_sld_error
-
-    fit_problem.reflectivity_model.back_name = front_name
-    fit_problem.reflectivity_model.back_sld = front_sld
-    fit_problem.reflectivity_model.back_sld_is_fixed = front_sld_is_fixed
-    fit_problem.reflectivity_model.back_sld_min = front_sld_min
-    fit_problem.reflectivity_model.back_sld_max = front_sld_max
-    fit_problem.reflectivity_model.back_sld_error = front_sld_error
-
-    layers = [l.id for l in fit_problem.layers.all().order_by('layer_number')]
-    count = fit_problem.layers.all().count()
-
-    if count > 0:
-        _roughness = fit_problem.reflectivity_model.back_roughness
-        _roughness_is_fixed = fit_problem.reflectivity_model.back_roughness_is_fixed
-        _roughness_min = fit_problem.reflectivity_model.back_roughness_min
-        _roughness_max = fit_problem.reflectivity_model.back_roughness_max
-        _roughness_error = fit_problem.reflectivity_model.back_roughness_error
-
-        layer = ReflectivityLayer.objects.get(id=layers[0])
-        fit_problem.reflectivity_model.back_roughness = layer.roughness
-        fit_problem.reflectivity_model.back_roughness_is_fixed = layer.roughness_is_fixed
-        fit_problem.reflectivity_model.back_roughness_min = layer.roughness_min
-        fit_problem.reflectivity_model.back_roughness_max = layer.roughness_max
-        fit_problem.reflectivity_model.back_roughness_error = layer.roughness_error
-
-    fit_problem.reflectivity_model.save()
-    fit_problem.remote_job = None
-    fit_problem.save()
+        Write the given fields of a list of layers with a single UPDATE query.
 
-    # Reorder the layers
-    for i in range(count):
-        layer = ReflectivityLayer.objects.get(id=layers[i])
-        layer.layer_number = count - i
-        if i == count-1:
-            layer.roughness = _roughness
-            layer.roughness_is_fixed = _roughness_is_fixed
-            layer.roughness_min = _roughness_min
-            layer.roughness_max = _roughness_max
-            layer.roughness_error = _roughness_error
-        else:
-            prev_layer = ReflectivityLayer.objects.get(id=layers[i+1])
-            layer.roughness = prev_layer.roughness
-            layer.roughness_is_fixed = prev_layer.roughness_is_fixed
-            layer.roughness_min = prev_layer.roughness_min
-            layer.roughness_max = prev_layer.roughness_max
-            layer.roughness_error = prev_layer.roughness_error
-        layer.save()
+        :param list layers: list of saved ReflectivityLayer objects
+        :param list fields: list of field names to write
+    """
+    if len(layers) == 0:
+        return
+    updates = {}
+    for field in fields:
+        updates[field] = Case(*[When(pk=layer.pk, then=Value(getattr(layer, field))) for layer in layers],
+                              output_field=ReflectivityLayer._meta.get_field(field))
+    ReflectivityLayer.objects.filter(pk__in=[layer.pk for layer in layers]).update(**updates)
+
+def reverse_model(fit_problem):
+    """
+        Reverse a layer model.
+        The layers are loaded once and written back with a single query.
+    """
+    roughness_fields = ['roughness', 'roughness_is_fixed', 'roughness_min', 'roughness_max', 'roughness_error']
+    with transaction.atomic():
+        ref_model = fit_problem.reflectivity_model
+
+        # Swap the front and back media
+        for par in ['name', 'sld', 'sld_is_fixed', 'sld_min', 'sld_max', 'sld_error']:
+            front_value = getattr(ref_model, 'front_%s' % par)
+            setattr(ref_model, 'front_%s' % par, getattr(ref_model, 'back_%s' % par))
+            setattr(ref_model, 'back_%s' % par, front_value)
+
+        layers = list(fit_problem.layers.select_for_update().order_by('layer_number'))
+        count = len(layers)
+
+        if count > 0:
+            # Each roughness describes the interface below a layer, so it moves
+            # to the next layer. The first layer's roughness becomes the back roughness
+            # and the old back roughness goes to the last layer.
+            back_roughness = [getattr(ref_model, 'back_%s' % par) for par in roughness_fields]
+            for par in roughness_fields:
+                setattr(ref_model, 'back_%s' % par, getattr(layers[0], par))
+            for i, layer in enumerate(layers):
+                layer.layer_number = count - i
+                for j, par in enumerate(roughness_fields):
+                    if i == count-1:
+                        setattr(layer, par, back_roughness[j])
+                    else:
+                        setattr(layer, par, getattr(layers[i+1], par))
+
+        ref_model.save()
+        fit_problem.remote_job = None
+        fit_problem.save()
+        _bulk_update_layers(layers, ['layer_number'] + roughness_fields)
@@ -11,9 +11,8 @@ from django.forms.formsets import formset_factory
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, HttpResponseNotFound, Http404
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden, Http404, StreamingHttpResponse
 from django.views.generic.base import View
-from django.views.generic.list import ListView
 from django.views.generic.edit import UpdateView, DeleteView
 from django.utils import dateformat, timezone
 from django.utils.decorators import method_decorator
@@ -24,6 +23,7 @@ import users.view_util
 from .forms import ReflectivityFittingForm, LayerForm, UploadFileForm, ConstraintForm, layer_modelformset, UserDataUpdateForm, SimultaneousModelForm
 from .models import FitProblem, FitterOptions, Constraint, ReflectivityModel, ReflectivityLayer, SavedModelInfo, UserData, SimultaneousModel, SimultaneousConstraint, SimultaneousFit
 from . import view_util
+from . import metrics
 from .data_server import data_handler
 from .simultaneous import model_handling
 
@@ -110,21 +110,22 @@ class FileView(View):
         return render(request, self.template_name, template_values)
 
     def post(self, request, *args, **kwargs):
-        """ Process a POST request """
-        template_values = self._get_template_values(request)
+        """
+            Process a POST request.
+            Several files can be uploaded at once, including zip and tar archives of data files.
+        """
         form = self.form_class(request.POST, request.FILES)
         errors = []
         if form.is_valid():
-            file_name = request.FILES['file'].name
-            if request.FILES['file'].size < 1024 * 1024:
-                raw_content = request.FILES['file'].read()
-                success, error_msg = view_util.parse_ascii_file(request, file_name, raw_content)
-                if success is True:
-                    return redirect(reverse('fitting:show_files'))
-                else:
-                    errors.append(error_msg)
-            else:
-                errors.append("The uploaded file is too big.")
+            data_files, errors = view_util.expand_uploads(request.FILES.getlist('file'))
+            results = view_util.ingest_files(request, data_files)
+            errors.extend([error for _, success, error in results if not success])
+            if len(errors) == 0:
+                return redirect(reverse('fitting:show_files'))
+            n_loaded = len([item for item in results if item[1]])
+            if n_loaded > 0:
+                errors.insert(0, "Loaded %s of %s files" % (n_loaded, len(results)))
+        template_values = self._get_template_values(request)
         template_values['form'] = form
         template_values['user_alert'] = errors
         return render(request, self.template_name, template_values)
@@ -195,13 +196,39 @@ def download_model(request, instrument, data_id):
         :param instrument: instrument name
         :param run_id: run number
     """
-    ascii_data = view_util.get_model_as_csv(request, instrument, data_id)
-    if ascii_data is None:
-        ascii_data = "There is no model for this data: construct your model and click Evaluate first."
-    response = HttpResponse(ascii_data, content_type="text/plain")
+    model_csv = view_util.stream_model_csv(request, instrument, data_id)
+    if model_csv is None:
+        model_csv = ["There is no model for this data: construct your model and click Evaluate first."]
+    response = StreamingHttpResponse(model_csv, content_type="text/plain")
     response['Content-Disposition'] = 'attachment; filename=%s_%s_model.txt' % (instrument.upper(), data_id)
     return response
 
+@login_required
+def export_models(request):
+    """
+        Download a zip file with the models, data and theory curves of several fits.
+        The fits are selected with path=<instrument>/<data_id> or proposal=<proposal>
+        parameters, or all the user's fits are exported.
+        :param request: http request object
+    """
+    fit_list = view_util.export_fit_list(request)
+    response = StreamingHttpResponse(view_util.iter_model_archive(fit_list), content_type="application/zip")
+    response['Content-Disposition'] = 'attachment; filename=reflectivity_models.zip'
+    return response
+
+def metrics_report(request):
+    """
+        Report the application metrics in the Prometheus text format.
+        Staff users can read them, as well as clients sending the METRICS_TOKEN
+        setting in a bearer authorization header.
+        :param request: http request object
+    """
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not request.user.is_staff and \
+       (not token or request.META.get('HTTP_AUTHORIZATION', '') != 'Bearer %s' % token):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.report(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @login_required
 def reverse_model(request, instrument, data_id):
     """
@@ -253,42 +280,27 @@ def save_model(request, instrument, data_id):
     return response
 
 @method_decorator(login_required, name='dispatch')
-class FitListView(ListView):
+class FitListView(View):
     """
-        List of fits
+        List of fits. The list itself is loaded page by page from fit_list_json().
     """
-    model = FitProblem
-    template_name = 'fitting/fit_list.html'
-    context_object_name = 'fit_list'
+    breadcrumbs = "<a href='/'>home</a> &rsaquo; recent fits"
 
-    def get_queryset(self):
-        return FitProblem.objects.filter(user=self.request.user)
+    def get(self, request, *args, **kwargs):
+        """ Process GET """
+        template_values = users.view_util.fill_template_values(request, breadcrumbs=self.breadcrumbs)
+        return render(request, 'fitting/fit_list.html', template_values)
 
-    def get_context_data(self, **kwargs):
-        context = super(FitListView, self).get_context_data(**kwargs)
-        errors = []
-        if len(context) == 0:
-            errors.append("No fit found")
-        fit_list = []
-        for item in context['fit_list']:
-            # Skip saved models
-            if len(item.reflectivity_model.data_path) == 0 or item.reflectivity_model.data_path == 'saved':
-                continue
-            localtime = timezone.localtime(item.timestamp)
-            df = dateformat.DateFormat(localtime)
-            actions = "<a href='%s%s' target='_blank'>click to fit</a> " % (reverse('fitting:modeling'),
-                                                                            item.reflectivity_model.data_path)
-            actions += " | <a href='%s'><span style='display:inline-block' class='ui-icon ui-icon-trash'></span></a>" % reverse('fitting:delete_problem', args=(item.id,))
-            fit_list.append({'id': item.id, 'layers': item.show_layers(),
-                             'data': "<span draggable='true' ondragstart='drag(event)'>%s</span>" % item.reflectivity_model.data_path,
-                             'url': actions,
-                             'timestamp': item.timestamp.isoformat(),
-                             'created_on': df.format(settings.DATETIME_FORMAT)})
-        context['json_list'] = json.dumps(fit_list)
-        context['user_alert'] = errors
-        context['breadcrumbs'] = "<a href='/'>home</a> &rsaquo; recent fits"
-        context = users.view_util.fill_template_values(self.request, **context)
-        return context
+@login_required
+def fit_list_json(request):
+    """
+        Return a page of the user's fits as JSON.
+        See view_util.get_fit_list() for the supported parameters.
+        :param request: request object
+    """
+    return_value = view_util.get_fit_list(request)
+    response = HttpResponse(json.dumps(return_value), content_type="application/json")
+    return response
 
 @method_decorator(login_required, name='dispatch')
 class FitView(View):
@@ -347,7 +359,12 @@ class FitView(View):
         layers_form = LayerFormSet(queryset=fit_problem.layers.all().order_by('layer_number') if fit_problem is not None else ReflectivityLayer.objects.none())
 
         job_id = request.session.get('job_id', None)
-        html_data, _chi2 = view_util.assemble_plots(request, instrument, data_id, fit_problem, rq4=template_values['rq4'])
+        # The browser can fetch and render the plots itself
+        if getattr(settings, 'CLIENT_SIDE_PLOTS', False):
+            html_data, _chi2 = '', None
+            template_values['plot_url'] = reverse('fitting:plot_data', args=(instrument, data_id))
+        else:
+            html_data, _chi2 = view_util.assemble_plots(request, instrument, data_id, fit_problem, rq4=template_values['rq4'], refresh=False)
         template_values.update({'data_form': data_form,
                                 'html_data': html_data,
                                 'user_alert': error_message,
@@ -393,7 +410,7 @@ class FitView(View):
         try:
             # See if we have a fit problem already
             fit_problem_list = FitProblem.objects.filter(user=request.user,
-                                                         reflectivity_model__data_path=data_path)
+                                                         data_path=data_path)
             if len(fit_problem_list) > 0:
                 reflectivity_model = fit_problem_list.latest('timestamp').reflectivity_model
             else:
@@ -443,6 +460,26 @@ class FitView(View):
         else:
             return redirect(reverse('fitting:fit', args=(instrument, data_id)))
 
+@login_required
+def plot_data(request, instrument, data_id):
+    """
+        Return the plots for a data set as JSON, for the browser to render.
+        The 'encoding' parameter selects how the arrays are sent (see view_util.encode_array).
+        R is sent unscaled unless the 'rq4' parameter is 1: the browser can apply the Q^4 scaling itself.
+        :param request: http request object
+        :param instrument: instrument name
+        :param data_id: data set identifier
+    """
+    is_allowed, _ = view_util.check_permissions(request, data_id, instrument)
+    if is_allowed is False:
+        raise Http404
+    _, fit_problem = view_util.get_fit_problem(request, instrument, data_id)
+    plots, chi2 = view_util.assemble_plots(request, instrument, data_id, fit_problem,
+                                           rq4=request.GET.get('rq4', '0') == '1', as_json=True,
+                                           encoding=view_util.plot_payload_encoding(request))
+    response = HttpResponse(json.dumps(dict(plots=plots, chi2=chi2)), content_type="application/json")
+    return response
+
 @method_decorator(login_required, name='dispatch')
 class FitAppend(View):
     """
@@ -685,12 +722,17 @@ class SimultaneousView(View):
         breadcrumbs = "<a href='/'>home</a> &rsaquo; simultaneous &rsaquo; %s &rsaquo; %s" % (instrument, data_id)
         job_id = request.session.get('job_id', None)
         active_form = chi2 is None or setup_request
-        html_data = model_handling.assemble_plots(request, fit_problem, fitproblem_list)
         template_values = dict(breadcrumbs=breadcrumbs, instrument=instrument, results_ready=results_ready,
                                existing_constraints=json.dumps(constraints), draggable=active_form,
                                chi2=chi2, job_id=job_id if can_update and not setup_request else None,
                                data_id=data_id, model_list=model_list, user_alert=error_list,
-                               html_data=html_data)
+                               rq4=request.session.get('rq4', False))
+        # The browser can fetch and render the plots itself
+        if getattr(settings, 'CLIENT_SIDE_PLOTS', False):
+            plot_url = reverse('fitting:simultaneous_plot_data', args=(instrument, data_id))
+            template_values['plot_url'] = plot_url + '?setup=1' if setup_request else plot_url
+        else:
+            template_values['html_data'] = model_handling.assemble_plots(request, fit_problem, fitproblem_list)
 
         template_values = users.view_util.fill_template_values(request, **template_values)
         return render(request, 'fitting/simultaneous_view.html', template_values)
@@ -718,6 +760,25 @@ class SimultaneousView(View):
 
         return redirect(reverse('fitting:simultaneous', args=(instrument, data_id)))
 
+@login_required
+def simultaneous_plot_data(request, instrument, data_id):
+    """
+        Return the plots for a simultaneous fit as JSON, for the browser to render.
+        :param request: http request object
+        :param instrument: instrument name
+        :param data_id: data set identifier
+    """
+    _, fit_problem = view_util.get_fit_problem(request, instrument, data_id)
+    if fit_problem is None or not fit_problem.user == request.user:
+        raise Http404
+    setup_request = request.GET.get('setup', '0') == '1'
+    _, _, chi2, _, _, fitproblem_list = model_handling.get_simultaneous_models(request, fit_problem, setup_request)
+    plots = model_handling.assemble_plots(request, fit_problem, fitproblem_list, as_json=True,
+                                          encoding=view_util.plot_payload_encoding(request),
+                                          rq4=request.GET.get('rq4', '0') == '1')
+    response = HttpResponse(json.dumps(dict(plots=plots, chi2=chi2)), content_type="application/json")
+    return response
+
 @login_required
 @csrf_exempt
 def update_simultaneous_params(request, instrument, data_id):
@@ -779,7 +840,7 @@ class ModelListView(View):
         apply_to = request.GET.get('apply_to', None)
         template_values = {'breadcrumbs': self.breadcrumbs}
 
-        model_objects = SavedModelInfo.objects.filter(user=request.user)
+        model_objects = SavedModelInfo.objects.filter(user=request.user).select_related('fit_problem__reflectivity_model', 'fit_problem__user').prefetch_related('fit_problem__layers')
         model_list = []
         for item in model_objects:
             localtime = timezone.localtime(item.fit_problem.timestamp)
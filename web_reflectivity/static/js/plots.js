@@ -0,0 +1,116 @@
+/*
+    Render the plots served as JSON payloads by the fitting views.
+    Arrays may be plain lists, or little-endian float32 values packed as base64.
+*/
+function decode_array(value) {
+    if (value !== null && typeof value === 'object' && value.bdata !== undefined) {
+        var raw = window.atob(value.bdata);
+        var bytes = new Uint8Array(raw.length);
+        for (var i = 0; i < raw.length; i++) {
+            bytes[i] = raw.charCodeAt(i);
+        }
+        return Array.prototype.slice.call(new Float32Array(bytes.buffer));
+    }
+    return value;
+}
+
+function decode_trace(trace) {
+    trace.x = decode_array(trace.x);
+    trace.y = decode_array(trace.y);
+    if (trace.error_x && trace.error_x.array) {
+        trace.error_x.array = decode_array(trace.error_x.array);
+    }
+    if (trace.error_y && trace.error_y.array) {
+        trace.error_y.array = decode_array(trace.error_y.array);
+    }
+    return trace;
+}
+
+/*
+    Reflectivity plots carry the raw R values and can be shown as R*Q^4
+    without going back to the server.
+*/
+var rendered_plots = [];
+
+function scale_rq4(plot, rq4) {
+    for (var i = 0; i < plot.data.length; i++) {
+        var trace = plot.data[i];
+        var raw = plot.raw[i];
+        var y = [];
+        var dy = [];
+        for (var j = 0; j < raw.y.length; j++) {
+            var factor = rq4 ? Math.pow(trace.x[j], 4) : 1;
+            y.push(raw.y[j] === null ? null : raw.y[j] * factor);
+            if (raw.dy) {
+                dy.push(raw.dy[j] === null ? null : raw.dy[j] * factor);
+            }
+        }
+        trace.y = y;
+        if (raw.dy) {
+            trace.error_y.array = dy;
+        }
+    }
+    plot.layout.yaxis.title = rq4 ? plot.rq4_title : plot.r_title;
+}
+
+function set_rq4(rq4) {
+    for (var i = 0; i < rendered_plots.length; i++) {
+        if (rendered_plots[i].rq4_title) {
+            scale_rq4(rendered_plots[i], rq4);
+            Plotly.react(rendered_plots[i].div, rendered_plots[i].data, rendered_plots[i].layout);
+        }
+    }
+    try {
+        window.localStorage.setItem('rq4', rq4 ? '1' : '0');
+    } catch (e) {}
+    $(".rq4_on").toggle(!rq4);
+    $(".rq4_off").toggle(rq4);
+}
+
+function get_rq4(default_value) {
+    try {
+        var stored = window.localStorage.getItem('rq4');
+        if (stored !== null) {
+            return stored === '1';
+        }
+    } catch (e) {}
+    return default_value;
+}
+
+function render_plots(element_id, url, chi2_id, rq4) {
+    $.ajax({
+        type: "GET",
+        url: url,
+        dataType: "json",
+        success: function(payload) {
+            var container = document.getElementById(element_id);
+            container.innerHTML = '';
+            rendered_plots = [];
+            for (var i = 0; i < payload.plots.length; i++) {
+                var plot = payload.plots[i];
+                plot.div = document.createElement('div');
+                container.appendChild(plot.div);
+                plot.data = plot.data.map(decode_trace);
+                if (plot.rq4_title) {
+                    plot.raw = plot.data.map(function(trace) {
+                        return {y: trace.y.slice(),
+                                dy: trace.error_y && trace.error_y.array ? trace.error_y.array.slice() : null};
+                    });
+                    if (rq4) {
+                        scale_rq4(plot, true);
+                    }
+                }
+                Plotly.newPlot(plot.div, plot.data, plot.layout, {showLink: false});
+                rendered_plots.push(plot);
+            }
+            if (chi2_id && payload.chi2 !== null && payload.chi2 !== undefined) {
+                $("#" + chi2_id).html("[&#x3C7;<sup>2</sup>=" + payload.chi2 + "]");
+            }
+            $(".rq4_on").toggle(!rq4);
+            $(".rq4_off").toggle(rq4);
+        },
+        error: function() {
+            document.getElementById(element_id).innerHTML = "<div class='error'>The plots could not be loaded.</div>";
+        }
+    });
+}
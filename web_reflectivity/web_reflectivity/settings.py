@@ -75,6 +75,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'fitting.timing.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -83,6 +84,7 @@ MIDDLEWARE_CLASSES = [
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     #'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'fitting.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'web_reflectivity.urls'
@@ -212,6 +214,10 @@ LOGIN_URL ='/users/login'
 LANDING_VIEW = 'fitting:modeling'
 GRAVATAR_URL = "https://www.gravatar.com/avatar/"
 
+# The application metrics are shared by the server and the Celery workers in Redis
+METRICS_REDIS_URL = CELERY_BROKER_URL
+METRICS_FLUSH_INTERVAL = 10
+
 # Fitting options
 REFL1D_PATH = '/usr/bin'
 REFL1D_BURN = 1000